@@ -7,7 +7,9 @@
 #include "PWMHelper.h"
 
 #define RCV_COMMAND "rcv"
-#define BAUD_RATE 9600
+#define BAUD_RATE 9600 // rate after a reset. The RPi can negotiate a higher one with the baud command
+#define BAUD_CONFIRM_COMMAND "baud_ok"
+#define BAUD_DEFAULT_WINDOW_MS 2000
 #define SERIAL_CONFIG SERIAL_8E1
 #define SOFT_SERIAL false
 #define ARR_LEN(a) sizeof(a)/sizeof(a[0])
@@ -27,6 +29,10 @@ const byte pumpPin = 3;
 
 const size_t nBalanzas = ARR_LEN(dataPins);
 
+// rates that can be negotiated with the baud command
+const unsigned long baudRates[] = {9600, 19200, 38400, 57600, 115200, 230400, 250000, 500000};
+unsigned long baudRate = BAUD_RATE;
+
 #define DHT_TYPE DHT22
 DHT dht(dhtPin, DHT_TYPE);
 
@@ -125,7 +131,7 @@ void cmdHX(Stream *stream, CommandArguments *comArgs)
 
 void cmdHXSingle(Stream *stream, CommandArguments *comArgs)
 {
-    // cmd: hx_single <int:n> <?int:n>
+    // cmd: hx_single <int:n> <int:index>
     // respuesta: 56
     // devuelve los datos de la balanza
 
@@ -133,7 +139,7 @@ void cmdHXSingle(Stream *stream, CommandArguments *comArgs)
 
     LED_ON();
 
-    if (comArgs->N < 1)
+    if (comArgs->N < 2)
     {
         stream->println(F("ERROR: No se proporcinaron dos argumentos numericos."));
         LED_OFF();
@@ -141,7 +147,7 @@ void cmdHXSingle(Stream *stream, CommandArguments *comArgs)
     }
 
     // extract argument 1
-    uint8_t index;
+    uint8_t n;
     {
         // check if arg 1 is a number
         long arg;
@@ -157,20 +163,17 @@ void cmdHXSingle(Stream *stream, CommandArguments *comArgs)
 
         if (arg < 1 || arg > 255)
         {
-            stream->print(F("ERROR: El argumento 2 debe ser un indice entre 0 y "));
-            stream->print(nBalanzas-1);
-            stream->print(F(". El argumento es "));
+            stream->print(F("ERROR: El argumento 1 debe ser un numero entre 1 y 255. El argumento es "));
             stream->println(arg);
             LED_OFF();
             return;
         }
 
-        index = static_cast<uint8_t>(arg);
+        n = static_cast<uint8_t>(arg);
     }
 
     // extract argument 2
-    size_t n = 1;
-    if (comArgs->N > 1)
+    size_t index;
     {
         long arg;
         bool isInt = comArgs->toInt(1, &arg);
@@ -178,20 +181,22 @@ void cmdHXSingle(Stream *stream, CommandArguments *comArgs)
         if (!isInt)
         {
             stream->print(F("ERROR: El argumento 2 no es un numero entero. El argumento es "));
-            stream->println(comArgs->arg(0));
+            stream->println(comArgs->arg(1));
             LED_OFF();
             return;
         }
 
-        if (arg < 0 || arg > nBalanzas)
+        if (arg < 0 || arg >= static_cast<long>(nBalanzas))
         {
-            stream->print(F("ERROR: El argumento 1 debe ser un numero entre 1 y 255. El argumento es "));
+            stream->print(F("ERROR: El argumento 2 debe ser un indice entre 0 y "));
+            stream->print(nBalanzas-1);
+            stream->print(F(". El argumento es "));
             stream->println(arg);
             LED_OFF();
             return;
         }
 
-        n = static_cast<size_t>(arg);
+        index = static_cast<size_t>(arg);
     }
     
     rcv(stream);
@@ -455,6 +460,108 @@ void cmdServoAttach(Stream *stream, CommandArguments *comArgs)
     LED_OFF();
 }
 
+void cmdEcho(Stream *stream, CommandArguments *comArgs)
+{
+    // cmd: echo <str:pattern>
+    // respuesta: <str:pattern>
+    // devuelve el argumento, para medir la tasa de errores del enlace
+
+    LED_ON();
+    if (comArgs->N == 0)
+        stream->println();
+    else
+        stream->println(comArgs->arg(0));
+    LED_OFF();
+}
+
+// reads a line (without the line ending) into buffer. Returns false if nothing complete arrived before deadline
+bool readLineUntil(Stream *stream, char *buffer, size_t len, unsigned long deadline)
+{
+    size_t pos = 0;
+    while (static_cast<long>(deadline - millis()) > 0)
+    {
+        if (!stream->available())
+            continue;
+        char c = stream->read();
+        if (c == '\n')
+        {
+            buffer[pos] = '\0';
+            return true;
+        }
+        if (c != '\r' && pos < len-1)
+            buffer[pos++] = c;
+    }
+    return false;
+}
+
+void cmdBaud(Stream *stream, CommandArguments *comArgs)
+{
+    // cmd: baud <long:rate> <?int:window_ms>
+    // respuesta: "OK <rate>" a la velocidad actual
+    // Despues cambia a la nueva velocidad y devuelve cada linea que recibe (para que el RPi
+    // pruebe el enlace) hasta recibir "baud_ok", que confirma el cambio (respuesta "OK").
+    // Si pasan window_ms sin recibir una linea o la confirmacion, vuelve a la velocidad anterior
+
+    LED_ON();
+    #if SOFT_SERIAL
+    stream->println(F("ERROR: No se puede cambiar la velocidad con SoftwareSerial"));
+    LED_OFF();
+    return;
+    #else
+    long rate;
+    if (!comArgs->toInt(0, &rate))
+    {
+        stream->print(F("ERROR: El argumento 1 no es un numero entero. El argumento es "));
+        stream->println(comArgs->arg(0));
+        LED_OFF();
+        return;
+    }
+    bool valid = false;
+    for (size_t i = 0; i < ARR_LEN(baudRates); i++)
+        valid = valid || baudRates[i] == static_cast<unsigned long>(rate);
+    if (!valid)
+    {
+        stream->print(F("ERROR: Velocidad no soportada "));
+        stream->println(rate);
+        LED_OFF();
+        return;
+    }
+
+    long windowMs = BAUD_DEFAULT_WINDOW_MS;
+    if (comArgs->N > 1 && (!comArgs->toInt(1, &windowMs) || windowMs < 100 || windowMs > 10000))
+    {
+        stream->print(F("ERROR: El argumento 2 debe ser un numero entre 100 y 10000. El argumento es "));
+        stream->println(comArgs->arg(1));
+        LED_OFF();
+        return;
+    }
+
+    stream->print(F("OK "));
+    stream->println(rate);
+    Serial.flush();
+    Serial.end();
+    Serial.begin(rate, SERIAL_CONFIG);
+
+    char line[STREAM_BUFFER_LEN+1];
+    while (readLineUntil(stream, line, sizeof(line), millis() + windowMs))
+    {
+        if (strcmp_P(line, (PGM_P)F(BAUD_CONFIRM_COMMAND)) == 0)
+        {
+            baudRate = rate;
+            stream->println(F("OK"));
+            LED_OFF();
+            return;
+        }
+        stream->println(line);
+    }
+
+    // not confirmed, back to the previous rate
+    Serial.end();
+    Serial.begin(baudRate, SERIAL_CONFIG);
+    LED_OFF();
+    #endif
+}
+
 void cmdOK(Stream *stream, CommandArguments *comArgs)
 {
     // cmd: ok
@@ -482,6 +589,8 @@ CreateSmartCommandF(cmdPump_, "pump", cmdPump);
 CreateSmartCommandF(cmdStepperAttach_, "stepper_attach", cmdStepperAttach);
 CreateSmartCommandF(cmdServoAttach_, "servo_attach", cmdServoAttach);
 CreateSmartCommandF(cmdOK_, "ok", cmdOK);
+CreateSmartCommandF(cmdEcho_, "echo", cmdEcho);
+CreateSmartCommandF(cmdBaud_, "baud", cmdBaud);
 
 void setup()
 {
@@ -511,6 +620,8 @@ void setup()
     ss.addCommand(&cmdStepperAttach_);
     ss.addCommand(&cmdServoAttach_);
     ss.addCommand(&cmdOK_);
+    ss.addCommand(&cmdEcho_);
+    ss.addCommand(&cmdBaud_);
 
     Serial.println("begin");
     LED_OFF();
@@ -0,0 +1,196 @@
+'''
+    Aggregator of the tick records shipped by the CollectorClients of many pis. Every batch
+    is stored in a single sqlite database along with its id, in one transaction, and only
+    then acknowledged, so a batch that is sent again (the ack was lost) is ignored. A batch
+    that can't be decoded or has malformed records is rejected explicitly, so the client
+    sets it aside instead of sending it again forever.
+    There is no authentication, so it only listens on localhost unless a bind address is
+    given, and then it should be limited to the pis with --allow (or a firewall / vpn).
+    Run it on the node that keeps the data (or on the same pi, to test):
+        python aggregator.py [db_file] [--port 7700] [--bind 0.0.0.0 --allow 192.168.0.10,192.168.0.11]
+    and query it with sqlite3, for example
+        select time, weight from ticks where site='pi1' and system='sistema_1' and balanza=0
+'''
+from __future__ import annotations
+import sys
+import socket
+import argparse
+import sqlite3
+import threading
+import socketserver
+from typing import Optional, Sequence
+from logging_helper import logger as lh
+from collector import MAGIC, ACK_MAGIC, REJECT_MAGIC, MAX_PAYLOAD, _frame_header, _ack, recv_exactly, decode_records
+
+_SCHEMA = '''
+create table if not exists batches (
+    site text not null,
+    batch_id integer not null,
+    received real not null default (julianday('now')),
+    n_records integer not null,
+    primary key (site, batch_id)
+);
+create table if not exists ticks (
+    site text not null,
+    system text not null,
+    time text not null,
+    balanza integer not null,
+    weight real,
+    stdev real,
+    watered integer,
+    n_filtered integer,
+    goal real,
+    threshold real,
+    n_unsuccessful real,
+    hum real,
+    temp real,
+    read integer
+);
+create index if not exists ticks_site_system_time on ticks (site, system, time, balanza);
+'''
+
+
+class Aggregator:
+    def __init__(self, db_file: str='aggregated.sqlite', host: str='127.0.0.1', port: int=7700, allow: Optional[Sequence[str]]=None) -> None:
+        ''' allow are the addresses of the clients that can connect, any if None '''
+        self.db_file = db_file
+        self.host = host
+        self.port = port
+        self.allow = None if allow is None else frozenset(allow)
+        self.n_batches = 0
+        self.n_repeated = 0
+        self.n_rejected = 0
+        self._db = sqlite3.connect(db_file, check_same_thread=False)
+        self._db.executescript(_SCHEMA)
+        # databases from before the read column
+        if 'read' not in [c[1] for c in self._db.execute('pragma table_info(ticks)')]:
+            self._db.execute('alter table ticks add column read integer')
+        self._db_lock = threading.Lock()
+        self.server: Optional[socketserver.ThreadingTCPServer] = None
+        self._thread: Optional[threading.Thread] = None
+        self._connections: set = set()
+
+    def store(self, site: str, batch_id: int, records: list) -> bool:
+        '''
+            stores a batch. Returns False if it was already stored. Malformed records raise
+            before anything is written (KeyError, IndexError, TypeError)
+        '''
+        rows = list()
+        for r in records:
+            n = len(r['means'])
+            for i in range(n):
+                read = r.get('read')
+                rows.append((
+                    site, r['system'], r['time'], i, r['means'][i], r['stdevs'][i], r['to_water'][i],
+                    r['n_filtered'][i], r['goals'][i], r['threshold'], r['n_unsuccessful'], r['hum'], r['temp'],
+                    None if read is None else read[i]
+                ))
+        with self._db_lock, self._db:
+            try:
+                self._db.execute('insert into batches (site, batch_id, n_records) values (?, ?, ?)', (site, batch_id, len(records)))
+            except sqlite3.IntegrityError:
+                self.n_repeated += 1
+                return False
+            self._db.executemany(
+                'insert into ticks (site, system, time, balanza, weight, stdev, watered, n_filtered, goal, threshold, n_unsuccessful, hum, temp, read) '
+                'values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+        self.n_batches += 1
+        return True
+
+    def query(self, sql: str, params: tuple=()) -> list:
+        with self._db_lock:
+            return self._db.execute(sql, params).fetchall()
+
+    def _make_server(self) -> socketserver.ThreadingTCPServer:
+        aggregator = self
+
+        class Handler(socketserver.BaseRequestHandler):
+            def setup(self) -> None:
+                aggregator._connections.add(self.request)
+
+            def finish(self) -> None:
+                aggregator._connections.discard(self.request)
+
+            def handle(self) -> None:
+                sock = self.request
+                if aggregator.allow is not None and self.client_address[0] not in aggregator.allow:
+                    lh.warning(f'Aggregator: Conexion rechazada de {self.client_address[0]}')
+                    return
+                while True:
+                    header = recv_exactly(sock, _frame_header.size)
+                    if header is None:
+                        return
+                    magic, batch_id, site_len, payload_len = _frame_header.unpack(header)
+                    if magic != MAGIC or payload_len > MAX_PAYLOAD:
+                        lh.warning(f'Aggregator: Trama invalida de {self.client_address[0]}')
+                        return
+                    site = recv_exactly(sock, site_len)
+                    payload = recv_exactly(sock, payload_len)
+                    if site is None or payload is None:
+                        return
+                    site = site.decode('utf-8')
+                    try:
+                        records = decode_records(payload)
+                        if aggregator.store(site, batch_id, records):
+                            lh.debug(f'Aggregator: Lote {batch_id} de {site} con {len(records)} registros')
+                    except sqlite3.Error as err:
+                        # not acknowledged, the client keeps it in its spool and sends it again
+                        lh.error(f'Aggregator: No se pudo guardar el lote {batch_id} de {site} ({err})')
+                        return
+                    except Exception as err:
+                        # the batch itself is bad, sending it again wouldn't help
+                        aggregator.n_rejected += 1
+                        lh.error(f'Aggregator: Lote {batch_id} de {site} invalido, se rechaza ({err})')
+                        sock.sendall(_ack.pack(REJECT_MAGIC, batch_id))
+                        continue
+                    sock.sendall(_ack.pack(ACK_MAGIC, batch_id))
+
+        socketserver.ThreadingTCPServer.allow_reuse_address = True
+        server = socketserver.ThreadingTCPServer((self.host, self.port), Handler)
+        server.daemon_threads = True
+        self.port = server.server_address[1]
+        return server
+
+    def serve_forever(self) -> None:
+        self.server = self._make_server()
+        lh.info(f'Aggregator: Escuchando en {self.host}:{self.port}, guardando en {self.db_file}')
+        self.server.serve_forever()
+
+    def start(self) -> None:
+        ''' serves from a background thread (for a local stand-in aggregator in tests) '''
+        self.server = self._make_server()
+        self._thread = threading.Thread(target=self.server.serve_forever, name='aggregator', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        ''' stops listening and closes the connections of the clients '''
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+        for sock in list(self._connections):
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def close(self) -> None:
+        self.stop()
+        with self._db_lock:
+            self._db.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('db_file', nargs='?', default='aggregated.sqlite')
+    parser.add_argument('--port', type=int, default=7700)
+    parser.add_argument('--bind', default='127.0.0.1', help='address to listen on (localhost by default)')
+    parser.add_argument('--allow', default=None, help='comma separated addresses of the clients that can connect')
+    args = parser.parse_args(sys.argv[1:])
+    allow = None if args.allow is None else [a.strip() for a in args.allow.split(',') if a.strip()]
+    if args.bind not in ('127.0.0.1', 'localhost', '::1') and allow is None:
+        lh.warning(f'Aggregator: Escuchando en {args.bind} sin --allow, cualquiera en la red puede enviar datos')
+    Aggregator(args.db_file, args.bind, args.port, allow).serve_forever()
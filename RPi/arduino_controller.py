@@ -1,13 +1,20 @@
-from gpiozero import DigitalOutputDevice as Pin
 from time import sleep
 
-reset_arduino_pin = Pin(18, active_high=False, initial_value=False)
+# the pins (and gpiozero) are only created the first time a reset is needed
+_reset_arduino_pins = dict()
 
-def arduino_reset():
+def _get_reset_pin(pin: int):
+    if pin not in _reset_arduino_pins:
+        from gpiozero import DigitalOutputDevice as Pin
+        _reset_arduino_pins[pin] = Pin(pin, active_high=False, initial_value=False)
+    return _reset_arduino_pins[pin]
+
+def arduino_reset(pin: int=18):
+    reset_arduino_pin = _get_reset_pin(pin)
     reset_arduino_pin.off()
     sleep(1)
     reset_arduino_pin.on()
     sleep(5)
 
 if __name__ == '__main__':
-    arduino_reset()
\ No newline at end of file
+    arduino_reset()
@@ -1,31 +1,58 @@
 from serial_manager import SerialManager
-from typing import List, Optional, Tuple, Union
+from halt_control import HaltControl
+from typing import TYPE_CHECKING, List, Optional, Sequence, Tuple, Union
+import logging
 from logging_helper import logger as lh
-from smart_arrays import UncertaintiesArray, SmartArray
-from smart_arrays import uncertainties_array as ua
+from logging_helper import fields, is_enabled_for
+from smart_arrays import SmartArray, SmartMatrix, fused
 from smart_arrays import smart_array as sa
-from statistics import mean, stdev
+from bisect import bisect_left, bisect_right
+from calibration import CalibrationPoint, CalibrationFit, samples_needed
+from calibration import fit as calibration_fit
+from drift_model import DriftModel
+if TYPE_CHECKING:
+    # uncertainties is only imported when the first UncertaintiesArray is built
+    from smart_arrays import UncertaintiesArray
+from time import monotonic
 import json
+import math
 import os
-try:
-    from tqdm import trange
-    # trange = lambda n: trange(n, leave=False)
-except ImportError:
-    trange = range
+
+
+def trange(n: int):
+    # tqdm is only imported the first time a progress bar is needed
+    try:
+        from tqdm import trange as tqdm_trange
+    except ImportError:
+        return range(n)
+    return tqdm_trange(n)
+
+# lower and upper outlier bounds of the IQR method, in one pass each
+_iqr_bounds = fused(lambda q1, q3: (q1 - 1.5 * (q3 - q1), q3 + 1.5 * (q3 - q1)))
 
 
 class Balanzas:
-    def __init__(self, serial_manager: SerialManager, n_balanzas: int, n_statistics: int=100, n_arduino: int=10, err_threshold: int=5, save_file: str='balanzas.json') -> None:
+    def __init__(self, serial_manager: SerialManager, n_balanzas: int, n_statistics: int=100, n_arduino: int=10, err_threshold: int=5, save_file: str='balanzas.json', halt_control: Optional[HaltControl]=None) -> None:
         self.sm = serial_manager
+        # if not None, acquisitions raise HaltedError between samples when the system is halted
+        self.halt_control = halt_control
         self.n_statistics = n_statistics
         self.n_arduino = n_arduino
         self.err_threshold = err_threshold
         self.n_balanzas = n_balanzas
         self.save_file = save_file
+        # an acquisition is aborted after this many failed reads in a row (the link is probably dead)
+        self.max_consecutive_errors = 5
 
         # calibration
-        self.offsets: Optional[UncertaintiesArray] = None
-        self.slopes: Optional[UncertaintiesArray] = None
+        self.offsets: Optional['UncertaintiesArray'] = None
+        self.slopes: Optional['UncertaintiesArray'] = None
+        # [[var_offset, cov], [cov, var_slope]] of each balanza, if calibrated with calibrate_points
+        self.covariances: Optional[List[List[List[float]]]] = None
+        # if not None, the temperature drift of the offsets is subtracted in read_stats (see drift_model.py)
+        self.drift: Optional[DriftModel] = None
+        # last calibrated reading in raw units, for update_drift: [read, means, variances of the means, temp]
+        self._last_raw: Optional[Tuple[Optional[SmartArray], SmartArray, SmartArray, Optional[float]]] = None
 
         self.load()
 
@@ -44,9 +71,19 @@ class Balanzas:
 
                 print(offsets, slopes, offsets_error, slopes_error)
 
+                covariances = obj.get('covariances')
+
                 if len(offsets) == len(slopes) == len(offsets_error) == len(slopes_error) == self.n_balanzas:
-                    self.offsets = UncertaintiesArray(offsets, offsets_error)
-                    self.slopes = UncertaintiesArray(slopes, slopes_error)
+                    if covariances is not None and len(covariances) == self.n_balanzas:
+                        # the offset and slope of each balanza are correlated
+                        from calibration import correlated_offsets_slopes
+                        self.offsets, self.slopes = correlated_offsets_slopes(offsets, slopes, covariances)
+                        self.covariances = covariances
+                    else:
+                        from smart_arrays import UncertaintiesArray
+                        self.offsets = UncertaintiesArray(offsets, offsets_error)
+                        self.slopes = UncertaintiesArray(slopes, slopes_error)
+                        self.covariances = None
                     res = True
                     lh.info('Balanzas: Se cargo la calibracion guardada')
                 else:
@@ -67,6 +104,8 @@ class Balanzas:
             'offsets_error': list(self.offsets.errors()),
             'slopes_error': list(self.slopes.errors())
         }
+        if self.covariances is not None:
+            obj['covariances'] = self.covariances
         try:
             with open(self.save_file, 'w') as f:
                 json.dump(obj, f)
@@ -78,6 +117,12 @@ class Balanzas:
             lh.warning(f'Balanzas: No se pudo guardar calibracion ({err})')
             return False
     
+    def _link_lost(self, consecutive_errors: int) -> bool:
+        if not self.sm.is_open() or consecutive_errors >= self.max_consecutive_errors:
+            lh.error(f'Balanzas: Se aborto la lectura despues de {consecutive_errors} errores seguidos')
+            return True
+        return False
+
     def read_single_raw(self) -> Optional[SmartArray]:
         res = self.sm.cmd_hx(self.n_arduino)
         if res is None:
@@ -95,14 +140,24 @@ class Balanzas:
         err_threshold = self.err_threshold if err_threshold is None else err_threshold
         # si err_threshold <= 0, no se considera, y se toman todos los valores
 
-        vals: List[SmartArray] = list() # [n, self.n_balanzas]
+        vals = SmartMatrix(self.n_balanzas, max(n, 1), float) # [n, self.n_balanzas]
+        consecutive_errors = 0
         for _ in trange(n):
+            if self.halt_control is not None:
+                self.halt_control.check()
             r = self.read_single_raw() # [self.n_balanzas]
             if r:
-                vals.append(r)
-        n_completed = len(vals)
+                vals.append_row(r)
+                consecutive_errors = 0
+            else:
+                consecutive_errors += 1
+                if self._link_lost(consecutive_errors):
+                    return None
+        n_completed = vals.n_rows
+        if n_completed < 2:
+            lh.error(f'Balanzas: Solo se completaron {n_completed} lecturas de {n}')
+            return None
         n_error = n-n_completed
-        vals_t: List[SmartArray] = list(zip(*vals)) # [self.n_balanzas, n]
 
         # old method of filtering if data is more than err_threshold away from mean
         # means = list(mean(vals_balanza) for vals_balanza in vals_t) #np.mean(vals, axis=0) # should be of size self.n_balanzas
@@ -120,40 +175,159 @@ class Balanzas:
         #     return None
 
         # new method of filtering by quartiles
-        sorted_vals: Tuple[List[float]] = tuple(sorted(v) for v in vals_t)
+        sorted_vals: Tuple[List[float]] = tuple(sorted(column) for column in vals.columns()) # [self.n_balanzas, n]
 
         # Calculate quartiles
         q1 = SmartArray(tuple(sorted_val[len(sorted_val) // 4] for sorted_val in sorted_vals))
         q3 = SmartArray(tuple(sorted_val[(3 * len(sorted_val)) // 4] for sorted_val in sorted_vals))
 
-        # Interquartile range (IQR)
-        iqr = q3 - q1
-
-        # Define the lower and upper bounds
-        lower_bounds = q1 - (1.5 * iqr)
-        upper_bounds = q3 + (1.5 * iqr)
+        # Define the lower and upper bounds from the interquartile range (IQR), each in a single pass
+        lower_bounds, upper_bounds = _iqr_bounds(q1, q3)
 
-        # Filter the data based on the bounds
-        filtered_vals: List[List[float]] = [[x for x in sorted_val if lower <= x <= upper] for sorted_val, lower, upper in zip(sorted_vals, lower_bounds, upper_bounds)]
+        # Filter the data based on the bounds. The values are sorted, so the ones kept are a contiguous run
+        filtered_vals: List[SmartArray] = [SmartArray(sorted_val[bisect_left(sorted_val, lower):bisect_right(sorted_val, upper)], float) for sorted_val, lower, upper in zip(sorted_vals, lower_bounds, upper_bounds)]
 
-        cleaned_means = SmartArray([mean(fv) for fv in filtered_vals]) # [self.n_balanzas]
-        cleaned_stdevs = SmartArray([stdev(fv) for fv in filtered_vals]) # [self.n_balanzas]
-        filtered_vals = SmartArray([n_completed-len(fv) for fv in filtered_vals])  # [self.n_balanzas]
+        cleaned_means = SmartArray([fv.mean() for fv in filtered_vals], float) # [self.n_balanzas]
+        cleaned_stdevs = SmartArray([fv.std(ddof=1) for fv in filtered_vals], float) # [self.n_balanzas]
+        filtered_vals = SmartArray([n_completed-len(fv) for fv in filtered_vals], int)  # [self.n_balanzas]
 
-        lh.debug(f'Balanza: Se leyo las balanzas y hubo {n_error} veces que no se pudo leer del Arduino y {filtered_vals} valores que se descartaron por estadistica')
+        lh.debug('Balanza: Se leyo las balanzas y hubo %s veces que no se pudo leer del Arduino y %s valores que se descartaron por estadistica', n_error, filtered_vals)
 
         return cleaned_means, cleaned_stdevs, filtered_vals, n_error
     
-    def read_stats(self, n: Optional[int]=None, err_threshold: Optional[float]=None) -> Optional[Tuple[UncertaintiesArray, SmartArray, float]]: # [mean, stdev, n_stats_filtered_vals, n_unsuccessful_reads]
+    def read_single_raw_index(self, index: int) -> Optional[float]:
+        res = self.sm.cmd_hx_single(index, self.n_arduino)
+        if res is None:
+            lh.warning(f'Balanzas: No se pudo leer de la balanza {index}')
+            return None
+        if not isinstance(res, (int, float)):
+            lh.error(f'Balanzas: El tipo de dato de la balanza {index} no es el correcto ({res})')
+            return None
+        return float(res)
+
+    @staticmethod
+    def _filter_quartiles(vals: Sequence[float]) -> SmartArray:
+        # same filtering by quartiles as in read_stats_raw, for a single balanza
+        sorted_vals = sorted(vals)
+        q1 = sorted_vals[len(sorted_vals) // 4]
+        q3 = sorted_vals[(3 * len(sorted_vals)) // 4]
+        iqr = q3 - q1
+        lower, upper = q1 - (1.5 * iqr), q3 + (1.5 * iqr)
+        return SmartArray(sorted_vals[bisect_left(sorted_vals, lower):bisect_right(sorted_vals, upper)], float)
+
+    def read_stats_raw_partial(self, samples: Sequence[int]) -> Optional[Tuple[SmartArray, SmartArray, SmartArray, SmartArray, float]]: # [read, mean, stdev, n_stats_filtered_vals, n_unsuccessful_reads]
+        '''
+            reads each balanza on its own (hx_single) samples[i] times (at least 2), so the
+            sampling budget can be spent on the balanzas that need it. Balanzas with 0 samples
+            are not read. read is the mask of the balanzas that were read. mean and stdev are
+            nan and n_stats_filtered_vals is 0 for the balanzas that were not read.
+            Returns None if a balanza that had to be read couldn't be read
+        '''
+        if len(samples) != self.n_balanzas:
+            raise IndexError(f'samples should be of length {self.n_balanzas}')
+        read = sa.zeros(self.n_balanzas, bool)
+        means = sa.filled(self.n_balanzas, float('nan'), float)
+        stdevs = sa.filled(self.n_balanzas, float('nan'), float)
+        filtered = sa.zeros(self.n_balanzas, int)
+        n_error = 0
+        for i, n in enumerate(samples):
+            if n <= 0:
+                continue
+            n = max(n, 2)
+            vals = list()
+            consecutive_errors = 0
+            for _ in range(n):
+                if self.halt_control is not None:
+                    self.halt_control.check()
+                r = self.read_single_raw_index(i)
+                if r is None:
+                    n_error += 1
+                    consecutive_errors += 1
+                    if self._link_lost(consecutive_errors):
+                        return None
+                else:
+                    vals.append(r)
+                    consecutive_errors = 0
+            if len(vals) < 2:
+                lh.warning(f'Balanzas: No se pudo leer la balanza {i} ({len(vals)} lecturas de {n})')
+                return None
+            filtered_vals = Balanzas._filter_quartiles(vals)
+            read[i] = True
+            means[i] = filtered_vals.mean()
+            stdevs[i] = filtered_vals.std(ddof=1)
+            filtered[i] = len(vals) - len(filtered_vals)
+
+        lh.debug('Balanza: Se leyo %s con %s muestras y hubo %s veces que no se pudo leer del Arduino y %s valores que se descartaron por estadistica', read, samples, n_error, filtered)
+        return read, means, stdevs, filtered, n_error
+
+    def _subtract_drift(self, values: 'UncertaintiesArray', read: Optional[SmartArray], means: SmartArray, stdevs: SmartArray, n_kept: SmartArray, temp: Optional[float]) -> None:
+        '''
+            subtracts the drift of the offsets at temp from values (offsets already subtracted,
+            not yet divided by the slopes) and keeps the raw reading for update_drift
+        '''
+        n_kept = sa.where(n_kept > 0, n_kept, 1)
+        self._last_raw = (read, means, stdevs * stdevs / n_kept.float(), temp)
+        if self.drift is not None and temp is not None and not math.isnan(temp):
+            values -= self.drift.corrections(temp, self.slopes.values())
+
+    def update_drift(self, empty: Sequence[bool], stable: Sequence[bool], expected_changes: Optional[SmartArray]=None, time_s: Optional[float]=None) -> int:
+        '''
+            feeds the last reading of read_stats or read_stats_partial to the drift model.
+            empty and stable are masks over the balanzas (see DriftModel.update) and
+            expected_changes is how much the weight of each balanza should have changed since
+            the previous reading, in grams. time_s is the monotonic time of the reading (now
+            by default). Returns the number of observations used
+        '''
+        if self.drift is None or self._last_raw is None:
+            return 0
+        read, means, mean_vars, temp = self._last_raw
+        self._last_raw = None
+        if temp is None:
+            return 0
+        slopes = self.slopes.values()
+        if read is not None:
+            # the balanzas that were not read break their chain of stable readings
+            means = sa.where(read, means, float('nan'))
+        if expected_changes is not None:
+            expected_changes = expected_changes * slopes
+        time_s = monotonic() if time_s is None else time_s
+        return self.drift.update(time_s, means, mean_vars, temp, self.offsets.values(), empty, stable, expected_changes)
+
+    def read_stats_partial(self, samples: Sequence[int], temp: Optional[float]=None) -> Optional[Tuple[SmartArray, 'UncertaintiesArray', SmartArray, float]]: # [read, values, n_stats_filtered_vals, n_unsuccessful_reads]
+        '''
+            calibrated version of read_stats_raw_partial. values are only meaningful where read is True.
+            temp is the temperature of the reading, for the drift model
+        '''
+        if any(a is None for a in (self.offsets, self.slopes)):
+            raise Exception('Balanzas have not been calibrated')
+        res = self.read_stats_raw_partial(samples)
+        if res is None:
+            return None
+        read, means, stdevs, filtered_vals, unsuccessful_reads = res
+        from smart_arrays import UncertaintiesArray
+        values = UncertaintiesArray(means, stdevs)
+        values -= self.offsets
+        n_kept = SmartArray([max(n, 2) if r else 0 for n, r in zip(samples, read)], int) - filtered_vals
+        self._subtract_drift(values, read, means, stdevs, n_kept, temp)
+        values /= self.slopes
+        return read, values, filtered_vals, unsuccessful_reads
+
+    def read_stats(self, n: Optional[int]=None, err_threshold: Optional[float]=None, temp: Optional[float]=None) -> Optional[Tuple['UncertaintiesArray', SmartArray, float]]: # [mean, stdev, n_stats_filtered_vals, n_unsuccessful_reads]
+        ''' temp is the temperature of the reading, for the drift model '''
         if any(a is None for a in (self.offsets, self.slopes)):
             raise Exception('Balanzas have not been calibrated')
+        n = self.n_statistics if n is None else n
         res = self.read_stats_raw(n, err_threshold)
         if res is None:
             return None
         means, stdevs, filtered_vals, unsuccessful_reads = res
 
-        values_raw = UncertaintiesArray(means, stdevs)
-        values = (values_raw - self.offsets) / self.slopes
+        # calibrated in place, values_raw is not needed afterwards
+        from smart_arrays import UncertaintiesArray
+        values = UncertaintiesArray(means, stdevs)
+        values -= self.offsets
+        self._subtract_drift(values, None, means, stdevs, (n - unsuccessful_reads) - filtered_vals, temp)
+        values /= self.slopes
 
         # means_no_slope = means - self.offsets
         # stdevs_no_slope = sa.sqrt( stdevs**2 + self.offsets_error**2 )
@@ -161,7 +335,8 @@ class Balanzas:
         # means_real = means_no_slope / self.slopes
         # stdevs_real = abs(means_real) * sa.sqrt( (stdevs_no_slope/means_no_slope)**2 + (self.slopes_error/self.slopes)**2 )
 
-        lh.debug(f'Balanza: read_stats -> {values.values()}, {values.errors()}, {filtered_vals}, {unsuccessful_reads}')
+        if is_enabled_for(logging.DEBUG):
+            lh.debug(fields('Balanza: read_stats', values=values.values(), errors=values.errors(), filtered=filtered_vals, unsuccessful=unsuccessful_reads))
         return values, filtered_vals, unsuccessful_reads
     
     def calibrate_offset(self, n: Optional[int]=None, err_threshold: Optional[float]=None, err_lim: float=1) -> bool:
@@ -174,15 +349,17 @@ class Balanzas:
             return False
 
         mean, err, _, _ = res
-        if any(e > err_lim for e in err):
+        if (err > err_lim).any():
             lh.error(f'Balanzas: Couldn\'t calibrate offset since there were errors greater than the limit {err_lim}. The errors are {err}')
             return False
 
+        from smart_arrays import UncertaintiesArray
         val = UncertaintiesArray(mean, err)
         self.offsets = val
+        self.covariances = None
         return True
     
-    def calibrate_slope(self, weights: UncertaintiesArray, n: Optional[int]=None, err_threshold: Optional[float]=None, err_lim: float=1) -> bool:
+    def calibrate_slope(self, weights: 'UncertaintiesArray', n: Optional[int]=None, err_threshold: Optional[float]=None, err_lim: float=1) -> bool:
         n = self.n_statistics*2 if n is None else n
         err_threshold = self.err_threshold if err_threshold is None else err_threshold
 
@@ -193,6 +370,7 @@ class Balanzas:
             lh.error(f'Balanzas: Couldn\'t calibrate slope since the provided weight list is not of size {self.n_balanzas}. The provided weight list is {weights}')
             return False
         
+        from smart_arrays import UncertaintiesArray
         if not isinstance(weights, UncertaintiesArray):
             raise TypeError('weights no es una instancia de UncertaintiesArray')
 
@@ -213,13 +391,74 @@ class Balanzas:
 
         slope = (val - self.offsets) / weights
 
-        if any(e > err_lim for e in slope.errors()):
+        if (slope.errors() > err_lim).any():
             lh.error(f'Balanzas: Couldn\'t calibrate slope since there were errors greater than the limit {err_lim}. The errors are {slope.errors()}')
             return False
 
         self.slopes = slope
+        self.covariances = None
         return True
+
+    def read_calibration_point(self, loads: 'UncertaintiesArray', n: Optional[int]=None, err_threshold: Optional[float]=None) -> Optional[CalibrationPoint]:
+        ''' reads the balanzas n times with the known loads (in grams) on them '''
+        if len(loads) != self.n_balanzas:
+            raise IndexError(f'loads should be of length {self.n_balanzas}')
+        n = self.n_statistics*2 if n is None else n
+        res = self.read_stats_raw(n, err_threshold)
+        if res is None:
+            lh.error('Balanzas: No se pudo leer el punto de calibracion porque read_stats_raw() devolvio None')
+            return None
+        means, stdevs, filtered, n_error = res
+        return CalibrationPoint(
+            loads=loads.values(),
+            load_errors=loads.errors(),
+            means=means,
+            stdevs=stdevs,
+            n=(n - n_error) - filtered
+        )
+
+    def calibrate_points(self, points: Sequence[CalibrationPoint], err_lim: float=1) -> Optional[CalibrationFit]:
+        '''
+            fits offset and slope of each balanza from several calibration points (the tare
+            can be one of them, with loads of 0) by weighted least squares, keeping the
+            covariance between them. Returns None if the fit fails or the error of some
+            slope is over err_lim
+        '''
+        try:
+            res = calibration_fit(points)
+        except (ValueError, ZeroDivisionError) as err:
+            lh.error(f'Balanzas: No se pudo ajustar la calibracion ({err})')
+            return None
+        slope_errors = sa.sqrt(res.var_slopes)
+        if (slope_errors > err_lim).any():
+            lh.error(f'Balanzas: Couldn\'t calibrate since there were slope errors greater than the limit {err_lim}. The errors are {slope_errors}')
+            return None
+        self.offsets, self.slopes = res.correlated()
+        self.covariances = res.covariances()
+        lh.info(f'Balanzas: Calibracion con {res.n_points} puntos. Pendientes {self.slopes}, chi2 reducido {res.chi2_red}')
+        return res
         
+def _input_weights(n_balanzas: int, allow_empty: bool=False) -> Optional['UncertaintiesArray']:
+    ''' asks for a known weight on each balanza. Returns None on an empty answer if allow_empty '''
+    while True:
+        res = input('Introduci un peso conocido en cada balanza. Esribi los pesos y su error en el siguiente formato: (<numero>,<numero>,...)-<numero error>: ')
+        if allow_empty and res.strip() == '':
+            return None
+        try:
+            res = res.replace('(', '').replace(')', '').replace(' ', '')
+            weights_str, err_str = res.split('-')
+            err_nr = float(err_str)
+            weights_errs = [err_nr]*n_balanzas
+            weights_str = weights_str.split(',')
+            weights = [float(e) for e in weights_str]
+            from smart_arrays import UncertaintiesArray
+            weights = UncertaintiesArray(weights, weights_errs)
+            if len(weights) == n_balanzas:
+                return weights
+            print(f'La cantidad de pesos introducidos fue de {len(weights)}, cuando deberia haber sido {n_balanzas}. Intenta de nuevo')
+        except:
+            print('No se pudieron convertir los valores introducidos como numeros. Intenta de nuevo')
+
 def calibrate(balanzas: Balanzas, n_balanzas: int, n: int=100, offset_temp_file: str='.tmp_balanzas_offset.json'):
     if not os.path.isfile(offset_temp_file):
         input('Remove todo el peso de las balanzas y apreta enter')
@@ -240,29 +479,14 @@ def calibrate(balanzas: Balanzas, n_balanzas: int, n: int=100, offset_temp_file:
             d = json.load(f)
             offsets = d['tare_vals']
             offsets_errs = d['tare_errs']
+            from smart_arrays import UncertaintiesArray
             offsets = UncertaintiesArray(offsets, offsets_errs)
             if not len(offsets) == balanzas.n_balanzas:
                 raise ValueError()
             balanzas.offsets = offsets
         print('Continuando con una calibracion previa')
     print(balanzas.offsets)
-    res_b = False
-    while not res_b:
-        res = input('Introduci un peso conocido en cada balanza. Esribi los pesos y su error en el siguiente formato: (<numero>,<numero>,...)-<numero error>: ')
-        try:
-            res = res.replace('(', '').replace(')', '').replace(' ', '')
-            weights_str, err_str = res.split('-')
-            err_nr = float(err_str)
-            weights_errs = [err_nr]*n_balanzas
-            weights_str = weights_str.split(',')
-            weights = [float(e) for e in weights_str]
-            weights = UncertaintiesArray(weights, weights_errs)
-            if len(weights) == n_balanzas:
-                res_b = True
-            else:
-                print(f'La cantidad de pesos introducidos fue de {len(weights)}, cuando deberia haber sido {n_balanzas}. Intenta de nuevo')
-        except:
-            print('No se pudieron convertir los valores introducidos como numeros. Intenta de nuevo')
+    weights = _input_weights(n_balanzas)
     print('Calibrando...')
     balanzas.calibrate_slope(weights, n, err_threshold=1000, err_lim=1000)
     
@@ -274,6 +498,62 @@ def calibrate(balanzas: Balanzas, n_balanzas: int, n: int=100, offset_temp_file:
 
     os.remove(offset_temp_file)
 
+def calibrate_multipoint(balanzas: Balanzas, n_balanzas: int, n: int=100, target_error: float=.5, min_samples: int=20) -> bool:
+    '''
+        interactive calibration with several known loads on each balanza, fitted with
+        calibrate_points. The first point is the tare, read with n samples. Its stdevs are the
+        noise of the balanzas, from which the samples of each next point are chosen (between
+        min_samples and n) so that the calibration contributes at most target_error grams to
+        the largest load. An empty answer ends the calibration
+    '''
+    input('Remove todo el peso de las balanzas y apreta enter')
+    print('Tarando...')
+    from smart_arrays import UncertaintiesArray
+    no_load = UncertaintiesArray(sa.zeros(n_balanzas, float), sa.zeros(n_balanzas, float))
+    tare = balanzas.read_calibration_point(no_load, n, err_threshold=10000)
+    if tare is None:
+        print('No se pudo tarar')
+        return False
+    points = [tare]
+    slopes = balanzas.slopes.values() if balanzas.slopes is not None else None
+    while True:
+        weights = _input_weights(n_balanzas, allow_empty=len(points) >= 2 and slopes is not None)
+        if weights is None:
+            break
+        n_point = n
+        if slopes is not None:
+            try:
+                needed = samples_needed(tare.stdevs, slopes, [p.loads for p in points] + [weights.values()], target_error)
+                n_point = min(max(needed.max(), min_samples), n)
+                print(f'Se necesitan {needed} muestras por punto para un error de {target_error} g. Se toman {n_point}')
+            except ValueError as err:
+                lh.warning(f'Balanzas: No se pudo estimar la cantidad de muestras ({err})')
+        print('Midiendo...')
+        point = balanzas.read_calibration_point(weights, n_point, err_threshold=10000)
+        if point is None:
+            print('No se pudo medir el punto. Intenta de nuevo')
+            continue
+        points.append(point)
+        # the slopes of the points read so far give a better estimate for the next ones
+        try:
+            res = calibration_fit(points)
+        except ValueError as err:
+            print(f'Todavia no se puede ajustar ({err})')
+            continue
+        slopes = res.slopes
+        print(f'{len(points)} puntos: pendientes {res.correlated()[1]}, chi2 reducido {res.chi2_red}')
+
+    print('Calibrando...')
+    if balanzas.calibrate_points(points, err_lim=1000) is None:
+        print('No se pudo calibrar')
+        return False
+    if balanzas.save():
+        print('Listo!')
+        return True
+    print('No se pudo guardar el resultado de la calibracion. El resultado es:')
+    print('Offsets: ', balanzas.offsets, 'Slopes', balanzas.slopes, 'Covarianzas', balanzas.covariances)
+    return False
+
 if __name__ == '__main__':
     from time import sleep
 
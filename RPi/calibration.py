@@ -0,0 +1,174 @@
+from __future__ import annotations
+import math
+import dataclasses
+from typing import List, Optional, Sequence, Tuple
+from smart_arrays import SmartArray
+import smart_arrays.smart_array as sa
+
+
+@dataclasses.dataclass
+class CalibrationPoint:
+    '''
+        One known load on every balanza and the raw readings taken with it.
+        loads and load_errors are in grams, means and stdevs are the raw mean and the
+        stdev of the individual samples, n is the number of samples kept for each balanza
+    '''
+    loads: SmartArray
+    load_errors: SmartArray
+    means: SmartArray
+    stdevs: SmartArray
+    n: SmartArray
+
+    @property
+    def mean_errors(self) -> SmartArray:
+        ''' standard error of the raw means '''
+        return self.stdevs / sa.sqrt(self.n.float())
+
+
+@dataclasses.dataclass
+class CalibrationFit:
+    '''
+        Result of the weighted least squares fit raw = offset + slope * load of each balanza.
+        cov_offsets_slopes is the covariance between the offset and the slope of each balanza.
+        chi2_red is nan with only 2 points (the line goes through both)
+    '''
+    offsets: SmartArray
+    slopes: SmartArray
+    var_offsets: SmartArray
+    var_slopes: SmartArray
+    cov_offsets_slopes: SmartArray
+    chi2_red: SmartArray
+    n_points: int
+
+    def covariances(self) -> List[List[List[float]]]:
+        ''' [[var_offset, cov], [cov, var_slope]] of each balanza '''
+        return [[[vo, c], [c, vs]] for vo, vs, c in zip(self.var_offsets, self.var_slopes, self.cov_offsets_slopes)]
+
+    def correlated(self) -> Tuple['UncertaintiesArray', 'UncertaintiesArray']:
+        ''' offsets and slopes as ufloats that keep the covariance of the fit '''
+        return correlated_offsets_slopes(self.offsets, self.slopes, self.covariances())
+
+
+def correlated_offsets_slopes(offsets: Sequence[float], slopes: Sequence[float], covariances: Sequence[Sequence[Sequence[float]]]) -> Tuple['UncertaintiesArray', 'UncertaintiesArray']:
+    '''
+        builds the offset and slope of each balanza as ufloats with the given 2x2 covariance,
+        so that (raw - offset) / slope propagates the correlation between them. The pair is
+        the Cholesky factor of the covariance applied to two independent unit ufloats, which
+        doesn't need numpy (uncertainties.correlated_values does)
+    '''
+    from uncertainties import ufloat
+    from smart_arrays import UncertaintiesArray
+    res_offsets, res_slopes = list(), list()
+    for o, s, ((vo, c), (_, vs)) in zip(offsets, slopes, covariances):
+        u1, u2 = ufloat(0, 1), ufloat(0, 1)
+        so = math.sqrt(max(vo, 0))
+        c_factor = c / so if so > 0 else 0.
+        rest = math.sqrt(max(vs - c_factor**2, 0))
+        res_offsets.append(o + so * u1)
+        res_slopes.append(s + c_factor * u1 + rest * u2)
+    return UncertaintiesArray(res_offsets), UncertaintiesArray(res_slopes)
+
+
+def fit(points: Sequence[CalibrationPoint], iterations: int=2) -> CalibrationFit:
+    '''
+        weighted least squares fit of raw = offset + slope * load, for all the balanzas at
+        once (every sum is a SmartArray over the balanzas). The weight of each point is
+        1 / (mean_error^2 + slope^2 * load_error^2) (effective variance), so the slope of the
+        previous iteration is used to account for the uncertainty of the loads
+    '''
+    if len(points) < 2:
+        raise ValueError('at least 2 points are needed')
+    n_balanzas = len(points[0].loads)
+    if any(len(p.loads) != n_balanzas or len(p.means) != n_balanzas for p in points):
+        raise IndexError('all the points should have one value per balanza')
+
+    mean_vars = [p.mean_errors * p.mean_errors for p in points]
+    load_vars = [p.load_errors * p.load_errors for p in points]
+    slopes = sa.zeros(n_balanzas, float)
+    for _ in range(max(iterations, 1)):
+        s2 = slopes * slopes
+        weights = [1 / (mv + s2 * lv) for mv, lv in zip(mean_vars, load_vars)]
+        S = sa.zeros(n_balanzas, float)
+        Sx = sa.zeros(n_balanzas, float)
+        Sy = sa.zeros(n_balanzas, float)
+        Sxx = sa.zeros(n_balanzas, float)
+        Sxy = sa.zeros(n_balanzas, float)
+        for w, p in zip(weights, points):
+            wx = w * p.loads
+            S += w
+            Sx += wx
+            Sy += w * p.means
+            Sxx += wx * p.loads
+            Sxy += wx * p.means
+        delta = S * Sxx - Sx * Sx
+        if (delta <= 0).any():
+            raise ValueError(f'the loads of some balanza are all the same ({list(delta)})')
+        offsets = (Sxx * Sy - Sx * Sxy) / delta
+        slopes = (S * Sxy - Sx * Sy) / delta
+
+    chi2 = sa.zeros(n_balanzas, float)
+    for w, p in zip(weights, points):
+        r = p.means - offsets - slopes * p.loads
+        chi2 += w * r * r
+    dof = len(points) - 2
+    chi2_red = chi2 / dof if dof > 0 else sa.filled(n_balanzas, float('nan'), float)
+    return CalibrationFit(
+        offsets=offsets,
+        slopes=slopes,
+        var_offsets=Sxx / delta,
+        var_slopes=S / delta,
+        cov_offsets_slopes=-Sx / delta,
+        chi2_red=chi2_red,
+        n_points=len(points)
+    )
+
+
+def samples_needed(noise: SmartArray, slopes: SmartArray, loads: Sequence[SmartArray], target_error: float, at_load: Optional[SmartArray]=None, min_samples: int=2) -> SmartArray:
+    '''
+        samples per point needed so that, with the same number of samples at each of the
+        loads, the calibration alone contributes at most target_error grams to a weight of
+        at_load (the largest load by default). noise is the stdev of the individual raw
+        samples of each balanza and slopes are the raw units per gram.
+        With n samples per point, the covariance of the fit is noise^2 / n times the inverse
+        of the design matrix [[K, sum(x)], [sum(x), sum(x^2)]], and the error of a weight W is
+        sqrt(var_offset + 2 W cov + W^2 var_slope) / slope. Only the reading noise is taken
+        into account, the uncertainty of the loads doesn't go down with more samples
+    '''
+    k = len(loads)
+    if k < 2:
+        raise ValueError('at least 2 loads are needed')
+    if target_error <= 0:
+        raise ValueError('target_error should be positive')
+    Sx = sa.zeros(len(noise), float)
+    Sxx = sa.zeros(len(noise), float)
+    for x in loads:
+        Sx += x
+        Sxx += x * x
+    delta = k * Sxx - Sx * Sx
+    if (delta <= 0).any():
+        raise ValueError('the loads of some balanza are all the same')
+    if at_load is None:
+        at_load = SmartArray([max(x[i] for x in loads) for i in range(len(noise))], float)
+    factor = (Sxx - 2 * at_load * Sx + k * at_load * at_load) / delta
+    n = noise * noise * factor / (slopes * slopes * target_error**2)
+    return SmartArray([max(min_samples, math.ceil(e)) for e in n], int)
+
+
+if __name__ == '__main__':
+    import random
+    true_offsets = (1000., 2000.)
+    true_slopes = (2., -1.5)
+    loads = (0., 200., 500., 1000.)
+    points = list()
+    for load in loads:
+        raw = [[o + s * load + random.gauss(0, 3) for o, s in zip(true_offsets, true_slopes)] for _ in range(50)]
+        cols = [SmartArray(c, float) for c in zip(*raw)]
+        points.append(CalibrationPoint(
+            loads=SmartArray((load,)*2, float), load_errors=SmartArray((.1,)*2, float),
+            means=SmartArray([c.mean() for c in cols], float), stdevs=SmartArray([c.std(ddof=1) for c in cols], float),
+            n=SmartArray((50,)*2, int)
+        ))
+    res = fit(points)
+    print(res)
+    print(res.correlated())
+    print(samples_needed(SmartArray((3.,)*2), res.slopes, [p.loads for p in points], target_error=.1))
@@ -0,0 +1,239 @@
+'''
+    Client that ships the tick records of the FileManagers to an aggregator (aggregator.py),
+    so the data of every pi ends up in a single store without copying csv files around.
+    The records are batched and compressed by a background thread, and every batch is
+    written to the spool directory before it is sent. It is only deleted after the
+    aggregator acknowledges it, so the batches survive offline periods and restarts and are
+    delivered at least once (the aggregator ignores a batch it already stored). A batch the
+    aggregator rejects (it can't be decoded, for example a spool file corrupted by a power
+    cut) is moved to the rejected directory of the spool, so it doesn't hold back the rest
+'''
+from __future__ import annotations
+import os
+import json
+import math
+import zlib
+import socket
+import struct
+import threading
+import dataclasses
+from collections import deque
+from time import time_ns
+from typing import Any, List, Optional
+from logging_helper import logger as lh
+
+MAGIC = b'LBNC'
+ACK_MAGIC = b'LBNA'
+REJECT_MAGIC = b'LBNR'
+# magic, batch id, length of the site name, length of the payload
+_frame_header = struct.Struct('!4sQHI')
+# ACK_MAGIC or REJECT_MAGIC, batch id
+_ack = struct.Struct('!4sQ')
+# a batch of batch_size records is a few kB, these only bound what a client can make the aggregator hold
+MAX_PAYLOAD = 4 * 1024 * 1024
+MAX_RECORDS_BYTES = 32 * 1024 * 1024
+
+
+@dataclasses.dataclass(frozen=True)
+class CollectorInfo:
+    host: str = '127.0.0.1'
+    port: int = 7700
+    site: str = socket.gethostname() # the pi, the aggregator keeps the data of each site apart
+    spool_dir: str = 'spool'
+    batch_size: int = 50 # records
+    flush_period_s: float = 60 # a batch is closed after this even if it is not full
+    timeout_s: float = 10
+    backoff_initial_s: float = 5
+    backoff_max_s: float = 300
+    max_spool_batches: int = 100000 # the oldest batches are dropped over this
+
+
+def encode_frame(site: str, batch_id: int, payload: bytes) -> bytes:
+    site_bytes = site.encode('utf-8')
+    return _frame_header.pack(MAGIC, batch_id, len(site_bytes), len(payload)) + site_bytes + payload
+
+
+def recv_exactly(sock: socket.socket, n: int) -> Optional[bytes]:
+    ''' None if the connection was closed before n bytes arrived '''
+    buf = bytearray()
+    while len(buf) < n:
+        chunk = sock.recv(n - len(buf))
+        if not chunk:
+            return None
+        buf += chunk
+    return bytes(buf)
+
+
+def encode_records(records: List[dict]) -> bytes:
+    return zlib.compress('\n'.join(json.dumps(r) for r in records).encode('utf-8'))
+
+
+def decode_records(payload: bytes, max_bytes: int=MAX_RECORDS_BYTES) -> List[dict]:
+    ''' raises ValueError if the records take more than max_bytes uncompressed '''
+    decompressor = zlib.decompressobj()
+    data = decompressor.decompress(payload, max_bytes)
+    if decompressor.unconsumed_tail:
+        raise ValueError(f'los registros ocupan mas de {max_bytes} bytes')
+    return [json.loads(line) for line in data.decode('utf-8').splitlines() if line]
+
+
+def _fsync_dir(dirname: str) -> None:
+    ''' makes the renames in dirname durable (not possible on every os) '''
+    try:
+        fd = os.open(dirname, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def _plain(v: Any) -> Any:
+    ''' json serializable copy, with None instead of nan '''
+    if isinstance(v, float):
+        return None if math.isnan(v) else v
+    if isinstance(v, (bool, int, str)) or v is None:
+        return v
+    try:
+        return [_plain(e) for e in v]
+    except TypeError:
+        return _plain(float(v))
+
+
+class CollectorClient:
+    def __init__(self, info: Optional[CollectorInfo]=None) -> None:
+        self.info = CollectorInfo() if info is None else info
+        self.n_sent = 0
+        self.n_dropped = 0
+        self.n_rejected = 0
+        self._pending: deque = deque()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._sock: Optional[socket.socket] = None
+        self._thread: Optional[threading.Thread] = None
+        self._backoff_s = self.info.backoff_initial_s
+        self._last_id = 0
+
+    @property
+    def rejected_dir(self) -> str:
+        return os.path.join(self.info.spool_dir, 'rejected')
+
+    def start(self) -> None:
+        os.makedirs(self.rejected_dir, exist_ok=True)
+        self._thread = threading.Thread(target=self._run, name='collector', daemon=True)
+        self._thread.start()
+
+    def add(self, system: str, **fields) -> None:
+        ''' queues a record of system. Never blocks, the loop calls it every tick '''
+        self._pending.append({'system': system, **{k: _plain(v) for k, v in fields.items()}})
+        if len(self._pending) >= self.info.batch_size:
+            self._wake.set()
+
+    def stop(self, timeout: Optional[float]=10) -> None:
+        ''' spools what is pending and tries to send it one last time '''
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._wake.set()
+        self._thread.join(timeout)
+        self._thread = None
+
+    def spooled(self) -> List[str]:
+        ''' spool files, oldest first '''
+        return sorted(os.path.join(self.info.spool_dir, f) for f in os.listdir(self.info.spool_dir) if f.endswith('.batch'))
+
+    def _spool_pending(self) -> None:
+        spooled_any = bool(self._pending)
+        while self._pending:
+            records = list()
+            while self._pending and len(records) < self.info.batch_size:
+                records.append(self._pending.popleft())
+            # ids are unique per site (and sort in order), so the aggregator can drop repeated batches
+            batch_id = self._last_id = max(time_ns(), self._last_id + 1)
+            fname = os.path.join(self.info.spool_dir, f'{batch_id:020d}.batch')
+            with open(fname + '.tmp', 'wb') as f:
+                f.write(encode_records(records))
+                # a power cut after the rename should not leave an empty or partial batch
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(fname + '.tmp', fname)
+        if spooled_any:
+            _fsync_dir(self.info.spool_dir)
+        spooled = self.spooled()
+        for fname in spooled[:max(len(spooled) - self.info.max_spool_batches, 0)]:
+            os.remove(fname)
+            self.n_dropped += 1
+            lh.warning(f'Collector: Spool lleno, se descarto {fname}')
+
+    def _connect(self) -> socket.socket:
+        if self._sock is None:
+            self._sock = socket.create_connection((self.info.host, self.info.port), self.info.timeout_s)
+            self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return self._sock
+
+    def _disconnect(self) -> None:
+        if self._sock is not None:
+            try:
+                self._sock.close()
+            except OSError:
+                pass
+            self._sock = None
+
+    def _reject(self, fname: str, reason: str) -> None:
+        lh.error(f'Collector: Lote {fname} rechazado ({reason}), se mueve a {self.rejected_dir}')
+        os.replace(fname, os.path.join(self.rejected_dir, os.path.basename(fname)))
+        self.n_rejected += 1
+
+    def _send_spooled(self) -> bool:
+        ''' sends the spooled batches in order. Returns False if the aggregator couldn't be reached '''
+        for fname in self.spooled():
+            batch_id = int(os.path.basename(fname).split('.')[0])
+            with open(fname, 'rb') as f:
+                payload = f.read()
+            if len(payload) > MAX_PAYLOAD:
+                self._reject(fname, f'{len(payload)} bytes, mas que {MAX_PAYLOAD}')
+                continue
+            try:
+                sock = self._connect()
+                sock.sendall(encode_frame(self.info.site, batch_id, payload))
+                res = recv_exactly(sock, _ack.size)
+                if res is None:
+                    raise ConnectionError('el agregador cerro la conexion')
+                magic, acked_id = _ack.unpack(res)
+                if magic not in (ACK_MAGIC, REJECT_MAGIC) or acked_id != batch_id:
+                    raise ConnectionError(f'confirmacion invalida ({magic}, {acked_id})')
+            except OSError as err:
+                lh.warning(f'Collector: No se pudo enviar al agregador {self.info.host}:{self.info.port} ({err}). {len(self.spooled())} lotes en espera')
+                self._disconnect()
+                return False
+            if magic == REJECT_MAGIC:
+                self._reject(fname, 'el agregador no lo pudo leer')
+                continue
+            os.remove(fname)
+            self.n_sent += 1
+        return True
+
+    def _run(self) -> None:
+        wait_s = self.info.flush_period_s
+        while True:
+            self._wake.wait(wait_s)
+            self._wake.clear()
+            stopping = self._stop.is_set()
+            try:
+                self._spool_pending()
+                ok = self._send_spooled()
+            except Exception as err:
+                lh.error(f'Collector: Error inesperado ({err})')
+                ok = False
+            if stopping:
+                break
+            if ok:
+                self._backoff_s = self.info.backoff_initial_s
+                wait_s = self.info.flush_period_s
+            else:
+                wait_s = self._backoff_s
+                self._backoff_s = min(self._backoff_s * 2, self.info.backoff_max_s)
+        self._disconnect()
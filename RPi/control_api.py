@@ -0,0 +1,155 @@
+'''
+    Local http api to look at a running SystemsManager and to send it commands, without
+    editing main.py and restarting. It is served from its own thread and only binds to
+    localhost. The commands that touch the hardware are queued with SystemsManager.submit
+    and run by the loop in between the ticks, so they never race the serial I/O of a tick.
+    Halt and resume go straight to the HaltControl, as the maintenance button does, so a halt
+    interrupts the tick in progress instead of waiting for it.
+
+        GET  /status                             weights, intensities and inhabilitated balanzas
+        GET  /status?history=1                   the same with the histories
+        GET  /systems/<i>/history
+        GET  /metrics                            scheduler tasks, pending commands, ...
+        POST /halt
+        POST /resume
+        POST /systems/<i>/water                  {"balanza": b, "intensity": 0}
+        POST /systems/<i>/balanzas/<b>/enable    re-enables an inhabilitated balanza
+        POST /systems/<i>/tare                   the balanzas should be empty
+
+    For example: curl -X POST localhost:8765/systems/0/water -d '{"balanza": 2}'
+'''
+from __future__ import annotations
+import re
+import json
+import threading
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Optional, Tuple
+from urllib.parse import urlparse, parse_qs
+from logging_helper import logger as lh
+from halt_control import HaltedError
+
+
+class ControlApi:
+    def __init__(self, manager: 'SystemsManager', host: str='127.0.0.1', port: int=8765, commands_period_s: float=1, wait_s: float=10) -> None:
+        '''
+            commands_period_s is how often the loop looks for queued commands. A command
+            request waits up to wait_s for its result, after that it is answered as queued
+            (202) and the command still runs
+        '''
+        self.manager = manager
+        self.host = host
+        self.port = port
+        self.commands_period_s = commands_period_s
+        self.wait_s = wait_s
+        self.server: Optional[ThreadingHTTPServer] = None
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        ''' should be called before manager.loop(), which runs the commands '''
+        self.manager.add_periodic_task('commands', self.commands_period_s, self.manager.run_commands, pausable=False)
+        handler = type('Handler', (_Handler,), {'api': self})
+        self.server = ThreadingHTTPServer((self.host, self.port), handler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        self._thread = threading.Thread(target=self.server.serve_forever, name='control_api', daemon=True)
+        self._thread.start()
+        lh.info(f'ControlApi: Escuchando en http://{self.host}:{self.port}')
+
+    def stop(self) -> None:
+        if self.server is None:
+            return
+        self.server.shutdown()
+        self.server.server_close()
+        self._thread.join()
+        self.server = None
+
+    def command(self, callback: Callable[[], Any]) -> Tuple[int, dict]:
+        future = self.manager.submit(callback)
+        try:
+            result = future.result(self.wait_s)
+        except FutureTimeoutError:
+            return 202, {'queued': True}
+        except HaltedError:
+            return 409, {'error': 'el sistema esta detenido'}
+        except (IndexError, ValueError, KeyError) as err:
+            return 400, {'error': str(err)}
+        except Exception as err:
+            lh.error(f'ControlApi: Fallo un comando ({err})')
+            return 500, {'error': str(err)}
+        return 200, {'ok': True, 'result': result}
+
+    def get(self, path: str, query: dict) -> Tuple[int, Any]:
+        manager = self.manager
+        if path == '/status':
+            return 200, manager.status(history=query.get('history', ['0'])[0] not in ('0', 'false'))
+        if path == '/metrics':
+            return 200, manager.metrics()
+        m = re.fullmatch(r'/systems/(\d+)/history', path)
+        if m is not None:
+            index = int(m.group(1))
+            systems = manager.status(history=True)['systems']
+            if index >= len(systems):
+                return 404, {'error': f'no existe el sistema {index}'}
+            return 200, systems[index]['history']
+        return 404, {'error': f'{path} no existe'}
+
+    def post(self, path: str, body: dict) -> Tuple[int, Any]:
+        manager = self.manager
+        if path == '/halt':
+            manager.halt(True)
+            return 200, {'ok': True}
+        if path == '/resume':
+            manager.halt(False)
+            return 200, {'ok': True}
+        m = re.fullmatch(r'/systems/(\d+)/water', path)
+        if m is not None:
+            index = int(m.group(1))
+            if 'balanza' not in body:
+                return 400, {'error': 'falta balanza'}
+            balanza, intensity = int(body['balanza']), int(body.get('intensity', 0))
+            return self.command(lambda: manager.water_now(index, balanza, intensity))
+        m = re.fullmatch(r'/systems/(\d+)/balanzas/(\d+)/enable', path)
+        if m is not None:
+            index, balanza = int(m.group(1)), int(m.group(2))
+            return self.command(lambda: manager.enable_balanza(index, balanza))
+        m = re.fullmatch(r'/systems/(\d+)/tare', path)
+        if m is not None:
+            index = int(m.group(1))
+            return self.command(lambda: manager.tare(index))
+        return 404, {'error': f'{path} no existe'}
+
+
+class _Handler(BaseHTTPRequestHandler):
+    api: ControlApi
+
+    def _send(self, code: int, obj: Any) -> None:
+        data = json.dumps(obj, default=str).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self) -> None:
+        url = urlparse(self.path)
+        self._send(*self.api.get(url.path.rstrip('/'), parse_qs(url.query)))
+
+    def do_POST(self) -> None:
+        url = urlparse(self.path)
+        length = int(self.headers.get('Content-Length') or 0)
+        try:
+            body = json.loads(self.rfile.read(length) or b'{}') if length > 0 else {}
+        except ValueError:
+            self._send(400, {'error': 'el cuerpo no es json'})
+            return
+        if not isinstance(body, dict):
+            self._send(400, {'error': 'el cuerpo deberia ser un objeto json'})
+            return
+        try:
+            self._send(*self.api.post(url.path.rstrip('/'), body))
+        except (TypeError, ValueError) as err:
+            self._send(400, {'error': str(err)})
+
+    def log_message(self, format: str, *args) -> None:
+        lh.debug(f'ControlApi: {self.address_string()} {format % args}')
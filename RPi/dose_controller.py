@@ -0,0 +1,171 @@
+from __future__ import annotations
+import os
+import math
+import json
+import dataclasses
+from typing import Iterable, List, Optional, Tuple
+from logging_helper import logger as lh
+
+
+@dataclasses.dataclass(frozen=True)
+class DoseControllerInfo:
+    '''
+        Configuration of the closed loop watering dose. The pump delivers rate grams per ms at
+        the initial pwm of the water_pwm_curve of each position, and rate is estimated online
+        from the weight before a watering and the next weighing of the pot
+    '''
+    initial_grams_per_ms: float = .01
+    initial_rate_stdev: float = .02 # g/ms
+    process_noise_rate: float = 1e-6 # (g/ms)^2 per watering, the pump and the nozzle change slowly
+    et_stdev_grams: float = 2 # uncertainty of the water lost between the weighings around a watering
+    rate_sigmas: float = 1 # the dose assumes the rate is this many stdevs over the estimate, so it rarely overshoots
+    target_offset_grams: float = 20 # the dose aims this much over the goal, so the pot is not under it again right away
+    min_time_ms: int = 300
+    max_time_ms: int = 8000 # a single visit never pumps longer, a pot that needs more is watered again next tick
+    max_age_s: float = 1800 # a watering is not used if its pot is not weighed again before this
+    gate_sigmas: float = 4
+    save_period_s: float = 600
+
+
+class PumpRateFilter:
+    '''
+        Kalman filter of the delivery rate (g/ms) of the pump at a single position. A watering
+        of t ms that changed the weight by delta grams (net of the evapotranspiration) is
+        the observation delta = rate * t
+    '''
+    __slots__ = ('info', 'rate', 'p', 'n_updates', 'n_rejected')
+
+    def __init__(self, info: DoseControllerInfo) -> None:
+        self.info = info
+        self.rate = info.initial_grams_per_ms
+        self.p = info.initial_rate_stdev**2
+        self.n_updates = 0
+        self.n_rejected = 0
+
+    @property
+    def stdev(self) -> float:
+        return math.sqrt(max(self.p, 0))
+
+    def update(self, time_ms: float, delta: float, r: float) -> bool:
+        ''' returns False if the observation was discarded by the gate '''
+        self.p += self.info.process_noise_rate
+        s = time_ms * time_ms * self.p + r
+        y = delta - self.rate * time_ms
+        if y*y > self.info.gate_sigmas**2 * s:
+            self.n_rejected += 1
+            return False
+        k = self.p * time_ms / s
+        self.rate += k * y
+        self.p -= k * time_ms * self.p
+        self.n_updates += 1
+        return True
+
+    def time_ms(self, grams: float) -> int:
+        info = self.info
+        rate = max(self.rate + info.rate_sigmas * self.stdev, 1e-9)
+        return int(min(max(grams / rate, info.min_time_ms), info.max_time_ms))
+
+
+class DoseController:
+    '''
+        Computes the pump time that takes each pot to its goal in a single visit, instead of
+        the open loop IntensityConfig ramps. dose() is asked before watering, watered() is
+        told what was pumped and update() closes the loop with the next weighing
+    '''
+    def __init__(self, n_balanzas: int, info: Optional[DoseControllerInfo]=None, save_file: Optional[str]=None) -> None:
+        self.info = DoseControllerInfo() if info is None else info
+        self.n_balanzas = n_balanzas
+        self.save_file = save_file
+        self.filters = tuple(PumpRateFilter(self.info) for _ in range(n_balanzas))
+        # [time_s, weight, variance, time_ms] of the last watering of each pot, until it is weighed again
+        self.pending: List[Optional[Tuple[float, float, float, int]]] = [None]*n_balanzas
+        if save_file is not None:
+            self.load()
+
+    def dose(self, index: int, weight: float, goal: float) -> int:
+        ''' pump time in ms to take the pot from weight to goal '''
+        return self.filters[index].time_ms(goal + self.info.target_offset_grams - weight)
+
+    def watered(self, index: int, time_s: float, weight: float, stdev: float, time_ms: int) -> None:
+        if math.isnan(weight) or math.isnan(stdev):
+            self.pending[index] = None
+            return
+        self.pending[index] = (time_s, weight, stdev * stdev, time_ms)
+
+    def update(self, time_s: float, means: Iterable[float], stdevs: Iterable[float], mask: Optional[Iterable[bool]]=None, expected_changes: Optional[Iterable[float]]=None) -> int:
+        '''
+            closes the pending waterings of the pots that were weighed (mask, all if None).
+            expected_changes is how much each pot should have changed since the previous
+            weighing without the watering (the evapotranspiration predicted by the weight
+            model, which is negative). Returns the number of observations used
+        '''
+        mask = (True,)*self.n_balanzas if mask is None else mask
+        expected_changes = (0.,)*self.n_balanzas if expected_changes is None else expected_changes
+        n = 0
+        for i, (f, m, s, weighed, change) in enumerate(zip(self.filters, means, stdevs, mask, expected_changes)):
+            pending = self.pending[i]
+            if pending is None or not weighed:
+                continue
+            self.pending[i] = None
+            start_s, weight, var, time_ms = pending
+            if time_s - start_s > self.info.max_age_s or math.isnan(m) or math.isnan(s):
+                continue
+            r = var + s * s + self.info.et_stdev_grams**2
+            n += f.update(time_ms, m - weight - change, r)
+        return n
+
+    def rates(self) -> Tuple[List[float], List[float]]:
+        ''' estimated rates and their stdevs, in g/ms '''
+        return [f.rate for f in self.filters], [f.stdev for f in self.filters]
+
+    def state(self) -> dict:
+        return {
+            'rates': [f.rate for f in self.filters],
+            'variances': [f.p for f in self.filters],
+        }
+
+    def save(self) -> bool:
+        if self.save_file is None:
+            return False
+        try:
+            tmp_file = self.save_file + '.tmp'
+            with open(tmp_file, 'w') as f:
+                json.dump(self.state(), f)
+            os.replace(tmp_file, self.save_file)
+            return True
+        except Exception as err:
+            lh.warning(f'DoseController: No se pudo guardar el caudal de las bombas ({err})')
+            return False
+
+    def load(self) -> bool:
+        if self.save_file is None or not os.path.isfile(self.save_file):
+            return False
+        try:
+            with open(self.save_file, 'r') as f:
+                obj = json.load(f)
+            if len(obj['rates']) != self.n_balanzas:
+                lh.warning('DoseController: El caudal guardado no corresponde a esta configuracion')
+                return False
+            for f, rate, p in zip(self.filters, obj['rates'], obj['variances']):
+                f.rate, f.p = rate, p
+            lh.info('DoseController: Se cargo el caudal de las bombas guardado')
+            return True
+        except Exception as err:
+            lh.warning(f'DoseController: No se pudo cargar el caudal de las bombas ({err})')
+            return False
+
+
+if __name__ == '__main__':
+    import random
+    controller = DoseController(1)
+    true_rate, goal = .025, 670.
+    weight, visits = 600., 0
+    for watering in range(12):
+        time_ms = controller.dose(0, weight, goal)
+        controller.watered(0, watering * 600, weight + random.gauss(0, .5), .5, time_ms)
+        weight += true_rate * time_ms
+        visits += 1
+        controller.update(watering * 600 + 300, (weight + random.gauss(0, .5),), (.5,))
+        print(f'visit {visits}: {time_ms} ms -> {weight:.1f} g, rate {controller.filters[0].rate:.4f} +/- {controller.filters[0].stdev:.4f} g/ms')
+        if weight >= goal - 5:
+            weight -= 60 # a day of evapotranspiration
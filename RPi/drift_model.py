@@ -0,0 +1,259 @@
+from __future__ import annotations
+import os
+import math
+import json
+import dataclasses
+from typing import Iterable, Optional
+from logging_helper import logger as lh
+from smart_arrays import SmartArray
+
+
+@dataclasses.dataclass(frozen=True)
+class DriftModelInfo:
+    '''
+        Configuration of the temperature drift compensation of the load cells.
+        The offset of each balanza (in raw units) is modelled as
+            offset(T) = calibrated_offset + shift + coef * (T - reference_temp)
+        shift and coef are estimated online from two kinds of observations:
+            - empty: the balanza is known to be empty (it is in empty_balanzas, or it
+              weighs less than empty_grams, that is, the pot was taken off), so its raw
+              mean is the offset itself (re-zeroing)
+            - stable: the load didn't change since the previous reading (the pot wasn't
+              watered), so the change of the raw mean is coef times the change of temperature
+              plus the change the weight model expected (so they need a weight model, or the
+              evapotranspiration would be fitted as coef)
+        shift is relative to the calibrated offsets, so the model is reset when they change
+    '''
+    reference_temp: float = 25 # C, the temperature of the calibration
+    initial_shift_stdev: float = 50 # raw units
+    initial_coef_stdev: float = 20 # raw units per C
+    process_noise_shift: float = 4 # raw^2 per hour, the offset creeps slowly
+    process_noise_coef: float = .01 # (raw/C)^2 per hour
+    empty_grams: float = 20
+    empty_balanzas: tuple[int, ...] = ()
+    min_delta_temp: float = .3 # C. Stable pairs with a smaller change carry little information
+    gate_sigmas: float = 4 # observations further than this from the prediction are discarded
+    max_correction_grams: float = 50 # the correction of a balanza is clipped to this
+    save_period_s: float = 600
+
+
+class OffsetDriftFilter:
+    '''
+        Kalman filter of the offset drift of a single balanza with state [shift, coef].
+        Both kinds of observations are linear in the state: h = [1, T - reference_temp]
+        for an empty balanza and h = [0, T - T_previous] for a stable one
+    '''
+    __slots__ = ('info', 'shift', 'coef', 'p00', 'p01', 'p11', 'last_raw', 'last_var', 'last_temp', 'expected_since_last', 'n_empty', 'n_stable', 'n_rejected')
+
+    def __init__(self, info: DriftModelInfo) -> None:
+        self.info = info
+        self.shift = 0.
+        self.coef = 0.
+        self.p00 = info.initial_shift_stdev**2
+        self.p01 = 0.
+        self.p11 = info.initial_coef_stdev**2
+        # reading the stable ones are compared with
+        self.last_raw: Optional[float] = None
+        self.last_var = 0.
+        self.last_temp = 0.
+        self.expected_since_last = 0.
+        self.n_empty = 0
+        self.n_stable = 0
+        self.n_rejected = 0
+
+    def correction(self, temp: float) -> float:
+        return self.shift + self.coef * (temp - self.info.reference_temp)
+
+    def predict(self, dt_h: float) -> None:
+        if dt_h <= 0:
+            return
+        self.p00 += self.info.process_noise_shift * dt_h
+        self.p11 += self.info.process_noise_coef * dt_h
+
+    def _update(self, h0: float, h1: float, z: float, r: float) -> bool:
+        ''' returns False if the observation was discarded by the gate '''
+        s = h0*h0*self.p00 + 2*h0*h1*self.p01 + h1*h1*self.p11 + r
+        y = z - (h0*self.shift + h1*self.coef)
+        if y*y > self.info.gate_sigmas**2 * s:
+            self.n_rejected += 1
+            return False
+        k0 = (h0*self.p00 + h1*self.p01) / s
+        k1 = (h0*self.p01 + h1*self.p11) / s
+        self.shift += k0 * y
+        self.coef += k1 * y
+        self.p00 -= k0 * k0 * s
+        self.p01 -= k0 * k1 * s
+        self.p11 -= k1 * k1 * s
+        return True
+
+    def observe_empty(self, raw: float, raw_var: float, calibrated_offset: float, temp: float) -> bool:
+        ok = self._update(1., temp - self.info.reference_temp, raw - calibrated_offset, max(raw_var, 1e-6))
+        self.n_empty += ok
+        return ok
+
+    def observe_stable(self, raw: float, raw_var: float, temp: float, expected_change: float=0) -> bool:
+        '''
+            expected_change is the raw change the load itself should have had since the
+            previous reading (for example the evapotranspiration predicted by the weight
+            model). The reading is compared with the last one that was remembered, which is
+            kept until the temperature moved at least min_delta_temp from it
+        '''
+        if self.last_raw is None:
+            self.remember(raw, raw_var, temp)
+            return False
+        self.expected_since_last += expected_change
+        if abs(temp - self.last_temp) < self.info.min_delta_temp:
+            return False
+        z = raw - self.last_raw - self.expected_since_last
+        ok = self._update(0., temp - self.last_temp, z, max(raw_var + self.last_var, 1e-6))
+        self.n_stable += ok
+        self.remember(raw, raw_var, temp)
+        return ok
+
+    def remember(self, raw: float, raw_var: float, temp: float) -> None:
+        self.last_raw, self.last_var, self.last_temp = raw, raw_var, temp
+        self.expected_since_last = 0.
+
+    def forget(self) -> None:
+        ''' the load changed (or is unknown), the next reading can't be compared with the last '''
+        self.last_raw = None
+
+
+def _same_offsets(a: Optional[Iterable[float]], b: Iterable[float]) -> bool:
+    if a is None:
+        return False
+    a, b = list(a), list(b)
+    return len(a) == len(b) and all(math.isclose(x, y, rel_tol=1e-9, abs_tol=1e-6) for x, y in zip(a, b))
+
+
+class DriftModel:
+    '''
+        Temperature drift compensation of the balanzas of a system. corrections(temp) is
+        subtracted from the raw readings (along with the calibrated offsets) in
+        Balanzas.read_stats, and update() is fed after each reading with which balanzas
+        are empty or stable. The state is saved to save_file so the model is not lost on
+        restarts, along with the calibrated offsets it was fitted against (offsets). A saved
+        state of other offsets is not loaded
+    '''
+    def __init__(self, n_balanzas: int, info: Optional[DriftModelInfo]=None, save_file: Optional[str]=None, offsets: Optional[Iterable[float]]=None) -> None:
+        self.info = DriftModelInfo() if info is None else info
+        self.n_balanzas = n_balanzas
+        self.save_file = save_file
+        self.offsets: Optional[list[float]] = None if offsets is None else list(offsets)
+        self.filters = tuple(OffsetDriftFilter(self.info) for _ in range(n_balanzas))
+        self.last_time_s: Optional[float] = None
+        if save_file is not None:
+            self.load()
+
+    def corrections(self, temp: float, slopes: Optional[Iterable[float]]=None) -> SmartArray:
+        ''' raw units to subtract from the readings. Clipped to max_correction_grams if slopes is given '''
+        res = SmartArray([f.correction(temp) for f in self.filters], float)
+        if slopes is not None:
+            limits = [abs(s) * self.info.max_correction_grams for s in slopes]
+            res = SmartArray([max(-l, min(l, c)) for c, l in zip(res, limits)], float)
+        return res
+
+    def predict(self, time_s: float) -> None:
+        if self.last_time_s is not None:
+            dt_h = (time_s - self.last_time_s) / 3600
+            for f in self.filters:
+                f.predict(dt_h)
+        self.last_time_s = time_s
+
+    def update(self, time_s: float, raw_means: Iterable[float], raw_vars: Iterable[float], temp: float, calibrated_offsets: Iterable[float], empty: Iterable[bool], stable: Iterable[bool], expected_changes: Optional[Iterable[float]]=None) -> int:
+        '''
+            feeds a reading of all the balanzas (raw units) taken at temp. A balanza that is
+            neither empty nor stable only breaks the chain of stable readings.
+            Returns the number of observations that were used
+        '''
+        if temp is None or math.isnan(temp):
+            return 0
+        self.predict(time_s)
+        expected_changes = (0.,)*self.n_balanzas if expected_changes is None else expected_changes
+        n = 0
+        for i, (f, raw, var, offset, e, s, change) in enumerate(zip(self.filters, raw_means, raw_vars, calibrated_offsets, empty, stable, expected_changes)):
+            if math.isnan(raw):
+                f.forget()
+                continue
+            if e or i in self.info.empty_balanzas:
+                n += f.observe_empty(raw, var, offset, temp)
+                f.remember(raw, var, temp)
+            elif s:
+                n += f.observe_stable(raw, var, temp, change)
+            else:
+                f.forget()
+        return n
+
+    def reset(self) -> None:
+        self.filters = tuple(OffsetDriftFilter(self.info) for _ in range(self.n_balanzas))
+
+    def tared(self, temp: Optional[float], offsets: Optional[Iterable[float]]=None) -> None:
+        '''
+            the calibrated offsets were just measured again (offsets) at temp, so the correction
+            at temp is 0 from now on. The coefs are kept. Without temp the model starts over
+        '''
+        if offsets is not None:
+            self.offsets = list(offsets)
+        if temp is None or math.isnan(temp):
+            self.reset()
+            return
+        for f in self.filters:
+            f.shift = -f.coef * (temp - self.info.reference_temp)
+            f.forget()
+
+    def state(self) -> dict:
+        return {
+            'reference_temp': self.info.reference_temp,
+            'offsets': self.offsets,
+            'shifts': [f.shift for f in self.filters],
+            'coefs': [f.coef for f in self.filters],
+            'covariances': [[[f.p00, f.p01], [f.p01, f.p11]] for f in self.filters],
+        }
+
+    def save(self) -> bool:
+        if self.save_file is None:
+            return False
+        try:
+            tmp_file = self.save_file + '.tmp'
+            with open(tmp_file, 'w') as f:
+                json.dump(self.state(), f)
+            os.replace(tmp_file, self.save_file)
+            return True
+        except Exception as err:
+            lh.warning(f'DriftModel: No se pudo guardar el modelo de deriva ({err})')
+            return False
+
+    def load(self) -> bool:
+        if self.save_file is None or not os.path.isfile(self.save_file):
+            return False
+        try:
+            with open(self.save_file, 'r') as f:
+                obj = json.load(f)
+            if len(obj['shifts']) != self.n_balanzas or obj['reference_temp'] != self.info.reference_temp:
+                lh.warning('DriftModel: El modelo de deriva guardado no corresponde a esta configuracion')
+                return False
+            if self.offsets is not None and not _same_offsets(obj.get('offsets'), self.offsets):
+                lh.warning('DriftModel: El modelo de deriva guardado es de otra calibracion, se empieza de nuevo')
+                return False
+            for f, shift, coef, ((p00, p01), (_, p11)) in zip(self.filters, obj['shifts'], obj['coefs'], obj['covariances']):
+                f.shift, f.coef, f.p00, f.p01, f.p11 = shift, coef, p00, p01, p11
+            lh.info('DriftModel: Se cargo el modelo de deriva guardado')
+            return True
+        except Exception as err:
+            lh.warning(f'DriftModel: No se pudo cargar el modelo de deriva ({err})')
+            return False
+
+
+if __name__ == '__main__':
+    import random
+    model = DriftModel(1, DriftModelInfo(empty_balanzas=()))
+    offset, true_coef = 1000., 8.
+    for k in range(200):
+        temp = 25 + 5 * math.sin(k / 20)
+        raw = offset + true_coef * (temp - 25) + 600 * 2 + random.gauss(0, 1)
+        empty = k % 50 == 0
+        if empty:
+            raw -= 600 * 2
+        model.update(k * 600, (raw,), (1.,), temp, (offset,), (empty,), (not empty,))
+    f = model.filters[0]
+    print(f'coef {f.coef:.2f} +/- {math.sqrt(f.p11):.2f} (true {true_coef}), shift {f.shift:.2f} +/- {math.sqrt(f.p00):.2f}, {f.n_empty} empty, {f.n_stable} stable, {f.n_rejected} rejected')
@@ -6,30 +6,71 @@ from smart_arrays import SmartArray
 
 
 class FileManager:
-    def __init__(self, n_balanzas: int, fname: str='data.csv') -> None:
+    def __init__(self, n_balanzas: int, fname: str='data.csv', name: Optional[str]=None) -> None:
+        ''' name is the system of the records sent to the collector, the name of the file if None '''
         self.n_balanzas = n_balanzas
         self.fname = fname
+        self.name = os.path.splitext(os.path.basename(fname))[0] if name is None else name
         self.dirname = os.path.dirname(os.path.abspath(self.fname))
+        # PersistenceProcess that writes the rows, if any (see persistence.py)
+        self.persistence = None
+        # CollectorClient that also ships the rows to the aggregator, if any (see collector.py)
+        self.collector = None
+        self._header_checked = False
 
-    def add_entry(self, b_means: SmartArray, b_stdevs: SmartArray, pump_states: SmartArray, n_filtered: SmartArray, n_unsuccessful: float, grams_goals: SmartArray, grams_threshold: float, dht_hum: Optional[float], dht_temp: Optional[float]) -> bool:
-        if not os.path.isdir(self.dirname):
-            os.makedirs(self.dirname)
+    def _header(self) -> str:
+        header = 'time,'
+        for i in range(self.n_balanzas):
+            header += f'balanza_avg_{i+1},balanza_std_{i+1},balanza_pump_state_{i+1},balanza_read_{i+1},n_filtered_{i+1},grams_goals_{i+1},grams_threshold_{i+1},'
+        return header + 'n_unsuccessful,hum,temp\n'
 
+    def _check_header(self) -> None:
+        ''' a file with other columns (older version, other number of balanzas) is moved aside '''
+        self._header_checked = True
+        if not os.path.isfile(self.fname):
+            return
+        with open(self.fname, 'r') as f:
+            header = f.readline()
+        if header and header != self._header():
+            root, ext = os.path.splitext(self.fname)
+            old_fname = f'{root}_{datetime.now().strftime("%Y-%m-%d_%H-%M-%S")}{ext}'
+            os.replace(self.fname, old_fname)
+            lh.warning(f'File Manager: {self.fname} tenia otras columnas, se movio a {old_fname}')
+
+    def add_entry(self, b_means: SmartArray, b_stdevs: SmartArray, pump_states: SmartArray, n_filtered: SmartArray, n_unsuccessful: float, grams_goals: SmartArray, grams_threshold: float, dht_hum: Optional[float], dht_temp: Optional[float], read: Optional[SmartArray]=None) -> bool:
+        '''
+            read is False for the balanzas that were not read in this tick (partial reads), whose
+            mean is the prediction of the weight model or the last weight. None if all were read
+        '''
         if not (len(b_means) == len(b_stdevs) == len(pump_states) == self.n_balanzas):
             lh.error(f'File Manager: Lengths of arrays do not match or are not {self.n_balanzas}. Lengths are {b_means.shape[0]}, {b_stdevs.shape[0]}, {pump_states.shape[0]}')
             return False
 
+        if not self._header_checked:
+            self._check_header()
+        if read is None:
+            read = SmartArray([True]*self.n_balanzas, bool)
+
+        now_str = datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
+        if self.collector is not None:
+            self.collector.add(
+                self.name, time=now_str, means=b_means, stdevs=b_stdevs, to_water=pump_states, read=read, n_filtered=n_filtered,
+                n_unsuccessful=n_unsuccessful, goals=grams_goals, threshold=grams_threshold, hum=dht_hum, temp=dht_temp
+            )
+
+        row = now_str + ','
+        for i in range(self.n_balanzas):
+            row += f'{b_means[i]},{b_stdevs[i]},{1 if pump_states[i] else 0},{1 if read[i] else 0},{n_filtered[i]},{grams_goals[i]},{grams_threshold},'
+        row += f'{n_unsuccessful},{dht_hum if dht_hum is not None else ""},{dht_temp if dht_temp is not None else ""}\n'
+        if self.persistence is not None and self.persistence.append_csv(self.fname, self._header(), row):
+            return True
+
+        if not os.path.isdir(self.dirname):
+            os.makedirs(self.dirname)
         first_time = not os.path.isfile(self.fname)
         with open(self.fname, 'a') as f:
             if first_time:
-                f.write('time,')
-                for i in range(self.n_balanzas):
-                    f.write(f'balanza_avg_{i+1},balanza_std_{i+1},balanza_pump_state_{i+1},n_filtered_{i+1},grams_goals_{i+1},grams_threshold_{i+1},')
-                f.write('n_unsuccessful,hum,temp\n')
-            now_str = datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
-            f.write(now_str + ',')
-            for i in range(self.n_balanzas):
-                f.write(f'{b_means[i]},{b_stdevs[i]},{1 if pump_states[i] else 0},{n_filtered[i]},{grams_goals[i]},{grams_threshold},')
-            f.write(f'{n_unsuccessful},{dht_hum if dht_hum is not None else ""},{dht_temp if dht_temp is not None else ""}\n')
+                f.write(self._header())
+            f.write(row)
         
-        return True
\ No newline at end of file
+        return True
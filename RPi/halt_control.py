@@ -0,0 +1,63 @@
+import threading
+from typing import Callable, List, Optional
+
+halt_cb_t = Callable[[bool], None]
+
+
+class HaltedError(Exception):
+    ''' raised by interruptible waits when the system is halted '''
+    pass
+
+
+class HaltControl:
+    '''
+        Event based pause/resume. Long waits (serial rcv waits, multi sample acquisitions,
+        retries) use sleep() and check() so that a halt interrupts them right away instead of
+        after the current tick. Listeners are called (in the thread that halts or resumes)
+        every time the state changes
+    '''
+    def __init__(self) -> None:
+        self._halted = threading.Event()
+        self._resumed = threading.Event()
+        self._resumed.set()
+        self._listeners: List[halt_cb_t] = list()
+        self._lock = threading.Lock()
+
+    @property
+    def halted(self) -> bool:
+        return self._halted.is_set()
+
+    def add_listener(self, callback: halt_cb_t) -> None:
+        if not isinstance(callback, Callable): raise TypeError()
+        self._listeners.append(callback)
+
+    def set(self, state: bool) -> None:
+        with self._lock:
+            if state == self.halted:
+                return
+            if state:
+                self._resumed.clear()
+                self._halted.set()
+            else:
+                self._halted.clear()
+                self._resumed.set()
+        for listener in self._listeners:
+            listener(state)
+
+    def halt(self) -> None:
+        self.set(True)
+
+    def resume(self) -> None:
+        self.set(False)
+
+    def check(self) -> None:
+        if self._halted.is_set():
+            raise HaltedError()
+
+    def sleep(self, s: float) -> None:
+        ''' sleeps s seconds. Raises HaltedError as soon as the system is halted '''
+        if self._halted.wait(s):
+            raise HaltedError()
+
+    def wait_resumed(self, timeout: Optional[float]=None) -> bool:
+        return self._resumed.wait(timeout)
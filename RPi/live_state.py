@@ -0,0 +1,229 @@
+'''
+    Live state of the SystemsManager in a fixed layout shared memory segment (a memory
+    mapped file, in /dev/shm if it exists), so any number of local monitors can poll the
+    current weights without reading the logs or the csv and without bothering the control
+    loop. The writer protects every update with a seqlock: the sequence number is odd while
+    an update is in progress, and a reader retries if it was odd or changed during its read.
+    Readers never block the writer. Run from the RPi directory to watch it:
+        python live_state.py [path]
+'''
+from __future__ import annotations
+import os
+import sys
+import math
+import mmap
+import struct
+import tempfile
+import threading
+import dataclasses
+from time import time, sleep
+from typing import List, Optional, Sequence
+
+MAGIC = b'LBNS'
+VERSION = 1
+NAME_SIZE = 32
+
+# magic, version, n_systems, max_balanzas, seq, publish wall time, halted
+_header = struct.Struct('<4sHHH2xQdB')
+_SEQ_OFFSET = 12
+_PUBLISH_OFFSET = 20
+_HALTED_OFFSET = 28
+# tick_count, last tick wall time, last tick monotonic time, last tick duration, hum, temp, ready, link_dead, skipped, n_balanzas
+_system = struct.Struct('<QdddddBBBH')
+
+
+def default_path(name: str='labino_live_state') -> str:
+    dirname = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+    return os.path.join(dirname, name)
+
+
+@dataclasses.dataclass
+class SystemState:
+    ''' state of a system after its last tick. hum and temp are nan if the dht couldn't be read '''
+    name: str = ''
+    tick_count: int = 0
+    last_tick_wall: float = 0
+    last_tick_mono: float = 0
+    last_tick_dt: float = 0
+    hum: float = math.nan
+    temp: float = math.nan
+    ready: bool = False
+    link_dead: bool = False
+    skipped: bool = False # the weighing of the last tick was skipped and the means are predictions
+    means: List[float] = dataclasses.field(default_factory=list)
+    stdevs: List[float] = dataclasses.field(default_factory=list)
+    to_water: List[bool] = dataclasses.field(default_factory=list)
+    intensities: List[int] = dataclasses.field(default_factory=list)
+    inhabilitated: List[bool] = dataclasses.field(default_factory=list)
+
+
+@dataclasses.dataclass
+class LiveState:
+    seq: int
+    publish_wall: float
+    halted: bool
+    systems: List[SystemState]
+
+
+class _Layout:
+    ''' offsets of the segment for n_systems systems of up to max_balanzas balanzas '''
+    def __init__(self, n_systems: int, max_balanzas: int) -> None:
+        self.n_systems = n_systems
+        self.max_balanzas = max_balanzas
+        m = max_balanzas
+        # means, stdevs, to_water, intensities, inhabilitated
+        self.arrays = struct.Struct(f'<{m}d{m}d{m}B{m}i{m}B')
+        self.names_offset = _header.size
+        self.systems_offset = self.names_offset + n_systems * NAME_SIZE
+        self.system_size = _system.size + self.arrays.size
+        self.size = self.systems_offset + n_systems * self.system_size
+
+    def system_offset(self, index: int) -> int:
+        return self.systems_offset + index * self.system_size
+
+
+def _padded(values: Sequence, size: int, fill) -> list:
+    values = list(values)[:size]
+    return values + [fill] * (size - len(values))
+
+
+class LiveStateWriter:
+    '''
+        Owner of the segment. Only one process writes, but within it the control loop and the
+        halt listener may publish from different threads, so writes take a lock among themselves
+    '''
+    def __init__(self, names: Sequence[str], n_balanzas: Sequence[int], path: Optional[str]=None) -> None:
+        if len(names) != len(n_balanzas):
+            raise IndexError('names and n_balanzas should be of the same length')
+        self.path = default_path() if path is None else path
+        self.n_balanzas = tuple(n_balanzas)
+        self.layout = _Layout(len(names), max(self.n_balanzas, default=0))
+        self._lock = threading.Lock()
+        self._seq = 0
+        # the segment is built aside and then replaces the one of a previous run, truncating
+        # a file that a monitor still has mapped would crash it
+        tmp_path = self.path + '.tmp'
+        fd = os.open(tmp_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.ftruncate(fd, self.layout.size)
+            self.mm = mmap.mmap(fd, self.layout.size)
+        finally:
+            os.close(fd)
+        _header.pack_into(self.mm, 0, MAGIC, VERSION, self.layout.n_systems, self.layout.max_balanzas, 0, time(), 0)
+        for i, (name, n) in enumerate(zip(names, self.n_balanzas)):
+            self.mm[self.layout.names_offset + i*NAME_SIZE:self.layout.names_offset + (i+1)*NAME_SIZE] = name.encode('utf-8')[:NAME_SIZE].ljust(NAME_SIZE, b'\0')
+            self._write_system(i, SystemState(means=[math.nan]*n, stdevs=[math.nan]*n))
+        os.replace(tmp_path, self.path)
+
+    def _begin(self) -> None:
+        self._seq += 1
+        struct.pack_into('<Q', self.mm, _SEQ_OFFSET, self._seq)
+
+    def _end(self, halted: Optional[bool]=None) -> None:
+        if halted is not None:
+            struct.pack_into('<B', self.mm, _HALTED_OFFSET, halted)
+        struct.pack_into('<d', self.mm, _PUBLISH_OFFSET, time())
+        self._seq += 1
+        struct.pack_into('<Q', self.mm, _SEQ_OFFSET, self._seq)
+
+    def _write_system(self, index: int, state: SystemState) -> None:
+        offset = self.layout.system_offset(index)
+        m = self.layout.max_balanzas
+        _system.pack_into(
+            self.mm, offset, state.tick_count, state.last_tick_wall, state.last_tick_mono, state.last_tick_dt,
+            math.nan if state.hum is None else state.hum, math.nan if state.temp is None else state.temp,
+            state.ready, state.link_dead, state.skipped, self.n_balanzas[index]
+        )
+        self.layout.arrays.pack_into(
+            self.mm, offset + _system.size,
+            *_padded(state.means, m, math.nan), *_padded(state.stdevs, m, math.nan),
+            *_padded((bool(e) for e in state.to_water), m, False), *_padded((int(e) for e in state.intensities), m, 0),
+            *_padded((bool(e) for e in state.inhabilitated), m, False)
+        )
+
+    def publish(self, index: int, state: SystemState) -> None:
+        with self._lock:
+            self._begin()
+            try:
+                self._write_system(index, state)
+            finally:
+                self._end()
+
+    def publish_halted(self, halted: bool) -> None:
+        with self._lock:
+            self._begin()
+            self._end(halted)
+
+    def close(self, remove: bool=True) -> None:
+        self.mm.close()
+        if remove:
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+
+
+class LiveStateReader:
+    '''
+        Maps the segment read only. read() decodes it straight from the mapping (there is no
+        intermediate copy of the buffer) and retries while the writer is in the middle of an
+        update
+    '''
+    def __init__(self, path: Optional[str]=None) -> None:
+        self.path = default_path() if path is None else path
+        with open(self.path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, n_systems, max_balanzas, _, _, _ = _header.unpack_from(self.mm, 0)
+        if magic != MAGIC or version != VERSION:
+            self.mm.close()
+            raise ValueError(f'{self.path} is not a live state segment of version {VERSION}')
+        self.layout = _Layout(n_systems, max_balanzas)
+        if len(self.mm) < self.layout.size:
+            self.mm.close()
+            raise ValueError(f'{self.path} is smaller than its layout')
+        self.names = [
+            bytes(self.mm[self.layout.names_offset + i*NAME_SIZE:self.layout.names_offset + (i+1)*NAME_SIZE]).rstrip(b'\0').decode('utf-8', 'replace')
+            for i in range(n_systems)
+        ]
+
+    def _read_system(self, index: int) -> SystemState:
+        offset = self.layout.system_offset(index)
+        m = self.layout.max_balanzas
+        tick_count, wall, mono, dt, hum, temp, ready, link_dead, skipped, n = _system.unpack_from(self.mm, offset)
+        arrays = self.layout.arrays.unpack_from(self.mm, offset + _system.size)
+        return SystemState(
+            name=self.names[index], tick_count=tick_count, last_tick_wall=wall, last_tick_mono=mono, last_tick_dt=dt,
+            hum=hum, temp=temp, ready=bool(ready), link_dead=bool(link_dead), skipped=bool(skipped),
+            means=list(arrays[0:n]), stdevs=list(arrays[m:m+n]),
+            to_water=[bool(e) for e in arrays[2*m:2*m+n]], intensities=list(arrays[3*m:3*m+n]),
+            inhabilitated=[bool(e) for e in arrays[4*m:4*m+n]]
+        )
+
+    def read(self, max_retries: int=1000) -> Optional[LiveState]:
+        ''' consistent snapshot of the segment, or None if the writer kept it busy for max_retries attempts '''
+        for _ in range(max_retries):
+            seq = struct.unpack_from('<Q', self.mm, _SEQ_OFFSET)[0]
+            if seq % 2:
+                continue
+            publish_wall, halted = struct.unpack_from('<dB', self.mm, _PUBLISH_OFFSET)
+            systems = [self._read_system(i) for i in range(self.layout.n_systems)]
+            if struct.unpack_from('<Q', self.mm, _SEQ_OFFSET)[0] == seq:
+                return LiveState(seq, publish_wall, bool(halted), systems)
+        return None
+
+    def close(self) -> None:
+        self.mm.close()
+
+
+if __name__ == '__main__':
+    reader = LiveStateReader(sys.argv[1] if len(sys.argv) > 1 else None)
+    last_seq = None
+    while True:
+        state = reader.read()
+        if state is not None and state.seq != last_seq:
+            last_seq = state.seq
+            print(f'seq {state.seq} {"DETENIDO" if state.halted else ""}')
+            for s in state.systems:
+                weights = ' '.join(f'{m:7.1f}' for m in s.means)
+                print(f'  {s.name}: tick {s.tick_count} ({s.last_tick_dt:.1f} s{", salteado" if s.skipped else ""}) hum {s.hum:.1f} temp {s.temp:.1f} pesos {weights}')
+        sleep(1)
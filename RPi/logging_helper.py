@@ -1,7 +1,7 @@
 import logging
 import logging.handlers
 from collections.abc import Iterable
-from typing import Union
+from typing import Union, Optional
 import os
 
 class LoggingLevelFilter(logging.Filter):
@@ -29,17 +29,17 @@ for fname_ in (fname_debug, fname_info, fname_error):
     if not os.path.isdir(dirname):
         os.makedirs(dirname)
 
-rotating_handler_info = logging.handlers.RotatingFileHandler(filename=fname_info, mode='a', maxBytes=5*1024*1024, backupCount=10)
+rotating_handler_info = logging.handlers.RotatingFileHandler(filename=fname_info, mode='a', maxBytes=5*1024*1024, backupCount=10, delay=True)
 rotating_handler_info.setFormatter(formatter_file)
 rotating_handler_info.addFilter(LoggingLevelFilter((logging.INFO, logging.WARNING)))
 logger.addHandler(rotating_handler_info)
 
-rotating_handler_debug = logging.handlers.RotatingFileHandler(filename=fname_debug, mode='a', maxBytes=5*1024*1024, backupCount=10)
+rotating_handler_debug = logging.handlers.RotatingFileHandler(filename=fname_debug, mode='a', maxBytes=5*1024*1024, backupCount=10, delay=True)
 rotating_handler_debug.setFormatter(formatter_file)
 rotating_handler_debug.addFilter(LoggingLevelFilter(logging.DEBUG))
 logger.addHandler(rotating_handler_debug)
 
-rotating_handler_error = logging.handlers.RotatingFileHandler(filename=fname_error, mode='a', maxBytes=5*1024*1024, backupCount=10)
+rotating_handler_error = logging.handlers.RotatingFileHandler(filename=fname_error, mode='a', maxBytes=5*1024*1024, backupCount=10, delay=True)
 rotating_handler_error.setFormatter(formatter_file)
 rotating_handler_error.addFilter(LoggingLevelFilter((logging.ERROR, logging.CRITICAL)))
 logger.addHandler(rotating_handler_error)
@@ -49,6 +49,49 @@ stream_handler.setFormatter(formatter_print)
 stream_handler.addFilter(LoggingLevelFilter((logging.INFO, logging.WARNING, logging.ERROR, logging.CRITICAL)))
 logger.addHandler(stream_handler)
 
+def is_enabled_for(level: int) -> bool:
+    '''
+        True if at least one handler of the logger would emit a record of the given level.
+        Unlike logger.isEnabledFor this takes into account the handler levels and the
+        LoggingLevelFilter of each handler, so it can be used as a guard before doing
+        expensive work that is only needed for a log message
+    '''
+    if not logger.isEnabledFor(level):
+        return False
+    for handler in logger.handlers:
+        if level < handler.level:
+            continue
+        level_filters = tuple(f for f in handler.filters if isinstance(f, LoggingLevelFilter))
+        if all(level in f.logging_levels for f in level_filters):
+            return True
+    return False
+
+class StructuredMessage:
+    '''
+        Log message made of a text and key/value fields. The fields are only rendered
+        (and rendered only once) when a handler actually formats the record, so a
+        filtered out record never pays for the repr of its fields.
+        usage: lh.debug(fields('Serial read', res=res))
+    '''
+    __slots__ = ('msg', 'fields', '_rendered')
+
+    def __init__(self, msg: str, fields: dict) -> None:
+        self.msg = msg
+        self.fields = fields
+        self._rendered: Optional[str] = None
+
+    def __str__(self) -> str:
+        if self._rendered is None:
+            fields_str = ', '.join(f'{k}={v}' for k, v in self.fields.items())
+            self._rendered = f'{self.msg}: {fields_str}' if fields_str else self.msg
+        return self._rendered
+
+    def __repr__(self) -> str:
+        return self.__str__()
+
+def fields(msg: str, **kwargs) -> StructuredMessage:
+    return StructuredMessage(msg, kwargs)
+
 def debug(msg: str, *args) -> None:
     logger.debug(msg, *args)
 
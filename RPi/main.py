@@ -1,15 +1,22 @@
+from startup_profile import startup_profile
+# the heavy modules are imported first to profile them. The imports below are then free
+startup_profile.time_imports(('logging_helper', 'serial_manager', 'smart_arrays', 'balanzas', 'file_manager', 'systems', 'maintenance_circuit'))
+
 from balanzas import Balanzas
 from balanzas import calibrate as balanzas_calibrate
 from serial_manager import SerialManager
 from file_manager import FileManager
 from logging_helper import logger as lh
 from time import sleep
-from smart_arrays import SmartArray, UncertaintiesArray
+from smart_arrays import SmartArray
 from smart_arrays import smart_array as sa
 from typing import Optional
 from systems import SystemInfo, SystemsManager, Position, IntensityConfig, SerialManagerInfo, BalanzasInfo, StepperPos
 from dataclass_save import load_dataclass, save_dataclass
 from maintenance_circuit import Maintenance
+from control_api import ControlApi
+from collector import CollectorInfo
+from tick_profiler import TickProfilerInfo
 
 # change working directory to here
 import os
@@ -18,8 +25,22 @@ dname = os.path.dirname(abspath)
 os.chdir(dname)
 del abspath, dname
 
+# aggregator the rows of the csv are shipped to (see collector.py), None to only keep them on this pi
+COLLECTOR: Optional[CollectorInfo] = None
+# profiling of the ticks (see tick_profiler.py), for example TickProfilerInfo(every_n=100, slo_s=30)
+TICK_PROFILER: Optional[TickProfilerInfo] = None
+
 def run(systems_manager: SystemsManager) -> None:
-    systems_manager.begin()
+    with startup_profile.phase('begin'):
+        systems_manager.begin()
+    startup_profile.report()
+    systems_manager.start_persistence_process()
+    systems_manager.publish_live_state()
+    if COLLECTOR is not None:
+        systems_manager.start_collector(COLLECTOR)
+    if TICK_PROFILER is not None:
+        systems_manager.enable_tick_profiler(TICK_PROFILER)
+    ControlApi(systems_manager).start()
     systems_manager.loop()
 
 def show_positions(systems_manager: SystemsManager, system_index: int, wait_for_user_input: bool) -> None:
@@ -30,9 +51,9 @@ def go_home(systems_manager: SystemsManager, system_index: int, wait_for_user_in
     systems_manager.begin_single(system_index)
     systems_manager.go_home(system_index, wait_for_user_input)
 
-def calibrate(systems_manager: SystemsManager, system_index: int, n: int=200) -> None:
+def calibrate(systems_manager: SystemsManager, system_index: int, n: int=200, multipoint: bool=False) -> None:
     systems_manager.begin_single(system_index)
-    systems_manager.calibrate_system(system_index, n)
+    systems_manager.calibrate_system(system_index, n, multipoint)
 
 def show_weights(systems_manager: SystemsManager, system_index: int, n: Optional[int]=None) -> None:
     systems_manager.begin_single(system_index)
@@ -57,7 +78,9 @@ def main() -> None:
                 stepper_pos=load_dataclass(StepperPos(save_file='system_1_stepper.json')),
                 sm_info=SerialManagerInfo(
                     port='/dev/ttyACM0',
-                    baud_rate=9600
+                    baud_rate=9600,
+                    baud_rates=(250000, 115200, 57600),
+                    reset_pin=18
                 ),
                 balanzas_info=BalanzasInfo(
                     save_file='system_1_balanzas.json',
@@ -68,8 +91,11 @@ def main() -> None:
                 grams_threshold=0.0
             )
 
-    maintenance = Maintenance()
-    systems_manager = SystemsManager((sys_1,), maintenance)
+    startup_profile.mark('config')
+    with startup_profile.phase('maintenance'):
+        maintenance = Maintenance()
+    with startup_profile.phase('systems_manager'):
+        systems_manager = SystemsManager((sys_1,), maintenance)
 
     # calibrate(systems_manager, 0, 500)
 
@@ -1,8 +1,9 @@
-from gpiozero import DigitalInputDevice as InPin
-from gpiozero import PWMLED as Led
-from typing import Callable
+import queue
+import threading
+from typing import Callable, Optional
 from logging_helper import logger as lh
 from enum import Enum, auto
+from time import monotonic, sleep
 
 maintenance_cb_t = Callable[[None], None]
 
@@ -12,15 +13,59 @@ class Maintenance:
         PULSE = auto()
         BLINK = auto()
 
-    def __init__(self, button_pin: int=24, led_pin: int=23) -> None:
+    def __init__(self, button_pin: int=24, led_pin: int=23, blink_hold_s: float=1) -> None:
         '''
             button_pin: the pulled-up pin which when grounded, halts the system for maintenance
             led_pin: the pin that drives the status LED
+            blink_hold_s: how long the LED blinks (to acknowledge the button) before showing the next state
+
+            The LED is driven by a worker thread, so changing its state never blocks the caller
         '''
+        # gpiozero is imported here so that importing this module is cheap
+        from gpiozero import DigitalInputDevice as InPin
+        from gpiozero import PWMLED as Led
         self.button_pin = InPin(pin=button_pin, pull_up=True, bounce_time=.5)
         self.led_pin = Led(pin=led_pin, active_high=True)
-        self._led_state = Maintenance.LedState.ON
+        self.blink_hold_s = blink_hold_s
+        self._led_state: Optional[Maintenance.LedState] = None
+        self._led_queue: queue.Queue = queue.Queue()
+        self._led_thread = threading.Thread(target=self._led_worker, name='maintenance_led', daemon=True)
+        self._led_thread.start()
         self.led_on(force=True)
+
+    def _apply_led_state(self, state: 'Maintenance.LedState') -> None:
+        if state == Maintenance.LedState.ON:
+            self.led_pin.on()
+        elif state == Maintenance.LedState.PULSE:
+            self.led_pin.pulse(fade_in_time=1, fade_out_time=1, n=None, background=True)
+        elif state == Maintenance.LedState.BLINK:
+            self.led_pin.blink(on_time=0.5, off_time=0.5, fade_in_time=0, fade_out_time=0, n=None, background=True)
+
+    def _led_worker(self) -> None:
+        hold_until = 0
+        while True:
+            state, force = self._led_queue.get()
+            # a blink is shown for at least blink_hold_s, unless a newer blink arrives
+            if state != Maintenance.LedState.BLINK:
+                wait_s = hold_until - monotonic()
+                if wait_s > 0:
+                    sleep(wait_s)
+                # only the latest requested state matters
+                while not self._led_queue.empty():
+                    state, force = self._led_queue.get()
+            if not force and state == self._led_state:
+                continue
+            try:
+                self._apply_led_state(state)
+            except Exception as err:
+                lh.error(f'Maintenance: No se pudo cambiar el estado del LED ({err})')
+                continue
+            self._led_state = state
+            if state == Maintenance.LedState.BLINK:
+                hold_until = monotonic() + self.blink_hold_s
+
+    def set_led_state(self, state: 'Maintenance.LedState', force: bool=False) -> None:
+        self._led_queue.put((state, force))
     
     def begin_maintenance(self, callback: maintenance_cb_t) -> None:
         if not isinstance(callback, Callable): raise TypeError()
@@ -37,19 +82,13 @@ class Maintenance:
         self.button_pin.when_activated = wrapper
 
     def led_on(self, force: bool=False):
-        if force or self._led_state != Maintenance.LedState.ON:
-            self.led_pin.on()
-            self._led_state = Maintenance.LedState.ON
+        self.set_led_state(Maintenance.LedState.ON, force)
 
     def led_pulse(self, force: bool=False):
-        if force or self._led_state != Maintenance.LedState.PULSE:
-            self.led_pin.pulse(fade_in_time=1, fade_out_time=1, n=None, background=True)
-            self._led_state = Maintenance.LedState.PULSE
+        self.set_led_state(Maintenance.LedState.PULSE, force)
     
     def led_blink(self, force: bool=False):
-        if force or self._led_state != Maintenance.LedState.BLINK:
-            self.led_pin.blink(on_time=0.5, off_time=0.5, fade_in_time=0, fade_out_time=0, n=None, background=True)
-            self._led_state = Maintenance.LedState.BLINK
+        self.set_led_state(Maintenance.LedState.BLINK, force)
 
 
     @property
@@ -57,8 +96,6 @@ class Maintenance:
         return bool(self.button_pin.value)
 
 if __name__ == '__main__':
-    from time import sleep
-
     m = Maintenance()
     m.begin_maintenance(lambda: print('begin maintenance'))
     m.end_maintenance(lambda: print('end maintenance'))
@@ -0,0 +1,169 @@
+'''
+    Writer process for the csv of the FileManagers and the log files. The control loop only
+    puts the rows and the log records in a bounded queue (pickled and sent by the feeder
+    thread of the queue, not by the loop), so a slow sd card or a stalled write never delays
+    the ticks and the writes run on another core. If the queue is full a log record is dropped
+    and counted. A row waits a moment for room, and if there is none it is kept in order for
+    the next put, so the csv only ever has one writer. Only when the process is not running
+    are the rows written by the FileManager itself
+'''
+from __future__ import annotations
+import os
+import queue
+from collections import deque
+import logging
+import logging.handlers
+import multiprocessing as mp
+from typing import Optional
+from logging_helper import logger as lh
+
+
+def _write_csv(fname: str, header: str, row: str) -> None:
+    dirname = os.path.dirname(os.path.abspath(fname))
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    first_time = not os.path.isfile(fname)
+    with open(fname, 'a') as f:
+        if first_time:
+            f.write(header)
+        f.write(row)
+
+
+def _run(q: mp.Queue) -> None:
+    from logging_helper import logger, stream_handler
+    # the console stays with the main process
+    logger.removeHandler(stream_handler)
+    while True:
+        item = q.get()
+        if item is None:
+            break
+        kind, payload = item
+        try:
+            if kind == 'log':
+                logger.handle(payload)
+            elif kind == 'csv':
+                _write_csv(*payload)
+        except Exception as err:
+            logger.error(f'Persistence: No se pudo escribir {kind} ({err})')
+    for handler in logger.handlers:
+        handler.flush()
+
+
+class _QueueLogHandler(logging.handlers.QueueHandler):
+    ''' never blocks, a record that doesn't fit in the queue is dropped '''
+    def __init__(self, persistence: PersistenceProcess) -> None:
+        super().__init__(persistence._queue)
+        self.persistence = persistence
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        if not self.persistence._put('log', record):
+            for handler in self.persistence._file_handlers:
+                handler.handle(record)
+
+
+class PersistenceProcess:
+    def __init__(self, queue_size: int=10000, csv_put_timeout_s: float=.5) -> None:
+        self.queue_size = queue_size
+        self.csv_put_timeout_s = csv_put_timeout_s
+        self.n_dropped = 0 # log records
+        self.n_full = 0 # csv rows that found the queue full and were kept for the next put
+        # csv rows that didn't fit in the queue yet, oldest first
+        self._csv_backlog: deque = deque()
+        self._queue: Optional[mp.Queue] = None
+        self._process: Optional[mp.Process] = None
+        self._log_handler: Optional[_QueueLogHandler] = None
+        self._file_handlers: list[logging.Handler] = list()
+
+    @property
+    def alive(self) -> bool:
+        return self._process is not None and self._process.is_alive()
+
+    def start(self) -> None:
+        ''' starts the process and moves the file handlers of the logger to it '''
+        # spawn, forking a process with the threads of the loop (telemetry, gpio, ...) is not safe
+        ctx = mp.get_context('spawn')
+        self._queue = ctx.Queue(self.queue_size)
+        self._process = ctx.Process(target=_run, args=(self._queue,), name='persistence', daemon=True)
+        self._process.start()
+        self._file_handlers = [h for h in lh.handlers if isinstance(h, logging.FileHandler)]
+        self._log_handler = _QueueLogHandler(self)
+        for h in self._file_handlers:
+            h.flush()
+            lh.removeHandler(h)
+        lh.addHandler(self._log_handler)
+        lh.info(f'Persistence: Proceso de escritura iniciado (pid {self._process.pid})')
+
+    def _put(self, kind: str, payload) -> bool:
+        if not self.alive:
+            if kind == 'csv':
+                # the caller writes this row, the ones that were waiting go first
+                self._write_backlog()
+            return False
+        if kind == 'csv':
+            self._put_csv(payload)
+            return True
+        try:
+            self._queue.put_nowait((kind, payload))
+        except queue.Full:
+            self.n_dropped += 1
+        return True
+
+    def _put_csv(self, payload) -> None:
+        ''' the rows of the experiment are never dropped nor reordered '''
+        self._csv_backlog.append(payload)
+        while self._csv_backlog:
+            try:
+                self._queue.put(('csv', self._csv_backlog[0]), timeout=self.csv_put_timeout_s)
+            except queue.Full:
+                self.n_full += 1
+                return
+            self._csv_backlog.popleft()
+
+    def _write_backlog(self) -> None:
+        ''' only once the process is not running, so there is still a single writer '''
+        while self._csv_backlog:
+            try:
+                _write_csv(*self._csv_backlog[0])
+            except OSError as err:
+                lh.error(f'Persistence: No se pudo escribir una fila del csv ({err})')
+            self._csv_backlog.popleft()
+
+    def append_csv(self, fname: str, header: str, row: str) -> bool:
+        '''
+            appends row to fname (header first if the file doesn't exist yet). Returns False if
+            the process is not running, so the caller should write it by itself. If the queue is
+            full it blocks for csv_put_timeout_s at most
+        '''
+        return self._put('csv', (fname, header, row))
+
+    def stop(self, timeout: Optional[float]=10) -> None:
+        ''' writes what is left in the queue and gives the file handlers back to the logger '''
+        if self._process is None:
+            return
+        if self._log_handler is not None:
+            lh.removeHandler(self._log_handler)
+            for h in self._file_handlers:
+                lh.addHandler(h)
+            self._log_handler = None
+        if self._process.is_alive():
+            while self._csv_backlog:
+                try:
+                    self._queue.put(('csv', self._csv_backlog[0]), timeout=timeout)
+                except queue.Full:
+                    break
+                self._csv_backlog.popleft()
+            try:
+                self._queue.put(None, timeout=timeout)
+            except queue.Full:
+                pass
+            self._process.join(timeout)
+            if self._process.is_alive():
+                self._process.terminate()
+        self._queue.close()
+        self._process = None
+        # what the process couldn't take, now that it's gone
+        self._write_backlog()
+        if self.n_dropped > 0:
+            lh.warning(f'Persistence: Se descartaron {self.n_dropped} registros del log por tener la cola llena')
+        if self.n_full > 0:
+            lh.warning(f'Persistence: {self.n_full} veces una fila del csv tuvo que esperar por tener la cola llena')
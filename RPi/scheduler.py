@@ -0,0 +1,176 @@
+import threading
+import dataclasses
+from math import floor
+from time import monotonic, sleep
+from typing import Any, Callable, List, Optional
+from logging_helper import logger as lh
+
+
+class MonotonicClock:
+    '''
+        Time source of the scheduler. Every wait goes through here, so it
+        can be replaced by a virtual clock
+    '''
+    def monotonic(self) -> float:
+        return monotonic()
+
+    def sleep(self, s: float) -> None:
+        if s > 0:
+            sleep(s)
+
+    def wait(self, event: threading.Event, timeout: Optional[float]=None) -> bool:
+        ''' waits until the event is set or timeout seconds pass. Returns the state of the event '''
+        return event.wait(timeout)
+
+
+class VirtualClock(MonotonicClock):
+    '''
+        Clock whose time only moves when something sleeps or waits on it, so a schedule of
+        days runs as fast as the tasks themselves (see simulator.py). A wait returns right
+        away, after moving the time to its timeout, unless the event was already set
+    '''
+    def __init__(self, start_s: float=0) -> None:
+        self._now = start_s
+        self._lock = threading.Lock()
+
+    def monotonic(self) -> float:
+        return self._now
+
+    def sleep(self, s: float) -> None:
+        if s > 0:
+            with self._lock:
+                self._now += s
+
+    def wait(self, event: threading.Event, timeout: Optional[float]=None) -> bool:
+        if event.is_set():
+            return True
+        if timeout is None:
+            raise RuntimeError('a wait without timeout would never end in virtual time')
+        self.sleep(timeout)
+        return event.is_set()
+
+
+@dataclasses.dataclass
+class PeriodicTask:
+    name: str
+    period_s: float
+    callback: Callable[[], Any]
+    next_deadline: float = 0
+    # pausable tasks don't run while the scheduler is paused
+    pausable: bool = True
+    n_runs: int = 0
+    n_missed: int = 0
+    last_duration_s: float = 0
+    # set by Scheduler.defer, the next run is not before this
+    not_before: float = 0
+
+
+class Scheduler:
+    '''
+        Runs periodic tasks on fixed cadences using monotonic deadlines. The next deadline
+        of a task is its previous deadline plus its period, so the time a task takes doesn't
+        accumulate as drift. If a task overruns whole periods, they are skipped (and counted)
+        instead of running the task back to back to catch up.
+        While paused, only non pausable tasks run, and the scheduler blocks on an event in
+        between, so it doesn't use any CPU
+    '''
+    def __init__(self, clock: Optional[MonotonicClock]=None) -> None:
+        self.clock = MonotonicClock() if clock is None else clock
+        self.tasks: List[PeriodicTask] = list()
+        self._paused = False
+        self._stopped = False
+        self._wake = threading.Event()
+
+    def add_task(self, name: str, period_s: float, callback: Callable[[], Any], start_delay_s: float=0, pausable: bool=True) -> PeriodicTask:
+        if period_s < 0:
+            raise ValueError('period_s should not be negative')
+        task = PeriodicTask(name, period_s, callback, self.clock.monotonic() + start_delay_s, pausable)
+        self.tasks.append(task)
+        self._wake.set()
+        return task
+
+    @property
+    def paused(self) -> bool:
+        return self._paused
+
+    def pause(self) -> None:
+        self._paused = True
+        self._wake.set()
+
+    def resume(self) -> None:
+        # the periods missed while paused are not overruns, the tasks just start again now
+        now = self.clock.monotonic()
+        for task in self.tasks:
+            if task.pausable and task.next_deadline < now:
+                task.next_deadline = now
+        self._paused = False
+        self._wake.set()
+
+    def stop(self) -> None:
+        self._stopped = True
+        self._wake.set()
+
+    def defer(self, task: PeriodicTask, delay_s: float) -> None:
+        ''' the next run of task is at least delay_s from now (for a task that has nothing to do for a while) '''
+        task.not_before = self.clock.monotonic() + delay_s
+        self._wake.set()
+
+    def _next_task(self) -> Optional[PeriodicTask]:
+        # ties are broken by the order in which the tasks were added
+        candidates = (t for t in self.tasks if not (self._paused and t.pausable))
+        return min(candidates, key=lambda t: t.next_deadline, default=None)
+
+    def _run_task(self, task: PeriodicTask) -> None:
+        start = self.clock.monotonic()
+        try:
+            task.callback()
+        except Exception as err:
+            lh.exception(f'Scheduler: La tarea {task.name} fallo ({err})')
+        end = self.clock.monotonic()
+        task.n_runs += 1
+        task.last_duration_s = end - start
+
+        task.next_deadline += task.period_s
+        if task.next_deadline < end:
+            if task.period_s > 0:
+                missed = floor((end - task.next_deadline) / task.period_s) + 1
+                task.n_missed += missed
+                task.next_deadline += missed * task.period_s
+                lh.warning(f'Scheduler: La tarea {task.name} se atraso y se salteo {missed} periodos de {task.period_s} s (duro {task.last_duration_s:.1f} s)')
+            else:
+                # no period, the task runs back to back
+                task.next_deadline = end
+        if task.next_deadline < task.not_before:
+            task.next_deadline = task.not_before
+
+    def run_once(self) -> bool:
+        '''
+            waits for the next due task and runs it. Returns False if the wait was
+            interrupted (by pause, resume, stop or a new task) before any task ran
+        '''
+        self._wake.clear()
+        task = self._next_task()
+        if task is None:
+            # nothing can run (paused). Block until something changes
+            self.clock.wait(self._wake)
+            return False
+        wait_s = task.next_deadline - self.clock.monotonic()
+        if wait_s > 0 and self.clock.wait(self._wake, wait_s):
+            return False
+        self._run_task(task)
+        return True
+
+    def run(self, max_runs: Optional[int]=None) -> None:
+        ''' runs until stop() is called or max_runs tasks have run '''
+        self._stopped = False
+        n = 0
+        while not self._stopped and (max_runs is None or n < max_runs):
+            if self.run_once():
+                n += 1
+
+
+if __name__ == '__main__':
+    s = Scheduler()
+    s.add_task('fast', .2, lambda: print('fast', round(monotonic(), 2)))
+    s.add_task('slow', .5, lambda: (print('slow', round(monotonic(), 2)), sleep(.3)))
+    s.run(max_runs=12)
@@ -0,0 +1,142 @@
+'''
+    Bridge daemon that serves the arduinos of this pi over tcp with the RFC 2217 protocol,
+    so a SystemsManager on another pi drives them with ports like rfc2217://host:7000.
+    The baud rate changes of the client (negotiate_baud_rate) are applied to the local port.
+    Each device serves one client at a time. The local port is opened when the client
+    connects and closed when it leaves, so the arduino resets just like with a local port.
+    There is no authentication and a client drives the pump, the stepper and the servo, so
+    it only listens on localhost unless a bind address is given, and then it should be
+    limited to the pis that run the SystemsManager with --allow (or a firewall / vpn).
+    Run from the RPi directory:
+        python serial_bridge.py /dev/ttyACM0=7000 [/dev/ttyACM1=7001 ...] [--bind 0.0.0.0 --allow 192.168.0.10,192.168.0.11]
+'''
+from __future__ import annotations
+import sys
+import socket
+import argparse
+import threading
+import serial
+import serial.rfc2217
+from typing import Optional, Sequence
+from logging_helper import logger as lh
+
+
+class _Connection:
+    ''' what PortManager writes its telnet negotiation to '''
+    def __init__(self, conn: socket.socket) -> None:
+        self.conn = conn
+        self._lock = threading.Lock()
+
+    def write(self, data: bytes) -> None:
+        # the negotiation and the data of the serial port come from different threads
+        with self._lock:
+            self.conn.sendall(data)
+
+
+class SerialBridge:
+    def __init__(self, device: str, tcp_port: int, host: str='127.0.0.1', baud_rate: int=9600, allow: Optional[Sequence[str]]=None) -> None:
+        ''' allow are the addresses of the clients that can connect, any if None '''
+        self.device = device
+        self.tcp_port = tcp_port
+        self.host = host
+        self.baud_rate = baud_rate
+        self.allow = None if allow is None else frozenset(allow)
+        self._server: Optional[socket.socket] = None
+        self._stop = threading.Event()
+
+    def serve_forever(self) -> None:
+        self._server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._server.bind((self.host, self.tcp_port))
+        self._server.listen(1)
+        self.tcp_port = self._server.getsockname()[1]
+        lh.info(f'Bridge {self.device}: Escuchando en el puerto {self.tcp_port}')
+        while not self._stop.is_set():
+            try:
+                conn, address = self._server.accept()
+            except OSError:
+                break
+            if self.allow is not None and address[0] not in self.allow:
+                lh.warning(f'Bridge {self.device}: Conexion rechazada de {address[0]}:{address[1]}')
+                conn.close()
+                continue
+            lh.info(f'Bridge {self.device}: Conexion de {address[0]}:{address[1]}')
+            try:
+                self._handle(conn)
+            except Exception as err:
+                lh.error(f'Bridge {self.device}: Error en la conexion ({err})')
+            finally:
+                conn.close()
+            lh.info(f'Bridge {self.device}: Conexion terminada')
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._server is not None:
+            self._server.close()
+
+    def _handle(self, conn: socket.socket) -> None:
+        # the responses of the arduino are short lines, they go out right away
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        ser = serial.Serial(self.device, self.baud_rate, timeout=.05)
+        try:
+            out = _Connection(conn)
+            port_manager = serial.rfc2217.PortManager(ser, out)
+            alive = threading.Event()
+            alive.set()
+
+            def serial_to_socket() -> None:
+                while alive.is_set():
+                    try:
+                        data = ser.read(ser.in_waiting or 1)
+                        if data:
+                            out.write(b''.join(port_manager.escape(data)))
+                    except (OSError, serial.SerialException) as err:
+                        lh.error(f'Bridge {self.device}: Error al leer el puerto ({err})')
+                        break
+                alive.clear()
+                try:
+                    conn.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+            reader = threading.Thread(target=serial_to_socket, name=f'bridge_{self.device}', daemon=True)
+            reader.start()
+            try:
+                while alive.is_set():
+                    data = conn.recv(1024)
+                    if not data:
+                        break
+                    ser.write(b''.join(port_manager.filter(data)))
+            finally:
+                alive.clear()
+                reader.join()
+        finally:
+            ser.close()
+
+
+def main(argv: list[str]) -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('devices', nargs='+', help='device=tcp_port')
+    parser.add_argument('--bind', default='127.0.0.1', help='address to listen on (localhost by default)')
+    parser.add_argument('--allow', default=None, help='comma separated addresses of the clients that can connect')
+    args = parser.parse_args(argv)
+    allow = None if args.allow is None else [a.strip() for a in args.allow.split(',') if a.strip()]
+    if args.bind not in ('127.0.0.1', 'localhost', '::1') and allow is None:
+        lh.warning(f'Bridge: Escuchando en {args.bind} sin --allow, cualquiera en la red puede manejar los arduinos')
+    bridges = list()
+    for arg in args.devices:
+        device, _, tcp_port = arg.partition('=')
+        bridges.append(SerialBridge(device, int(tcp_port), args.bind, allow=allow))
+    threads = [threading.Thread(target=b.serve_forever, name=f'bridge_{b.device}', daemon=True) for b in bridges]
+    for t in threads:
+        t.start()
+    try:
+        for t in threads:
+            t.join()
+    except KeyboardInterrupt:
+        for b in bridges:
+            b.stop()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -1,10 +1,15 @@
 import serial
-from time import sleep, time
+from collections import deque
+from time import sleep, time, monotonic
 from typing import List, Optional, Tuple, Any, Union, Literal
 import sys
 import glob
 import json
+import logging
 from logging_helper import logger as lh
+from logging_helper import fields, is_enabled_for
+from telemetry import telemetry as tm
+from halt_control import HaltControl, HaltedError
 
 
 def get_devices() -> List[str]:
@@ -35,6 +40,22 @@ def get_devices() -> List[str]:
             pass
     return result
 
+def is_url(port: str) -> bool:
+    '''
+        ports like rfc2217://host:port (a serial_bridge.py on another pi), socket://host:port
+        or loop:// (loopback, for tests) are opened with serial.serial_for_url instead of as
+        a local device
+    '''
+    return '://' in port
+
+def make_serial(port: str) -> serial.SerialBase:
+    ''' closed serial object of the transport of port '''
+    if is_url(port):
+        return serial.serial_for_url(port, do_not_open=True)
+    res = serial.Serial()
+    res.port = port
+    return res
+
 def try_cast_omit_none(v: Any, t: type) -> Optional[Any]:
     if v is None:
         return None
@@ -49,24 +70,36 @@ class SerialManagerGeneric:
     SEP_CHAR = b' '
     
     def __init__(self, port: str='/dev/ttyS0', baud_rate: int=4800, timeout: int=5, delay_s: int=.15, n_retries: int=3) -> None:
-        devices = get_devices()
-        if port not in devices:
-            raise Exception(f'Port "{port}" is not among de available devices: {devices}')
+        # the port is not validated here, since get_devices() opens every tty of the system.
+        # If it doesn't exist, open() fails listing the available devices
         self.port = port
         self.baud_rate = baud_rate
         self.timeout = timeout
         self.delay_s = delay_s
         self.n_retries = n_retries
 
-        self.serial = serial.Serial()
-        self.serial.port = self.port
+        self._make_serial()
+
+    def _make_serial(self) -> None:
+        self.serial = make_serial(self.port)
         self.serial.baudrate = self.baud_rate
         self.serial.timeout = self.timeout
-        self.serial.write_timeout = self.timeout
+        if isinstance(self.serial, serial.Serial):
+            # not supported by the rfc2217 transport
+            self.serial.write_timeout = self.timeout
         self.serial.bytesize = serial.EIGHTBITS
         self.serial.parity = serial.PARITY_NONE
         self.serial.stopbits = serial.STOPBITS_ONE # probably
 
+    def set_port(self, port: str) -> None:
+        ''' the port has to be closed '''
+        self.port = port
+        if is_url(port) or not isinstance(self.serial, serial.Serial):
+            # the transport may change with the port
+            self._make_serial()
+        else:
+            self.serial.port = port
+
     def close(self, log: bool=True) -> None:
         if self.is_open():
             if log:
@@ -84,23 +117,41 @@ class SerialManagerGeneric:
         return self.serial.is_open
 
     def flush(self) -> None:
+        if not isinstance(self.serial, serial.Serial):
+            # a remote purge waits for the acknowledge of the bridge (polled every 50 ms by
+            # pyserial) before every command. Dropping what already arrived is enough
+            while self.serial.in_waiting:
+                self.serial.read(self.serial.in_waiting)
+            return
         self.serial.reset_input_buffer()
 
     def open(self) -> None:
         if not self.is_open():
             self.close()
-        self.serial.open()
+            # the arduino resets when the port is opened, so it is back at the initial rate
+            self.serial.baudrate = self.baud_rate
+        try:
+            self.serial.open()
+        except serial.SerialException as err:
+            if is_url(self.port):
+                raise
+            devices = get_devices()
+            if self.port not in devices:
+                raise Exception(f'Port "{self.port}" is not among de available devices: {devices}') from err
+            raise
         self.flush()
         lh.info('Serial: Opening serial port')
         sleep(self.delay_s)
 
     def write(self, command: str) -> None:
         self.serial.write(command.encode('utf-8') + SerialManager.END_CHAR)
-        lh.debug(f'Serial write: "{command}"')
+        if is_enabled_for(logging.DEBUG):
+            lh.debug('Serial write: "%s"', command)
 
     def read(self) -> Optional[str]:
         res = self.serial.read_until(SerialManager.END_CHAR)
-        lh.debug(f'Serial read: "{res}"')
+        if is_enabled_for(logging.DEBUG):
+            lh.debug('Serial read: "%s"', res)
         if not res:
             return None
         try:
@@ -112,18 +163,55 @@ class SerialManagerGeneric:
     
 class SerialManager(SerialManagerGeneric):
     RCV_STR = 'rcv'
-    def __init__(self, port: str='/dev/ttyS0', baud_rate: int=4800, timeout: int=5, delay_s: int=0.5) -> None:
+    BAUD_CONFIRM_STR = 'baud_ok'
+    # lines sent during the baud rate negotiation. 'U' is 01010101, the rest covers most bit patterns.
+    # They are kept short so they fit in the 64 bytes rx buffer of the arduino
+    BAUD_TEST_PATTERNS = (
+        'UUUU0123456789abcdefghijklmnopqrstuvwxyz!#$%&()*',
+        '~}|{zyxwvutsrqponmlkjihg`_^]ZYXWVUTSRQPONMLKJ@?<',
+    )
+    def __init__(self, port: str='/dev/ttyS0', baud_rate: int=4800, timeout: int=5, delay_s: int=0.5, halt_control: Optional[HaltControl]=None, baud_rates: Tuple[int, ...]=(), max_error_rate: float=.2) -> None:
+        '''
+            baud_rate: rate of the arduino after a reset
+            baud_rates: rates that negotiate_baud_rate can move to (the arduino firmware must have the baud command).
+                If empty, the rate is never changed
+            max_error_rate: if more than this fraction of the recent commands failed at a negotiated
+                rate, check_error_rate falls back to a lower one
+        '''
         super().__init__(port, baud_rate, timeout, delay_s)
+        self.baud_rates = tuple(sorted(baud_rates, reverse=True))
+        self.max_error_rate = max_error_rate
+        self.baud_window_ms = 2000
+        # results of the last commands attempts (True if failed), to estimate the error rate
+        self._recent_failures: deque = deque(maxlen=50)
+        # if not None, long waits of interruptible commands are cut short by a halt
+        self.halt_control = halt_control
+        self._pending_response = False
+        # commands that failed in a row (after their retries). Used to detect a dead link
+        self.consecutive_failures = 0
         self._hx_n_init_time_s = 0
         self._hx_n_total_time_s = 30
         self._last_hx_n: Optional[int] = None
 
-    def _send_command_wait_response(self, command: str, timeout_long_s: int = 30, use_delay: bool = True) -> Optional[str]:
+    def _discard_pending_response(self) -> None:
+        # the response of an interrupted command is still on its way. Wait for it
+        # so it is not taken as the response of the next command
+        if self._pending_response:
+            self._pending_response = False
+            res = self.read()
+            lh.debug('Serial: Se descarto la respuesta pendiente "%s"', res)
+
+    def _send_command_wait_response(self, command: str, timeout_long_s: int = 30, use_delay: bool = True, interruptible: bool = False) -> Optional[str]:
+        '''
+            if interruptible, the wait for the long response raises HaltedError as soon as the system is halted.
+            Only commands that don't change the state of the hardware should be interruptible
+        '''
         if not self.is_open():
             raise serial.PortNotOpenError()
         if not command:
             return None
         
+        self._discard_pending_response()
         self.flush()
         self.write(command)
         if use_delay:
@@ -133,7 +221,14 @@ class SerialManager(SerialManagerGeneric):
             if timeout_long_s > 0:
                 start_time = time()
                 while (not self.serial.in_waiting) and (abs(time() - start_time) < timeout_long_s):
-                    sleep(.05)
+                    if interruptible and self.halt_control is not None:
+                        try:
+                            self.halt_control.sleep(.05)
+                        except HaltedError:
+                            self._pending_response = True
+                            raise
+                    else:
+                        sleep(.05)
             res = self.read()
 
         if not res:
@@ -145,15 +240,121 @@ class SerialManager(SerialManagerGeneric):
             sleep(self.delay_s)
         return res
 
-    def _send_command_wait_response_retries(self, command: str, timeout_long_s: int=30, use_delay: bool=True, n_retries: Optional[int]=None) -> Optional[str]:
+    def _send_command_wait_response_retries(self, command: str, timeout_long_s: int=30, use_delay: bool=True, n_retries: Optional[int]=None, interruptible: bool=False) -> Optional[str]:
         n_retries = max(self.n_retries if n_retries is None else n_retries, 1)
-        for _ in range(n_retries):
-            res = self._send_command_wait_response(command, timeout_long_s, use_delay)
+        start_time = monotonic()
+        for attempt in range(n_retries):
+            try:
+                res = self._send_command_wait_response(command, timeout_long_s, use_delay, interruptible)
+                self._recent_failures.append(res is None)
+            except (serial.SerialException, OSError) as err:
+                # the link is broken (unplugged, port gone). The port is closed so
+                # is_open() reports it and there is no point in retrying
+                lh.error(f'Serial {self.port}: Error de comunicacion en "{command}" ({err})')
+                self._pending_response = False
+                try:
+                    self.close(log=False)
+                except (serial.SerialException, OSError):
+                    pass
+                tm.emit('command', port=self.port, cmd=command, ok=False, attempts=attempt+1, dt=monotonic()-start_time, error=str(err))
+                self.consecutive_failures += 1
+                return None
             if res is not None:
+                tm.emit('command', port=self.port, cmd=command, ok=True, attempts=attempt+1, dt=monotonic()-start_time)
+                self.consecutive_failures = 0
                 return res
+            tm.emit('retry', port=self.port, cmd=command, attempt=attempt+1)
         print(f': {res}')
+        tm.emit('command', port=self.port, cmd=command, ok=False, attempts=n_retries, dt=monotonic()-start_time)
+        self.consecutive_failures += 1
         return None
 
+    @property
+    def current_baud_rate(self) -> int:
+        return self.serial.baudrate
+
+    @property
+    def error_rate(self) -> float:
+        if not self._recent_failures:
+            return 0
+        return sum(self._recent_failures) / len(self._recent_failures)
+
+    def _try_baud_rate(self, rate: int, n_patterns: int=4) -> bool:
+        '''
+            asks the arduino to move to rate and checks that the test patterns come back intact.
+            The change is only confirmed if all of them do, otherwise the arduino goes back
+            to the current rate on its own after baud_window_ms
+        '''
+        old_rate = self.serial.baudrate
+        res = self._send_command_wait_response(f'baud {rate} {self.baud_window_ms}', use_delay=False)
+        if res != f'OK {rate}':
+            lh.warning(f'Serial {self.port}: El arduino no acepto la velocidad {rate} ("{res}")')
+            return False
+        self.serial.baudrate = rate
+        sleep(.05)
+        self.flush()
+        n_errors = 0
+        for i in range(n_patterns):
+            pattern = SerialManager.BAUD_TEST_PATTERNS[i % len(SerialManager.BAUD_TEST_PATTERNS)]
+            self.write(pattern)
+            if self.read() != pattern:
+                n_errors += 1
+                break
+        if n_errors == 0:
+            self.write(SerialManager.BAUD_CONFIRM_STR)
+            if self.read() == 'OK':
+                self._recent_failures.clear()
+                return True
+        # wait for the arduino to give up and go back to the old rate
+        self.serial.baudrate = old_rate
+        sleep(self.baud_window_ms / 1000 + .1)
+        self.flush()
+        return False
+
+    def negotiate_baud_rate(self, n_patterns: int=4) -> int:
+        '''
+            moves to the highest rate of baud_rates (over the current one) at which the test
+            patterns go through without errors. Returns the rate in use at the end
+        '''
+        start_rate = self.serial.baudrate
+        for rate in self.baud_rates:
+            if rate <= start_rate:
+                break
+            if self._try_baud_rate(rate, n_patterns):
+                break
+        rate = self.serial.baudrate
+        lh.info(f'Serial {self.port}: Velocidad negociada {rate} (inicial {start_rate})')
+        tm.emit('baud', port=self.port, rate=rate, previous=start_rate)
+        return rate
+
+    def check_error_rate(self, min_commands: int=20) -> bool:
+        '''
+            if the error rate at a negotiated rate is over max_error_rate, moves to the next lower
+            rate that works (or the initial one). If no rate works, the port is closed so the
+            link is recovered (the arduino is back at the initial rate after a reset).
+            Returns True if the rate changed
+        '''
+        # the tick may have just closed the port after an error, the link recovery takes it from there
+        if not self.is_open():
+            return False
+        current = self.serial.baudrate
+        if current <= self.baud_rate or len(self._recent_failures) < min_commands or self.error_rate <= self.max_error_rate:
+            return False
+        lh.warning(f'Serial {self.port}: Tasa de errores {self.error_rate:.0%} a {current} baudios. Bajando la velocidad')
+        for rate in sorted(set(r for r in self.baud_rates if r < current) | {self.baud_rate}, reverse=True):
+            try:
+                changed = self._try_baud_rate(rate)
+            except (serial.SerialException, OSError) as err:
+                lh.error(f'Serial {self.port}: Error probando {rate} baudios ({err})')
+                break
+            if changed:
+                tm.emit('baud', port=self.port, rate=rate, previous=current, error_rate=self.error_rate)
+                return True
+        lh.error(f'Serial {self.port}: No se pudo bajar la velocidad. Cerrando el puerto')
+        self.close(log=False)
+        self._recent_failures.clear()
+        return True
+
     def cmd_ok(self, retries: int=5) -> bool:
         res = False
         n = 0
@@ -175,7 +376,7 @@ class SerialManager(SerialManagerGeneric):
             raise TypeError()
         if n < 0:
             raise ValueError()
-        res = self._send_command_wait_response_retries(f'hx {n}')
+        res = self._send_command_wait_response_retries(f'hx {n}', interruptible=True)
         if res:
             try:
                 res = json.loads(res)
@@ -184,7 +385,7 @@ class SerialManager(SerialManagerGeneric):
         if res is None:
             lh.warning('Arduino: Failed hx command')
         else:
-            lh.debug(f'Arduino: Succeeded hx ({res})')
+            lh.debug(fields('Arduino: Succeeded hx', res=res))
         return res
     
     def cmd_hx_single(self, index: int, n: int=20) -> Optional[List[float]]:
@@ -200,7 +401,7 @@ class SerialManager(SerialManagerGeneric):
             raise TypeError()
         if n < 0:
             raise ValueError()
-        res = self._send_command_wait_response_retries(f'hx_single {n} {index}')
+        res = self._send_command_wait_response_retries(f'hx_single {n} {index}', interruptible=True)
         if res:
             try:
                 res = json.loads(res)
@@ -209,7 +410,7 @@ class SerialManager(SerialManagerGeneric):
         if res is None:
             lh.warning('Arduino: Failed hx command')
         else:
-            lh.debug(f'Arduino: Succeeded hx ({res})')
+            lh.debug(fields('Arduino: Succeeded hx', res=res))
         return res
     
     def cmd_hx_n(self) -> Optional[int]:
@@ -224,14 +425,14 @@ class SerialManager(SerialManagerGeneric):
                 return None
             self._hx_n_init_time_s = time()
             self._last_hx_n = res
-            lh.debug(f'Arduino: Succeeded hx_n command with {res}')
+            lh.debug('Arduino: Succeeded hx_n command with %s', res)
             return res
         else:
-            lh.debug(f'Arduino: Used cached hx_n value of {self._last_hx_n}')
+            lh.debug('Arduino: Used cached hx_n value of %s', self._last_hx_n)
             return self._last_hx_n
     
     def cmd_dht(self) -> Optional[Tuple[float, float]]: # hum, temp
-        res = self._send_command_wait_response_retries('dht')
+        res = self._send_command_wait_response_retries('dht', interruptible=True)
         if res:
             try:
                 res = json.loads(res)
@@ -241,7 +442,7 @@ class SerialManager(SerialManagerGeneric):
         if res is None:
             lh.warning('Arduino: Failed dht command')
         else:
-            lh.debug(f'Arduino: Succeeded dht command with {res}')
+            lh.debug('Arduino: Succeeded dht command with %s', res)
         return res
     
     def cmd_stepper(self, steps: int, detach: bool=True) -> Optional[int]:
@@ -257,7 +458,7 @@ class SerialManager(SerialManagerGeneric):
         if res is None:
             lh.warning('Arduino: Failed stepper command')
         else:
-            lh.debug(f'Arduino: Succeeded stepper command with {res}')
+            lh.debug('Arduino: Succeeded stepper command with %s', res)
         return res == detach
     
     def cmd_servo(self, angulo: Optional[int]=None) -> Optional[int]:
@@ -275,7 +476,7 @@ class SerialManager(SerialManagerGeneric):
         if res is None:
             lh.warning('Arduino: Failed servo command')
         else:
-            lh.debug(f'Arduino: Succeeded servo command with {res}')
+            lh.debug('Arduino: Succeeded servo command with %s', res)
         return res
     
     def cmd_pump(self, tiempo: int, intensidad: int) -> bool:
@@ -291,7 +492,7 @@ class SerialManager(SerialManagerGeneric):
         if res is None:
             lh.warning('Arduino: Failed pump command')
         else:
-            lh.debug(f'Arduino: Succeeded pump command')
+            lh.debug('Arduino: Succeeded pump command')
         return res
     
     def cmd_stepper_attach(self, attach: bool):
@@ -301,7 +502,7 @@ class SerialManager(SerialManagerGeneric):
         if res is None:
             lh.warning('Arduino: Failed stepper_attach command')
         else:
-            lh.debug(f'Arduino: Succeeded stepper_attach command with {res}')
+            lh.debug('Arduino: Succeeded stepper_attach command with %s', res)
         return res
     
     def cmd_servo_attach(self, attach: bool):
@@ -311,7 +512,7 @@ class SerialManager(SerialManagerGeneric):
         if res is None:
             lh.warning('Arduino: Failed servo_attach command')
         else:
-            lh.debug(f'Arduino: Succeeded servo_attach command with {res}')
+            lh.debug('Arduino: Succeeded servo_attach command with %s', res)
         return res
         
     
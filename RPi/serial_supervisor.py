@@ -0,0 +1,174 @@
+import glob
+import threading
+from time import monotonic, sleep
+from typing import Callable, Collection, List, Optional, Sequence
+from logging_helper import logger as lh
+from telemetry import telemetry as tm
+from serial_manager import SerialManager, is_url
+
+handshake_cb_t = Callable[[], bool]
+ports_cb_t = Callable[[], Collection[str]]
+# the supervisors of different systems check that a port is free and take it under this lock
+_ports_lock = threading.Lock()
+
+
+class SerialSupervisor:
+    '''
+        Watches the link of a SerialManager and brings it back when it dies.
+        The link is considered dead when the port is closed (pyserial errors close it)
+        or after failure_threshold consecutive commands failed.
+        Recovery escalates through:
+            1. reopening the same port and running the handshake
+            2. looking for the arduino in the other ports that match port_patterns
+               (the port can change name when the USB link drops), except the ports of the
+               other systems (busy_ports), since opening a port resets its arduino
+            3. resetting the arduino through reset_pin (if not None) and trying 1 and 2 again
+        handshake must open the port of the serial manager and check the arduino answers.
+        Recoveries run in a background thread, so the other systems keep running. After a
+        failed recovery the next one waits an exponential backoff
+    '''
+    def __init__(self, serial_manager: SerialManager, handshake: handshake_cb_t, reset_pin: Optional[int]=None, port_patterns: Sequence[str]=('/dev/ttyACM*', '/dev/ttyUSB*'), failure_threshold: int=3, backoff_initial_s: float=10, backoff_max_s: float=300, busy_ports: Optional[ports_cb_t]=None) -> None:
+        if not isinstance(handshake, Callable): raise TypeError()
+        self.sm = serial_manager
+        self.handshake = handshake
+        self.busy_ports = busy_ports
+        self.reset_pin = reset_pin
+        self.port_patterns = tuple(port_patterns)
+        self.failure_threshold = failure_threshold
+        self.backoff_initial_s = backoff_initial_s
+        self.backoff_max_s = backoff_max_s
+
+        self.n_recoveries = 0
+        self.n_failed_recoveries = 0
+        self._backoff_s = backoff_initial_s
+        self._next_attempt = 0
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    @property
+    def link_dead(self) -> bool:
+        return (not self.sm.is_open()) or self.sm.consecutive_failures >= self.failure_threshold
+
+    @property
+    def retry_in_s(self) -> float:
+        ''' seconds until the backoff of the last failed recovery passes '''
+        with self._lock:
+            return max(self._next_attempt - monotonic(), 0.)
+
+    @property
+    def recovering(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def candidate_ports(self) -> List[str]:
+        ''' ports where the arduino could be, the current one first. A remote port is the only candidate '''
+        ports = [self.sm.port]
+        if is_url(self.sm.port):
+            return ports
+        busy = set() if self.busy_ports is None else set(self.busy_ports())
+        for pattern in self.port_patterns:
+            for port in sorted(glob.glob(pattern)):
+                if port not in ports and port not in busy:
+                    ports.append(port)
+        return ports
+
+    def _take_port(self, port: str) -> bool:
+        ''' False if port belongs to another system '''
+        with _ports_lock:
+            if port != self.sm.port and self.busy_ports is not None and port in self.busy_ports():
+                return False
+            self.sm.close(log=False)
+            self.sm.set_port(port)
+        return True
+
+    def _try_handshake(self) -> bool:
+        try:
+            res = bool(self.handshake())
+        except Exception as err:
+            lh.warning(f'Supervisor {self.sm.port}: fallo el handshake ({err})')
+            res = False
+        if res:
+            self.sm.consecutive_failures = 0
+        return res
+
+    def _try_ports(self, stage: str) -> bool:
+        original_port = self.sm.port
+        for port in self.candidate_ports():
+            if not self._take_port(port):
+                # another system took it while this one was trying the previous ports
+                continue
+            start_time = monotonic()
+            ok = self._try_handshake()
+            tm.emit('link_recovery', port=original_port, stage=stage, tried=port, ok=ok, dt=monotonic()-start_time)
+            if ok:
+                if port != original_port:
+                    lh.warning(f'Supervisor: El arduino de {original_port} aparecio en {port}')
+                return True
+        # closed, it doesn't disturb anyone even if another system took it meanwhile
+        self.sm.close(log=False)
+        self.sm.set_port(original_port)
+        return False
+
+    def recover(self) -> bool:
+        ''' runs the recovery in the calling thread. Returns True if the link is back '''
+        start_time = monotonic()
+        port = self.sm.port
+        lh.warning(f'Supervisor {port}: Enlace caido ({self.sm.consecutive_failures} fallos seguidos). Recuperando...')
+        ok = self._try_ports('reopen')
+        if not ok and self.reset_pin is not None:
+            lh.warning(f'Supervisor {port}: Reseteando el arduino (pin {self.reset_pin})')
+            try:
+                from arduino_controller import arduino_reset
+                arduino_reset(self.reset_pin)
+                ok = self._try_ports('reset')
+            except Exception as err:
+                lh.error(f'Supervisor {port}: No se pudo resetear el arduino ({err})')
+
+        dt = monotonic() - start_time
+        with self._lock:
+            if ok:
+                self.n_recoveries += 1
+                self._backoff_s = self.backoff_initial_s
+                self._next_attempt = 0
+                lh.info(f'Supervisor {self.sm.port}: Enlace recuperado en {dt:.1f} s')
+            else:
+                self.n_failed_recoveries += 1
+                self._next_attempt = monotonic() + self._backoff_s
+                lh.critical(f'Supervisor {port}: No se pudo recuperar el enlace en {dt:.1f} s. Nuevo intento en {self._backoff_s:.0f} s')
+                self._backoff_s = min(self._backoff_s * 2, self.backoff_max_s)
+        tm.emit('link_recovered' if ok else 'link_lost', port=self.sm.port, dt=dt)
+        return ok
+
+    def recover_async(self) -> bool:
+        '''
+            starts a recovery in a background thread, unless one is running or the
+            backoff of the last failed one hasn't passed. Returns True if one was started
+        '''
+        with self._lock:
+            if self.recovering or monotonic() < self._next_attempt:
+                return False
+            self._thread = threading.Thread(target=self.recover, name=f'supervisor_{self.sm.port}', daemon=True)
+            self._thread.start()
+        return True
+
+    def join(self, timeout: Optional[float]=None) -> None:
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+
+if __name__ == '__main__':
+    import sys
+    port = sys.argv[1] if len(sys.argv) > 1 else '/dev/ttyACM0'
+    sm = SerialManager(port=port, baud_rate=9600)
+
+    def handshake() -> bool:
+        sm.open()
+        sleep(1)
+        return sm.cmd_ok(retries=1)
+
+    supervisor = SerialSupervisor(sm, handshake)
+    while True:
+        if supervisor.link_dead and not supervisor.recovering:
+            supervisor.recover_async()
+        elif not supervisor.recovering:
+            print(sm.cmd_ok(retries=1), sm.consecutive_failures)
+        sleep(2)
@@ -0,0 +1,506 @@
+'''
+    Offline simulation of the watering strategy. A SystemsManager runs its own loop (the
+    ticks, the intensities, the safety checks, the weight model...) in virtual time against
+    SimulatedArduino, which answers the arduino commands from a model of the pots
+    (evapotranspiration, drainage and the pump). Parameter sets run in parallel with
+    simulate_many, for example to tune the IntensityConfig curves or min_weight_diff.
+    Run from the RPi directory with:
+        python simulator.py [days] [processes]
+'''
+from __future__ import annotations
+import os
+import sys
+import math
+import random
+import logging
+import tempfile
+import dataclasses
+from collections import Counter
+from time import perf_counter
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+from logging_helper import logger as lh
+from telemetry import telemetry as tm
+from scheduler import VirtualClock
+from weight_model import WeightModelInfo
+from dose_controller import DoseControllerInfo
+from systems import SystemInfo, SystemsManager, Position, IntensityConfig, SerialManagerInfo, BalanzasInfo, SamplingInfo, StepperPos
+
+
+# same as system_1 in main.py
+DEFAULT_POSITIONS = (
+    Position(0, 179, IntensityConfig(1600, 3000, 15, 5), IntensityConfig(53, 75, 30, 15)),
+    Position(0, 1, IntensityConfig(1600, 3400, 15, 5), IntensityConfig(55, 80, 30, 15)),
+    Position(4800, 1, IntensityConfig(1700, 3400, 15, 5), IntensityConfig(53, 80, 30, 15)),
+    Position(5000, 172, IntensityConfig(1700, 3000, 15, 5), IntensityConfig(53, 75, 30, 15)),
+    Position(9700, 162, IntensityConfig(1900, 3500, 15, 2), IntensityConfig(53, 80, 30, 15)),
+    Position(9700, 20, IntensityConfig(1800, 3400, 15, 2), IntensityConfig(53, 80, 30, 15)),
+)
+
+
+@dataclasses.dataclass(frozen=True)
+class PlantInfo:
+    ''' model of the pots and the greenhouse. Weights in grams '''
+    dry_grams: float = 450 # pot, soil and plant without water
+    capacity_grams: float = 300 # water the soil holds, the rest drains right away
+    initial_water_grams: float = 200
+    et_grams_per_h: float = 4 # evapotranspiration at midday, 25 C and 50 % of humidity
+    night_et_fraction: float = .2
+    et_spread: float = .15 # relative stdev of the evapotranspiration of each pot
+    stress_fraction: float = .3 # with less water than this fraction of the capacity, the evapotranspiration goes down
+    temp_mean: float = 24 # C
+    temp_amplitude: float = 5
+    hum_mean: float = 55 # %
+    hum_amplitude: float = 15
+    start_hour: float = 0 # time of day at which the simulation starts
+    step_s: float = 60 # integration step
+
+
+@dataclasses.dataclass(frozen=True)
+class SimulatedArduinoInfo:
+    ''' hx711s, pump and timings of the simulated arduino '''
+    offset: float = 100 # raw units
+    slope: float = 2 # raw units per gram
+    noise_raw: float = 3 # stdev of a single hx711 sample
+    spike_probability: float = .005 # of a reading that is far off, for the filters
+    drift_raw_per_c: float = 0 # temperature drift of the offsets
+    max_flow_grams_per_s: float = 40 # pump at 100 %
+    stall_pwm: float = 30 # % under which the pump doesn't move water
+    catch_min: float = .85 # fraction of the water that ends in the pot, between catch_min and 1 for each position
+    command_s: float = .05
+    hx_sample_s: float = .0125 # one sample of one hx711 (80 Hz)
+    dht_s: float = .25
+    stepper_steps_per_s: float = 1000
+    servo_s: float = .3
+
+
+class PotsModel:
+    '''
+        Water content of each pot. It is integrated lazily up to the time asked for, with an
+        evapotranspiration that follows the day (light, temperature and humidity) and goes
+        down when the soil is dry. Also keeps the statistics of the simulation
+    '''
+    def __init__(self, n_pots: int, plant: PlantInfo, goals: Sequence[float], rng: random.Random, start_s: float=0) -> None:
+        self.plant = plant
+        self.n_pots = n_pots
+        self.goals = tuple(goals)
+        self.water = [min(plant.initial_water_grams, plant.capacity_grams)]*n_pots
+        self.et_factors = [max(rng.gauss(1, plant.et_spread), 0) for _ in range(n_pots)]
+        self.time_s = start_s
+        self.delivered_grams = [0.]*n_pots
+        self.drained_grams = [0.]*n_pots
+        self.below_goal_s = [0.]*n_pots
+        self.min_weights = [math.inf]*n_pots
+
+    def climate(self, time_s: float) -> Tuple[float, float, float]:
+        ''' (temp, hum, light) at time_s. The warmest and driest time is 15 hs, light goes from 6 to 18 hs '''
+        plant = self.plant
+        hour = (plant.start_hour + time_s / 3600) % 24
+        phase = math.cos(2 * math.pi * (hour - 15) / 24)
+        temp = plant.temp_mean + plant.temp_amplitude * phase
+        hum = plant.hum_mean - plant.hum_amplitude * phase
+        light = max(math.sin(2 * math.pi * (hour - 6) / 24), 0)
+        return temp, hum, light
+
+    def weights(self) -> List[float]:
+        return [self.plant.dry_grams + w for w in self.water]
+
+    def advance(self, time_s: float) -> None:
+        plant = self.plant
+        stress_grams = plant.stress_fraction * plant.capacity_grams
+        while self.time_s < time_s:
+            dt = min(time_s - self.time_s, plant.step_s)
+            temp, hum, light = self.climate(self.time_s)
+            rate = plant.et_grams_per_h * (plant.night_et_fraction + (1 - plant.night_et_fraction) * light)
+            rate *= max(1 + .05 * (temp - 25) + .01 * (50 - hum), 0)
+            lost = rate * dt / 3600
+            for i in range(self.n_pots):
+                stress = min(self.water[i] / stress_grams, 1) if stress_grams > 0 else 1
+                self.water[i] = max(self.water[i] - lost * self.et_factors[i] * stress, 0)
+                weight = plant.dry_grams + self.water[i]
+                if weight < self.goals[i]:
+                    self.below_goal_s[i] += dt
+                if weight < self.min_weights[i]:
+                    self.min_weights[i] = weight
+            self.time_s += dt
+
+    def add_water(self, index: int, grams: float) -> None:
+        self.delivered_grams[index] += grams
+        self.water[index] += grams
+        excess = self.water[index] - self.plant.capacity_grams
+        if excess > 0:
+            self.drained_grams[index] += excess
+            self.water[index] = self.plant.capacity_grams
+
+
+class SimulatedArduino:
+    '''
+        Stands in for the SerialManager of a system. It answers the cmd_* methods that the
+        SystemsManager uses from the state of the pots, and every command spends its
+        duration in the clock. The pump waters the pot whose position (stepper and servo)
+        the arduino is at
+    '''
+    def __init__(self, positions: Sequence[Position], pots: PotsModel, info: SimulatedArduinoInfo, clock: VirtualClock, rng: random.Random) -> None:
+        self.positions = tuple(positions)
+        self.n_balanzas = len(self.positions)
+        self.pots = pots
+        self.info = info
+        self.clock = clock
+        self.rng = rng
+        self.catch = [rng.uniform(info.catch_min, 1) for _ in range(self.n_balanzas)]
+        self.stepper = 0
+        self.servo = 90
+
+        # what the SystemsManager and the supervisor look at
+        self.port = 'simulated'
+        self.baud_rates: Tuple[int, ...] = ()
+        self.consecutive_failures = 0
+        self._open = False
+
+        self.pumped_grams = 0.
+        self.n_pumps = [0]*self.n_balanzas
+
+    def _spend(self, s: float) -> None:
+        self.clock.sleep(s)
+        self.pots.advance(self.clock.monotonic())
+
+    def _raw(self, weights: Sequence[float], n: int) -> List[float]:
+        ''' readings of the hx711s with the given loads, each the mean of n samples '''
+        info = self.info
+        rng = self.rng
+        temp, _, _ = self.pots.climate(self.clock.monotonic())
+        offset = info.offset + info.drift_raw_per_c * (temp - 25)
+        noise = info.noise_raw / math.sqrt(max(n, 1))
+        res = [offset + info.slope * w + rng.gauss(0, noise) for w in weights]
+        for i in range(len(res)):
+            if rng.random() < info.spike_probability:
+                res[i] += rng.choice((-1, 1)) * 100 * info.noise_raw
+        return res
+
+    def set_port(self, port: str) -> None:
+        self.port = port
+
+    def open(self) -> None:
+        self._open = True
+
+    def close(self, log: bool=True) -> None:
+        self._open = False
+
+    def is_open(self) -> bool:
+        return self._open
+
+    def flush(self) -> None:
+        pass
+
+    @property
+    def error_rate(self) -> float:
+        return 0
+
+    def check_error_rate(self, min_commands: int=20) -> bool:
+        return False
+
+    def negotiate_baud_rate(self, n_patterns: int=4) -> int:
+        return 0
+
+    def cmd_ok(self, retries: int=5) -> bool:
+        self._spend(self.info.command_s)
+        return True
+
+    def cmd_hx_n(self) -> Optional[int]:
+        self._spend(self.info.command_s)
+        return self.n_balanzas
+
+    def cmd_hx(self, n: int=20) -> Optional[List[float]]:
+        self._spend(self.info.command_s + n * self.n_balanzas * self.info.hx_sample_s)
+        return self._raw(self.pots.weights(), n)
+
+    def cmd_hx_single(self, index: int, n: int=20) -> Optional[float]:
+        if index < 0 or index >= self.n_balanzas:
+            raise ValueError()
+        self._spend(self.info.command_s + n * self.info.hx_sample_s)
+        return self._raw((self.pots.weights()[index],), n)[0]
+
+    def cmd_dht(self) -> Optional[Tuple[float, float]]: # hum, temp
+        self._spend(self.info.command_s + self.info.dht_s)
+        temp, hum, _ = self.pots.climate(self.clock.monotonic())
+        return round(hum, 1), round(temp, 1)
+
+    def cmd_stepper(self, steps: int, detach: bool=True) -> Optional[int]:
+        if not isinstance(steps, int) or not isinstance(detach, bool):
+            raise TypeError()
+        self._spend(self.info.command_s + abs(steps) / self.info.stepper_steps_per_s)
+        self.stepper += steps
+        return True
+
+    def cmd_servo(self, angulo: Optional[int]=None) -> Optional[int]:
+        if angulo is not None:
+            if not isinstance(angulo, int):
+                raise TypeError()
+            if angulo < 1 or angulo > 179:
+                raise ValueError()
+            self.servo = angulo
+        self._spend(self.info.command_s + self.info.servo_s)
+        return self.servo
+
+    def cmd_pump(self, tiempo: int, intensidad: int) -> bool:
+        # the same checks as the real command, so a curve that gives invalid values fails here too
+        if not all(isinstance(v, int) for v in (tiempo, intensidad)):
+            raise TypeError()
+        if tiempo <= 0 or (intensidad <= 0 or intensidad > 100):
+            raise ValueError()
+        self._spend(self.info.command_s + tiempo / 1000)
+        flow = self.info.max_flow_grams_per_s * max((intensidad - self.info.stall_pwm) / (100 - self.info.stall_pwm), 0)
+        grams = flow * tiempo / 1000
+        self.pumped_grams += grams
+        for i, p in enumerate(self.positions):
+            if p.stepper == self.stepper and p.servo == self.servo:
+                self.n_pumps[i] += 1
+                self.pots.add_water(i, grams * self.catch[i])
+                break
+        return True
+
+    def cmd_stepper_attach(self, attach: bool):
+        self._spend(self.info.command_s)
+        return str(int(attach))
+
+    def cmd_servo_attach(self, attach: bool):
+        self._spend(self.info.command_s)
+        return str(int(attach))
+
+
+class SimulatedMaintenance:
+    ''' Maintenance without the button and the led '''
+    def begin_maintenance(self, callback: Callable[[], None]) -> None:
+        pass
+
+    def end_maintenance(self, callback: Callable[[], None]) -> None:
+        pass
+
+    def led_on(self, force: bool=False) -> None:
+        pass
+
+    def led_pulse(self, force: bool=False) -> None:
+        pass
+
+    def led_blink(self, force: bool=False) -> None:
+        pass
+
+
+@dataclasses.dataclass(frozen=True)
+class SimulationParams:
+    '''
+        A strategy to simulate. tick_period_s is 0 (back to back) in main.py, which is
+        simulated too, but it runs a few times slower since there are many more ticks
+    '''
+    name: str = 'default'
+    days: float = 30
+    seed: int = 0
+    positions: tuple[Position, ...] = DEFAULT_POSITIONS
+    grams_goals: tuple[float, ...] = (670.0,)*6
+    grams_threshold: float = 0
+    not_watered: tuple[int, ...] = (0, 1)
+    min_weight_diff: float = 5
+    tick_period_s: float = 300
+    dht_period_s: float = 60
+    n_statistics: int = 50
+    n_arduino: int = 10
+    weight_model_info: Optional[WeightModelInfo] = None
+    sampling_info: Optional[SamplingInfo] = None
+    dose_controller_info: Optional[DoseControllerInfo] = None
+    plant: PlantInfo = PlantInfo()
+    arduino: SimulatedArduinoInfo = SimulatedArduinoInfo()
+    log_level: int = logging.CRITICAL + 1 # the ticks of a month would flood the logs
+
+    def __post_init__(self) -> None:
+        if not (len(self.positions) == len(self.grams_goals)):
+            raise IndexError('positions and grams_goals should be of the same length')
+
+
+@dataclasses.dataclass
+class SimulationReport:
+    ''' outcome of a simulation. The lists have one value per pot '''
+    name: str
+    days: float
+    wall_s: float
+    waterable: List[bool]
+    n_ticks: int
+    n_skipped_ticks: int
+    n_failed_ticks: int
+    n_waterings: List[int]
+    water_grams: List[float] # that ended in each pot
+    pumped_grams: float # in total, including what missed the pots
+    drained_grams: List[float]
+    hours_below_goal: List[float]
+    min_weights: List[float]
+    safety_trips: Dict[str, int]
+    inhabilitated: List[bool]
+
+    @property
+    def speedup(self) -> float:
+        return self.days * 86400 / self.wall_s if self.wall_s > 0 else math.inf
+
+    def waterable_values(self, values: Sequence[float]) -> List[float]:
+        return [v for v, w in zip(values, self.waterable) if w]
+
+
+class _TelemetryCounter:
+    ''' counts the telemetry records of a simulation '''
+    def __init__(self) -> None:
+        self.kinds: Counter = Counter()
+        self.safety_trips: Counter = Counter()
+
+    def __call__(self, record: dict) -> None:
+        self.kinds[record['kind']] += 1
+        if record['kind'] == 'safety_check_failed':
+            self.safety_trips[record['reason']] += 1
+
+
+def scaled_positions(positions: Sequence[Position], time_factor: float=1, pwm_factor: float=1) -> tuple[Position, ...]:
+    ''' positions with the watering time and pwm curves scaled (the pwm is kept under 100 %) '''
+    def scale(c: IntensityConfig, factor: float, limit: Optional[int]=None) -> IntensityConfig:
+        initial, final = round(c.initial_value * factor), round(c.final_value * factor)
+        if limit is not None:
+            initial, final = min(initial, limit), min(final, limit)
+        return dataclasses.replace(c, initial_value=initial, final_value=final)
+    return tuple(
+        dataclasses.replace(p, water_time_cruve=scale(p.water_time_cruve, time_factor), water_pwm_curve=scale(p.water_pwm_curve, pwm_factor, 100))
+        for p in positions
+    )
+
+
+def _system_info(params: SimulationParams, arduino: SimulatedArduinoInfo, savedir: str) -> SystemInfo:
+    ''' the system of the simulation, calibrated with the true offset and slope of the simulated hx711s '''
+    n = len(params.positions)
+    balanzas_file = os.path.join(savedir, 'simulated_balanzas.json')
+    with open(balanzas_file, 'w') as f:
+        f.write(
+            '{"offsets": %s, "slopes": %s, "offsets_error": %s, "slopes_error": %s}'
+            % ([arduino.offset]*n, [arduino.slope]*n, [.1]*n, [.001]*n)
+        )
+    return SystemInfo(
+        name='simulated',
+        n_balanzas=n,
+        positions=params.positions,
+        stepper_pos=StepperPos(save_file=os.path.join(savedir, 'simulated_stepper.json')),
+        sm_info=SerialManagerInfo(port='simulated'),
+        balanzas_info=BalanzasInfo(save_file=balanzas_file, n_statistics=params.n_statistics, n_arduino=params.n_arduino),
+        grams_goals=params.grams_goals,
+        grams_threshold=params.grams_threshold,
+        savedir=savedir,
+        tick_period_s=params.tick_period_s,
+        not_watered=params.not_watered,
+        weight_model_info=params.weight_model_info,
+        sampling_info=params.sampling_info,
+        dose_controller_info=params.dose_controller_info
+    )
+
+
+def simulate(params: SimulationParams, setup: Optional[Callable[[SystemsManager], None]]=None) -> SimulationReport:
+    '''
+        runs the loop of a SystemsManager for params.days of virtual time. setup is called with
+        the manager before the loop starts (to add periodic tasks, stop it earlier, ...)
+    '''
+    wall_start = perf_counter()
+    rng = random.Random(params.seed)
+    clock = VirtualClock()
+    counter = _TelemetryCounter()
+
+    # quiet: no logs, no progress bars and the telemetry only goes to the counter
+    log_level, persist, tqdm_disable = lh.level, tm.persist, os.environ.get('TQDM_DISABLE')
+    lh.setLevel(params.log_level)
+    tm.persist = False
+    os.environ['TQDM_DISABLE'] = '1'
+    tm.add_listener(counter)
+    try:
+        with tempfile.TemporaryDirectory(prefix='labino_sim_') as savedir:
+            system = _system_info(params, params.arduino, savedir)
+            pots = PotsModel(system.n_balanzas, params.plant, params.grams_goals, rng, clock.monotonic())
+            arduino = SimulatedArduino(params.positions, pots, params.arduino, clock, rng)
+            manager = SystemsManager((system,), SimulatedMaintenance(), clock=clock, serial_managers=(arduino,))
+            manager.min_weight_diff = params.min_weight_diff
+            manager.dht_period_s = params.dht_period_s
+            manager.begin(deadline_s=60)
+
+            end_s = clock.monotonic() + params.days * 86400
+            def check_end() -> None:
+                if clock.monotonic() >= end_s:
+                    manager.scheduler.stop()
+            manager.add_periodic_task('simulation_end', 60, check_end, pausable=False)
+            if setup is not None:
+                setup(manager)
+            manager.loop()
+            pots.advance(clock.monotonic())
+            inhabilitated = list(manager.inhabilitated_balanzas[0])
+    finally:
+        tm.remove_listener(counter)
+        tm.persist = persist
+        lh.setLevel(log_level)
+        if tqdm_disable is None:
+            del os.environ['TQDM_DISABLE']
+        else:
+            os.environ['TQDM_DISABLE'] = tqdm_disable
+
+    waterable = [i not in params.not_watered for i in range(system.n_balanzas)]
+    return SimulationReport(
+        name=params.name,
+        days=params.days,
+        wall_s=perf_counter() - wall_start,
+        waterable=waterable,
+        n_ticks=counter.kinds['tick'],
+        n_skipped_ticks=counter.kinds['tick_skipped'],
+        n_failed_ticks=counter.kinds['tick_failed'],
+        n_waterings=arduino.n_pumps,
+        water_grams=pots.delivered_grams,
+        pumped_grams=arduino.pumped_grams,
+        drained_grams=pots.drained_grams,
+        hours_below_goal=[s / 3600 for s in pots.below_goal_s],
+        min_weights=pots.min_weights,
+        safety_trips=dict(counter.safety_trips),
+        inhabilitated=inhabilitated
+    )
+
+
+def simulate_many(params: Sequence[SimulationParams], processes: Optional[int]=None) -> List[SimulationReport]:
+    ''' runs each simulation in its own process (as many at once as processes, all the cpus by default) '''
+    if processes == 1:
+        return [simulate(p) for p in params]
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        return list(executor.map(simulate, params))
+
+
+def format_reports(reports: Sequence[SimulationReport]) -> str:
+    '''
+        a line per simulation, from the least to the most time below goal. Water is what was
+        pumped, below goal is the mean over the watered pots and worst is its maximum
+    '''
+    header = f'{"name":<24} {"water [l]":>9} {"drained [l]":>11} {"waterings":>9} {"below goal [h]":>14} {"worst [h]":>9} {"trips":>5} {"ticks":>6} {"speedup":>8}'
+    lines = [header, '-'*len(header)]
+    def mean_below_goal(r: SimulationReport) -> float:
+        values = r.waterable_values(r.hours_below_goal)
+        return sum(values) / len(values) if values else 0.
+    for r in sorted(reports, key=mean_below_goal):
+        below_goal = r.waterable_values(r.hours_below_goal)
+        lines.append(
+            f'{r.name:<24} {r.pumped_grams/1000:>9.2f} {sum(r.drained_grams)/1000:>11.2f} {sum(r.n_waterings):>9} '
+            f'{mean_below_goal(r):>14.1f} {max(below_goal, default=0):>9.1f} {sum(r.safety_trips.values()):>5} '
+            f'{r.n_ticks:>6} {r.speedup:>7.0f}x'
+        )
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    days = float(sys.argv[1]) if len(sys.argv) > 1 else 30
+    processes = int(sys.argv[2]) if len(sys.argv) > 2 else None
+    grid = [
+        SimulationParams(name=f'time x{time_factor} diff {diff}', days=days, positions=scaled_positions(DEFAULT_POSITIONS, time_factor=time_factor), min_weight_diff=diff)
+        for time_factor in (.75, 1, 1.5)
+        for diff in (2, 5, 10)
+    ]
+    grid += [
+        SimulationParams(name=f'dose, {rate_sigmas} sigmas', days=days, dose_controller_info=DoseControllerInfo(rate_sigmas=rate_sigmas))
+        for rate_sigmas in (0, 1, 2)
+    ]
+    start = perf_counter()
+    reports = simulate_many(grid, processes)
+    print(format_reports(reports))
+    print(f'{len(grid)} simulations of {days:g} days in {perf_counter() - start:.1f} s')
@@ -1,9 +1,17 @@
+from importlib import import_module
 from ._check_dependencies import uncertainties_exists
 
 from .smart_array import SmartArray, SmartList
+from .smart_matrix import SmartMatrix
+from .expression import fused
 if uncertainties_exists:
-    from .uncertainties_array import UncertaintiesArray, UncertaintiesList
-    __all__ = ['smart_array', 'uncertainties_array']
+    __all__ = ['smart_array', 'smart_matrix', 'expression', 'uncertainties_array']
 else:
-    __all__ = ['smart_array']
+    __all__ = ['smart_array', 'smart_matrix', 'expression']
 
+def __getattr__(name: str):
+    # uncertainties is only imported when UncertaintiesArray is first needed
+    if uncertainties_exists and name in ('UncertaintiesArray', 'UncertaintiesList', 'uncertainties_array'):
+        module = import_module('.uncertainties_array', __name__)
+        return module if name == 'uncertainties_array' else getattr(module, name)
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
@@ -1,5 +1,4 @@
-try:
-    import uncertainties
-    uncertainties_exists = True
-except ModuleNotFoundError:
-    uncertainties_exists = False
\ No newline at end of file
+from importlib.util import find_spec
+
+# only checks that uncertainties is installed, without importing it (it is imported on first use)
+uncertainties_exists = find_spec('uncertainties') is not None
@@ -1,16 +1,22 @@
+import sys
 from typing import Iterable, Optional, Union, Tuple, Callable
 from ._check_dependencies import uncertainties_exists
 
-if uncertainties_exists:
-    from uncertainties.core import AffineScalarFunc as ufloat_t
-    scalar_t = Union[bool, int, float, complex, ufloat_t]
-    scalar_type_list = (bool, int, float, complex, ufloat_t)
-else:
-    scalar_t = Union[bool, int, float, complex]
-    scalar_type_list = (bool, int, float, complex)
+scalar_t = Union[bool, int, float, complex] # or a ufloat if uncertainties is used
+_base_scalar_type_list = (bool, int, float, complex)
+scalar_type_list = _base_scalar_type_list
+
+def _scalar_types() -> Tuple[type, ...]:
+    # ufloats can only exist once uncertainties has been imported, so there is no
+    # need to import it here just to check types
+    global scalar_type_list
+    if scalar_type_list is _base_scalar_type_list and uncertainties_exists and 'uncertainties.core' in sys.modules:
+        from uncertainties.core import AffineScalarFunc as ufloat_t
+        scalar_type_list = _base_scalar_type_list + (ufloat_t,)
+    return scalar_type_list
 
 def _generic_binary_op(a: Iterable, b: Union[Iterable, scalar_t], op: Callable, force_type: Optional[type]=None) -> Tuple: # type: ignore
-    if isinstance(b, scalar_type_list):
+    if isinstance(b, _scalar_types()):
         return tuple(op(e,b) for e in a)
     elif isinstance(b, Iterable):
         if not len(a) == len(b):
@@ -22,7 +28,7 @@ def _generic_binary_op(a: Iterable, b: Union[Iterable, scalar_t], op: Callable,
     raise TypeError()
 
 def _generic_binary_op_rightsided(b: Union[Iterable, scalar_t], a: Iterable, op: Callable, force_type: Optional[type]=None) -> Tuple: # type: ignore
-    if isinstance(b, scalar_type_list):
+    if isinstance(b, _scalar_types()):
         return tuple(op(b,e) for e in a)
     elif isinstance(b, Iterable):
         if not len(a) == len(b):
@@ -37,7 +43,7 @@ def _generic_unary_op(a: Iterable, op) -> Tuple: # type: ignore
     return tuple(op(e) for e in a)
 
 def _generic_binary_logic_op(a: Iterable, b: Union[Iterable, scalar_t], op: Callable, force_type: Optional[type]=None) -> Tuple: # type: ignore
-    if isinstance(b, scalar_type_list):
+    if isinstance(b, _scalar_types()):
         return tuple(op(e,b) for e in a)
     elif isinstance(b, Iterable):
         if not len(a) == len(b):
@@ -49,7 +55,7 @@ def _generic_binary_logic_op(a: Iterable, b: Union[Iterable, scalar_t], op: Call
     raise TypeError()
 
 def _generic_binary_logic_op_rightsided(b: Union[Iterable, scalar_t], a: Iterable, op: Callable, force_type: Optional[type]=None) -> Tuple: # type: ignore
-    if isinstance(b, scalar_type_list):
+    if isinstance(b, _scalar_types()):
         return tuple(op(b,e) for e in a)
     elif isinstance(b, Iterable):
         if not len(a) == len(b):
@@ -0,0 +1,153 @@
+'''
+    Microbenchmark of the array operations done in a tick (see SystemsManager.tick_single
+    and Balanzas.read_stats_raw), on arrays of the size of a system (6 balanzas).
+    Run from the RPi directory with:
+        python -m smart_arrays.benchmark [n_balanzas] [n_repeats] [--baseline REF]
+    With --baseline, the same cases are also run against the smart_arrays of the git
+    revision REF (for example the commit before a change), and both times are printed.
+    The cases that the old version can't run are left empty
+'''
+import os
+import sys
+import json
+import random
+import shutil
+import timeit
+import argparse
+import tempfile
+import subprocess
+from typing import Callable, Dict, List, Tuple
+from smart_arrays import SmartArray
+try:
+    from smart_arrays import fused
+except ImportError:
+    # older versions of smart_arrays, to compare against
+    fused = None
+try:
+    from smart_arrays import SmartMatrix
+except ImportError:
+    SmartMatrix = None
+from smart_arrays._check_dependencies import uncertainties_exists
+
+
+def tick_cases(n: int) -> Dict[str, Callable[[], object]]:
+    raw = tuple(random.gauss(1300, 5) for _ in range(n))
+    weights = SmartArray(tuple(random.gauss(650, 20) for _ in range(n)), float)
+    last_weights = SmartArray(tuple(random.gauss(650, 20) for _ in range(n)), float)
+    goals = SmartArray((670.0,)*n, float)
+    watered = weights < goals
+    q1 = SmartArray(tuple(random.gauss(1295, 1) for _ in range(n)), float)
+    q3 = SmartArray(tuple(random.gauss(1305, 1) for _ in range(n)), float)
+
+    cases = {
+        'construct (hx read)': lambda: SmartArray(raw),
+        'to water (means < goals - threshold)': lambda: weights < (goals - 0.0),
+        'weight diff (abs(w - last))': lambda: abs(weights - last_weights),
+        'intensities ((watered * (diff < 5)).int())': lambda: (watered * (abs(weights - last_weights) < 5)).int(),
+        'iqr bounds (q1 - 1.5*(q3 - q1))': lambda: (q1 - 1.5 * (q3 - q1), q3 + 1.5 * (q3 - q1)),
+        'zeros': lambda: SmartArray((0.0,)*n, int),
+        'any (generator)': lambda: any(w > 700 for w in weights),
+        'sum (generator)': lambda: sum(w < 0 for w in weights),
+        'iterate': lambda: [w for w in weights],
+    }
+    rows = [SmartArray(tuple(random.gauss(1300, 5) for _ in range(n)), float) for _ in range(20)]
+    def acquire_lists():
+        vals = list()
+        for r in rows:
+            vals.append(r)
+        return tuple(sorted(v) for v in zip(*vals))
+    cases['acquire 20 rows (list + zip)'] = acquire_lists
+    if SmartMatrix is not None:
+        def acquire_matrix():
+            vals = SmartMatrix(n, 20, float)
+            for r in rows:
+                vals.append_row(r)
+            return tuple(sorted(c) for c in vals.columns())
+        cases['acquire 20 rows (SmartMatrix)'] = acquire_matrix
+        history = SmartMatrix(n, 30, float, ring=True, rows=rows + rows)
+        cases['history column mean'] = lambda: history.column(0).mean()
+        cases['history means (axis=0)'] = lambda: history.mean(axis=0)
+    if hasattr(SmartArray, 'any'):
+        cases['any ((w > lim).any())'] = lambda: (weights > 700).any()
+        cases['sum ((w < 0).sum())'] = lambda: (weights < 0).sum()
+        cases['mean and std'] = lambda: (weights.mean(), weights.std(ddof=1))
+        cases['select (mask.nonzero())'] = lambda: (watered & (weights > 600)).nonzero()
+    if fused is not None:
+        intensities = fused(lambda watered, weights, last_weights, min_diff: (watered * (abs(weights - last_weights) < min_diff)).int())
+        iqr_bounds = fused(lambda q1, q3: (q1 - 1.5 * (q3 - q1), q3 + 1.5 * (q3 - q1)))
+        cases['intensities, fused'] = lambda: intensities(watered, weights, last_weights, 5)
+        cases['iqr bounds, fused'] = lambda: iqr_bounds(q1, q3)
+    if uncertainties_exists:
+        from smart_arrays import UncertaintiesArray
+        stdevs = SmartArray(tuple(abs(random.gauss(1, .2)) for _ in range(n)), float)
+        offsets = UncertaintiesArray(tuple(random.gauss(100, 1) for _ in range(n)), (.1,)*n)
+        slopes = UncertaintiesArray(tuple(random.gauss(2, .01) for _ in range(n)), (.001,)*n)
+        values = (UncertaintiesArray(q1, stdevs) - offsets) / slopes
+        cases['calibrate ((raw - offsets) / slopes)'] = lambda: (UncertaintiesArray(q1, stdevs) - offsets) / slopes
+        def calibrate_inplace():
+            v = UncertaintiesArray(q1, stdevs)
+            v -= offsets
+            v /= slopes
+            return v
+        if hasattr(UncertaintiesArray, '__isub__'):
+            cases['calibrate, in place'] = calibrate_inplace
+        cases['values() and errors()'] = lambda: (values.values(), values.errors())
+    return cases
+
+def run(n: int=6, repeats: int=5, number: int=2000) -> List[Tuple[str, float]]:
+    ''' returns the best time per call in microseconds of each case '''
+    res = list()
+    for name, case in tick_cases(n).items():
+        best = min(timeit.repeat(case, number=number, repeat=repeats))
+        res.append((name, best / number * 1e6))
+    return res
+
+
+def run_baseline(ref: str, n: int=6, repeats: int=5) -> List[Tuple[str, float]]:
+    ''' runs the same cases against the smart_arrays of the git revision ref, in another process '''
+    package_dir = os.path.dirname(os.path.abspath(__file__))
+    def git(*args: str) -> bytes:
+        return subprocess.run(('git',) + args, cwd=package_dir, capture_output=True, check=True).stdout
+    with tempfile.TemporaryDirectory() as tmp:
+        old_dir = os.path.join(tmp, 'smart_arrays')
+        os.makedirs(old_dir)
+        for name in git('ls-tree', '--name-only', ref, './').decode().split():
+            if name.endswith('.py'):
+                with open(os.path.join(old_dir, name), 'wb') as f:
+                    f.write(git('show', f'{ref}:./{name}'))
+        # this benchmark, so both versions run the same cases
+        shutil.copy(os.path.abspath(__file__), os.path.join(old_dir, 'benchmark.py'))
+        out = subprocess.run((sys.executable, '-m', 'smart_arrays.benchmark', str(n), str(repeats), '--json'),
+                             cwd=tmp, capture_output=True, check=True, text=True).stdout
+    return [(name, us) for name, us in json.loads(out)]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Microbenchmark of the array operations of a tick')
+    parser.add_argument('n_balanzas', nargs='?', type=int, default=6)
+    parser.add_argument('repeats', nargs='?', type=int, default=5)
+    parser.add_argument('--baseline', metavar='REF', help='git revision to compare against, for example HEAD~1')
+    parser.add_argument('--json', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    n, repeats = args.n_balanzas, args.repeats
+    results = run(n, repeats)
+    if args.json:
+        print(json.dumps(results))
+        sys.exit(0)
+    baseline = dict(run_baseline(args.baseline, n, repeats)) if args.baseline else None
+    width = max(len(name) for name, _ in results)
+    print(f'{n} balanzas, best of {repeats}')
+    if baseline is None:
+        for name, us in results:
+            print(f'{name:<{width}}  {us:8.2f} us')
+        print(f'{"total":<{width}}  {sum(us for _, us in results):8.2f} us')
+    else:
+        print(f'{"":<{width}}  {args.baseline[:11]:>11}  {"current":>11}  speedup')
+        for name, us in results:
+            old = baseline.get(name)
+            old_str = f'{old:8.2f} us' if old is not None else ''
+            ratio = f'  {old / us:6.1f}x' if old is not None else ''
+            print(f'{name:<{width}}  {old_str:>11}  {us:8.2f} us{ratio}')
+        # only the cases that both versions run
+        common = [(baseline[name], us) for name, us in results if name in baseline]
+        print(f'{"total (common cases)":<{width}}  {sum(o for o, _ in common):8.2f} us  {sum(us for _, us in common):8.2f} us')
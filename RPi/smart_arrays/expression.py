@@ -0,0 +1,279 @@
+from __future__ import annotations
+import sys
+from typing import Any, Callable, Dict, List, Tuple, Union
+from .smart_array import SmartArray, scalar_type_list
+from ._utils import calculate_dominant_type
+
+# kind of the ufloat elements of an UncertaintiesArray in the dtype inference
+_UFLOAT = 'ufloat'
+
+_arithmetic_ops = {'add': '+', 'sub': '-', 'mul': '*', 'truediv': '/', 'floordiv': '//', 'pow': '**', 'mod': '%'}
+_comparison_ops = {'eq': '==', 'ne': '!=', 'lt': '<', 'gt': '>', 'le': '<=', 'ge': '>='}
+_unary_ops = {'neg': '-', 'pos': '+', 'invert': '~'}
+# traces kept by each fused function (one per combination of argument dtypes)
+_MAX_TRACES = 16
+
+
+def _is_uncertainties_array(v: Any) -> bool:
+    # only possible if uncertainties_array was imported, which is checked without importing it
+    module = sys.modules.get('smart_arrays.uncertainties_array')
+    return module is not None and isinstance(v, module.UncertaintiesArray)
+
+def _wrap(v: Any) -> Expr:
+    return v if isinstance(v, Expr) else Leaf(v)
+
+
+class Expr:
+    '''
+        Array expression traced by fused. Operations on an Expr don't compute anything,
+        they build a tree that is compiled into a single pass over the elements, with the
+        same dtype rules and casts as the eager operators at every node
+    '''
+    __slots__ = ()
+
+    def int(self) -> Expr:
+        return Cast(int, self)
+
+    def float(self) -> Expr:
+        return Cast(float, self)
+
+    def bool(self) -> Expr:
+        return Cast(bool, self)
+
+    def __abs__(self) -> Expr:
+        return Unary('abs', self)
+
+    def __neg__(self) -> Expr:
+        return Unary('neg', self)
+
+    def __pos__(self) -> Expr:
+        return Unary('pos', self)
+
+    def __invert__(self) -> Expr:
+        return Unary('invert', self)
+
+    __hash__ = None
+
+
+def _add_binary_ops() -> None:
+    def make(name: str, reflected: bool):
+        if reflected:
+            return lambda self, other: Binary(name, _wrap(other), self)
+        return lambda self, other: Binary(name, self, _wrap(other))
+    for name in _arithmetic_ops:
+        setattr(Expr, f'__{name}__', make(name, False))
+        setattr(Expr, f'__r{name}__', make(name, True))
+    for name in _comparison_ops:
+        setattr(Expr, f'__{name}__', make(name, False))
+
+_add_binary_ops()
+
+
+class Leaf(Expr):
+    __slots__ = ('value',)
+
+    def __init__(self, value: Any) -> None:
+        self.value = value
+
+
+class Binary(Expr):
+    __slots__ = ('op', 'left', 'right')
+
+    def __init__(self, op: str, left: Expr, right: Expr) -> None:
+        self.op = op
+        self.left = left
+        self.right = right
+
+
+class Unary(Expr):
+    __slots__ = ('op', 'operand')
+
+    def __init__(self, op: str, operand: Expr) -> None:
+        self.op = op
+        self.operand = operand
+
+
+class Cast(Expr):
+    __slots__ = ('dtype', 'operand')
+
+    def __init__(self, dtype: type, operand: Expr) -> None:
+        self.dtype = dtype
+        self.operand = operand
+
+
+class _Arg:
+    ''' placeholder for an argument of a fused function while it is traced '''
+    __slots__ = ('index', 'kind', 'is_array')
+
+    def __init__(self, index: int, kind: Any, is_array: bool) -> None:
+        self.index = index
+        self.kind = kind
+        self.is_array = is_array
+
+
+class _Compiler:
+    ''' turns a tree into the source of a function of one element of each array '''
+    def __init__(self) -> None:
+        self.scalars: List[Any] = list()
+
+    def leaf(self, value: Any) -> Tuple[str, Any]:
+        if isinstance(value, _Arg):
+            return (f'a{value.index}' if value.is_array else f'p{value.index}'), value.kind
+        if isinstance(value, SmartArray) or _is_uncertainties_array(value):
+            # it would be frozen into the trace
+            raise TypeError('arrays can\'t be captured by a fused function, pass them as arguments')
+        if isinstance(value, scalar_type_list):
+            kind = type(value)
+        elif hasattr(value, 'nominal_value') and hasattr(value, 'std_dev'):
+            kind = _UFLOAT
+        else:
+            raise TypeError(f'{type(value)} can\'t be used in an expression')
+        self.scalars.append(value)
+        return f's{len(self.scalars)-1}', kind
+
+    def compile(self, node: Expr) -> Tuple[str, Any]:
+        ''' returns the source and the dtype (or _UFLOAT) of the node '''
+        if isinstance(node, Leaf):
+            return self.leaf(node.value)
+        if isinstance(node, Cast):
+            src, _ = self.compile(node.operand)
+            return f'{node.dtype.__name__}({src})', node.dtype
+        if isinstance(node, Unary):
+            src, kind = self.compile(node.operand)
+            if node.op == 'invert' and kind is bool:
+                # like the eager operator, ~ of a bool array is the logical not
+                return f'(not {src})', bool
+            src = f'abs({src})' if node.op == 'abs' else f'({_unary_ops[node.op]}{src})'
+            if kind is bool:
+                src = f'bool({src})'
+            return src, kind
+        if isinstance(node, Binary):
+            left, left_kind = self.compile(node.left)
+            right, right_kind = self.compile(node.right)
+            if node.op in _comparison_ops:
+                return f'({left} {_comparison_ops[node.op]} {right})', bool
+            src = f'({left} {_arithmetic_ops[node.op]} {right})'
+            if _UFLOAT in (left_kind, right_kind):
+                return src, _UFLOAT
+            kind = calculate_dominant_type(left_kind, right_kind)
+            # the eager operators cast their result to the dominant type
+            if kind is bool or (kind is int and node.op in ('truediv', 'pow')):
+                src = f'{kind.__name__}({src})'
+            return src, kind
+        raise TypeError(f'{type(node)} is not an expression')
+
+
+def _kind(v: Any) -> Tuple[bool, Any]:
+    ''' (is_array, kind) of an argument of a fused function '''
+    if isinstance(v, SmartArray):
+        return True, v.dtype
+    if _is_uncertainties_array(v):
+        return True, _UFLOAT
+    if isinstance(v, scalar_type_list):
+        return False, type(v)
+    if hasattr(v, 'nominal_value') and hasattr(v, 'std_dev'):
+        return False, _UFLOAT
+    raise TypeError(f'{type(v)} can\'t be used in an expression')
+
+def _output(values: List, kind: Any) -> Union[SmartArray, Any]:
+    if kind == _UFLOAT:
+        from .uncertainties_array import UncertaintiesArray
+        return UncertaintiesArray._from_trusted(values)
+    return SmartArray._from_trusted(values, kind)
+
+
+class fused:
+    '''
+        Compiles a function of arrays (and scalars) into a single pass over the elements.
+        The function is traced once per combination of argument dtypes (the last
+        _MAX_TRACES are kept), so calls only pay for the pass itself.
+        Any other value it uses (a constant, a captured variable) is frozen into the trace,
+        so what changes between calls should be an argument. Capturing an array raises
+        TypeError. If the function returns a tuple, each element is an output. Example:
+            iqr_bounds = fused(lambda q1, q3: (q1 - 1.5 * (q3 - q1), q3 + 1.5 * (q3 - q1)))
+            lower, upper = iqr_bounds(q1, q3)
+    '''
+    __slots__ = ('f', '_cache')
+
+    def __init__(self, f: Callable) -> None:
+        self.f = f
+        self._cache: Dict[Tuple, Tuple[bool, List[Tuple[Callable, Any]]]] = dict()
+
+    def _trace(self, kinds: Tuple[Tuple[bool, Any], ...]) -> Tuple[bool, List[Tuple[Callable, Any]]]:
+        args = tuple(Leaf(_Arg(i, kind, is_array)) for i, (is_array, kind) in enumerate(kinds))
+        res = self.f(*args)
+        is_tuple = isinstance(res, tuple)
+        outputs = list()
+        for node in (res if is_tuple else (res,)):
+            compiler = _Compiler()
+            src, kind = compiler.compile(_wrap(node))
+            array_args = ', '.join(f'a{i}' for i, (is_array, _) in enumerate(kinds) if is_array)
+            scalar_args = ', '.join([f'p{i}' for i, (is_array, _) in enumerate(kinds) if not is_array] + [f's{i}' for i in range(len(compiler.scalars))])
+            code = f'def factory({scalar_args}):\n    return lambda {array_args}: {src}'
+            namespace: Dict[str, Any] = dict()
+            exec(compile(code, '<smart_arrays fused>', 'exec'), namespace)
+            outputs.append((namespace['factory'], tuple(compiler.scalars), kind))
+        return is_tuple, outputs
+
+    def __call__(self, *args) -> Any:
+        kinds = tuple(_kind(a) for a in args)
+        traced = self._cache.get(kinds)
+        if traced is None:
+            if len(self._cache) >= _MAX_TRACES:
+                del self._cache[next(iter(self._cache))]
+            traced = self._cache[kinds] = self._trace(kinds)
+        is_tuple, outputs = traced
+
+        arrays = [a.arr for a, (is_array, _) in zip(args, kinds) if is_array]
+        if not arrays:
+            raise ValueError('no argument is an array')
+        size = len(arrays[0])
+        if any(len(a) != size for a in arrays):
+            raise IndexError('Arrays are not of same size')
+        params = [a for a, (is_array, _) in zip(args, kinds) if not is_array]
+
+        res = tuple(_output(list(map(factory(*params, *constants), *arrays)), kind) for factory, constants, kind in outputs)
+        return res if is_tuple else res[0]
+
+
+if __name__ == '__main__':
+    # fused against the eager operators, for every combination of dtypes of the arguments.
+    # Run from the RPi directory with: python -m smart_arrays.expression
+    import itertools
+    samples = {
+        bool: SmartArray((True, False, True, False), bool),
+        int: SmartArray((3, -2, 0, 7), int),
+        float: SmartArray((1.5, -0.25, 2.0, 650.75), float),
+    }
+    functions = {
+        'intensities': lambda a, b, c, d: (a * (abs(b - c) < d)).int(),
+        'iqr bounds': lambda a, b: (a - 1.5 * (b - a), b + 1.5 * (b - a)),
+        'division': lambda a, b: (a / 2, -a + b, a ** 2, ~(a > b)),
+        'casts': lambda a, b: ((a + b).float(), (a * 0.5).int(), (a - b).bool()),
+    }
+    for name, f in functions.items():
+        g = fused(f)
+        n_args = f.__code__.co_argcount
+        for dtypes in itertools.product(samples, repeat=n_args):
+            args = [samples[t] for t in dtypes]
+            if n_args == 4:
+                args[-1] = 5
+            try:
+                expected = f(*args)
+            except TypeError:
+                continue # ~ of a float, also for the eager operators
+            res = g(*args)
+            for e, r in zip(expected if isinstance(expected, tuple) else (expected,), res if isinstance(res, tuple) else (res,)):
+                assert e.dtype == r.dtype and list(e) == list(r), (name, dtypes, e, r)
+    big = fused(lambda a, b: a + b)
+    for t1, t2 in itertools.product(samples, repeat=2):
+        big(samples[t1], samples[t2])
+        big(samples[t1], 1.5)
+    assert len(big._cache) <= _MAX_TRACES
+    captured = samples[float]
+    try:
+        fused(lambda x: x + captured)(samples[int])
+        raise AssertionError('a captured array should raise TypeError')
+    except TypeError:
+        pass
+    print('OK')
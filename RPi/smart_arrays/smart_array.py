@@ -1,13 +1,28 @@
 from __future__ import annotations
+from array import array
 from typing import Iterable, Optional, Literal, Union, List, Tuple, Callable, Generator
+from itertools import compress
 import operator
 import math
-from . import _generic_operations as go
 from ._utils import castable, calculate_dominant_type, calculate_dominant_type_from_iter
 
 scalar_t = Union[bool, int, float, complex]
 scalar_type_list = (bool, int, float, complex)
 
+# typecodes of the array.array used as storage. complex has no typecode, so it is stored in a list
+_typecodes = {float: 'd', int: 'q', bool: 'b'}
+
+def _storage(values: List, t: type) -> Union[array, List]:
+    ''' values must already be of type t (ints are also accepted for floats) '''
+    tc = _typecodes.get(t)
+    if tc is None:
+        return values
+    try:
+        return array(tc, values)
+    except OverflowError:
+        # ints that don't fit in 64 bits
+        return values
+
 def _cdt(a: Union[SmartArray, SmartList, scalar_t], b: Union[SmartArray, SmartList, scalar_t]) -> type:
     if isinstance(a, (SmartArray, SmartList)):
         t1 = a.dtype
@@ -32,17 +47,38 @@ def zeros(size: int, dtype: Optional[scalar_t]=None) -> SmartArray:
     return filled(size, 0.0, dtype)
 
 def sqrt(a: SmartArray) -> SmartArray:
-    return SmartArray(go._generic_unary_op(a, math.sqrt))
+    return SmartArray._from_trusted([math.sqrt(e) for e in a.arr], float)
+
+def where(mask: SmartArray, a: Union[SmartArray, scalar_t], b: Union[SmartArray, scalar_t]) -> SmartArray:
+    ''' elements of a where mask is True and of b where it is False '''
+    if not isinstance(mask, SmartArray) or mask.dtype is not bool:
+        raise TypeError('mask should be a bool SmartArray')
+    dtype = _cdt(a, b)
+    n = len(mask.arr)
+    if any(isinstance(x, SmartArray) and len(x.arr) != n for x in (a, b)):
+        raise IndexError('Arrays are not of same size')
+    a_it = a.arr if isinstance(a, SmartArray) else (a,)*n
+    b_it = b.arr if isinstance(b, SmartArray) else (b,)*n
+    return SmartArray._from_trusted([x if m else y for m, x, y in zip(mask.arr, a_it, b_it)], dtype)
 
 class SmartArray:
+    '''
+        1-D array of scalars of a single dtype (bool, int, float or complex).
+        bool, int and float arrays are stored in an array.array, so elements are not
+        Python objects and instances have no __dict__. Results of operations between
+        SmartArrays are built with _from_trusted, which skips the validation of __init__
+    '''
+    __slots__ = ('arr', 't')
+
     def __init__(self, a: Optional[Union[Iterable, SmartArray, SmartList]]=None, dtype: Optional[type]=None) -> None:
         if isinstance(a, (SmartArray, SmartList)):
-            self.arr = a.arr.copy()
+            self.arr = a.arr[:]
             self.t = a.dtype
         else:
             if not isinstance(a, Iterable):
                 raise TypeError()
-            if isinstance(a, Generator):
+            if not isinstance(a, (list, tuple, array)):
+                # generators and other iterators can only be walked once
                 a = tuple(a)
             if dtype is None:
                 self.t = calculate_dominant_type_from_iter(a)
@@ -52,9 +88,72 @@ class SmartArray:
                 self.t = dtype
             if not any(self.t is t for t in scalar_type_list):
                 raise TypeError('not all elements of the iterable are scalar')
-            if not all(castable(e, self.t) for e in a):
+            try:
+                values = [self.t(e) for e in a]
+            except ValueError:
                 raise TypeError('not all elements of the iterable are of same type')
-            self.arr = [self.t(e) for e in a]
+            self.arr = _storage(values, self.t)
+
+    @classmethod
+    def _from_trusted(cls, values: List, dtype: type) -> SmartArray:
+        '''
+            internal constructor for results of operations, which are already scalars of
+            dtype (or can be converted without loss). Only bools, and ints that
+            can't go into an int array (for example the result of a division), are cast
+        '''
+        res = cls.__new__(cls)
+        res.t = dtype
+        if dtype is bool:
+            values = [bool(e) for e in values]
+        try:
+            res.arr = _storage(values, dtype)
+        except TypeError:
+            res.arr = _storage([dtype(e) for e in values], dtype)
+        return res
+
+    def _binary(self, other: Union[SmartArray, SmartList, scalar_t], op: Callable, dtype: Optional[type]) -> SmartArray:
+        ''' dtype None means the dominant dtype of self and other '''
+        if not isinstance(other, (SmartArray,) + scalar_type_list):
+            # lets the other operand (for example an expression traced by fused) handle it
+            return NotImplemented
+        if dtype is None:
+            dtype = _cdt(self, other)
+        if isinstance(other, SmartArray):
+            if len(self.arr) != len(other.arr):
+                raise IndexError('Arrays are not of same size')
+            return SmartArray._from_trusted(list(map(op, self.arr, other.arr)), dtype)
+        return SmartArray._from_trusted([op(e, other) for e in self.arr], dtype)
+
+    def _rbinary(self, other: Union[SmartArray, SmartList, scalar_t], op: Callable, dtype: Optional[type]) -> SmartArray:
+        if not isinstance(other, scalar_type_list):
+            return NotImplemented
+        if dtype is None:
+            dtype = _cdt(self, other)
+        return SmartArray._from_trusted([op(other, e) for e in self.arr], dtype)
+
+    def _inplace(self, other: Union[SmartArray, SmartList, scalar_t], op: Callable) -> SmartArray:
+        '''
+            stores the result in self, without allocating. If the result needs a wider
+            dtype (for example int += float), a new array is returned instead
+        '''
+        if not isinstance(other, (SmartArray,) + scalar_type_list):
+            return NotImplemented
+        if _cdt(self, other) is not self.t:
+            return self._binary(other, op, None)
+        arr = self.arr
+        t = self.t
+        if isinstance(other, SmartArray):
+            if len(arr) != len(other.arr):
+                raise IndexError('Arrays are not of same size')
+            for i, o in enumerate(other.arr):
+                arr[i] = t(op(arr[i], o))
+        else:
+            for i, e in enumerate(arr):
+                arr[i] = t(op(e, other))
+        return self
+
+    def _unary(self, op: Callable, dtype: type) -> SmartArray:
+        return SmartArray._from_trusted([op(e) for e in self.arr], dtype)
 
     @property
     def size(self) -> int:
@@ -65,146 +164,272 @@ class SmartArray:
         return self.t
     
     def __len__(self) -> int:
-        return self.size
+        return len(self.arr)
     
     def __iter__(self):
+        if self.t is bool:
+            return map(bool, self.arr)
         return iter(self.arr)
     
-    def __getitem__(self, key: int) -> scalar_t:
+    def _selected(self, key: SmartArray) -> List[int]:
+        ''' indices selected by a bool mask or an int index array '''
+        if key.t is bool:
+            if len(key.arr) != len(self.arr):
+                raise IndexError('mask is not of the size of the array')
+            return list(compress(range(len(self.arr)), key.arr))
+        if key.t is int:
+            return list(key.arr)
+        raise IndexError('only bool masks and int arrays can be used as indices')
+
+    def __getitem__(self, key: Union[int, slice, SmartArray]) -> Union[scalar_t, List, SmartArray]:
+        if isinstance(key, SmartArray):
+            if key.t is bool and len(key.arr) == len(self.arr):
+                return SmartArray._from_trusted(list(compress(self.arr, key.arr)), self.t)
+            arr = self.arr
+            return SmartArray._from_trusted([arr[i] for i in self._selected(key)], self.t)
+        if isinstance(key, slice):
+            return [self[i] for i in range(*key.indices(len(self.arr)))]
+        if self.t is bool:
+            return bool(self.arr[key])
         return self.arr[key]
     
-    def __setitem__(self, key: int, value: scalar_t):
+    def __setitem__(self, key: Union[int, SmartArray], value: Union[scalar_t, SmartArray]):
+        if isinstance(key, SmartArray):
+            # masked assignment, of a scalar or of one value per selected element
+            indices = self._selected(key)
+            if isinstance(value, SmartArray):
+                if len(value.arr) != len(indices):
+                    raise IndexError(f'{len(value.arr)} values for {len(indices)} elements')
+                values = value.arr
+            else:
+                values = (value,)*len(indices)
+            for i, v in zip(indices, values):
+                self[i] = v
+            return
         if not isinstance(value, self.t) and not castable(value, self.t):
             raise TypeError(f'value is not of type {self.t}')
         self.arr[key] = self.t(value)
 
     def bool(self) -> SmartArray:
-        return SmartArray(tuple(bool(e) for e in self), dtype=bool)
+        return SmartArray._from_trusted(list(self.arr), bool)
     
     def int(self) -> SmartArray:
-        return SmartArray(tuple(int(e) for e in self), dtype=int)
+        return SmartArray._from_trusted([int(e) for e in self.arr], int)
     
     def float(self) -> SmartArray:
-        return SmartArray(tuple(float(e) for e in self), dtype=float)
+        return SmartArray._from_trusted([float(e) for e in self.arr], float)
     
     def complex(self) -> SmartArray:
-        return SmartArray(tuple(complex(e) for e in self), dtype=complex)
+        return SmartArray._from_trusted([complex(e) for e in self.arr], complex)
 
     def reverse(self) -> None:
         self.arr.reverse()
 
     def sort(self, *args, key: Optional[Callable]=None, reverse: bool=False) -> None:
-        self.arr.sort(*args, key=key, reverse=reverse)
+        self.arr = _storage(sorted(self, *args, key=key, reverse=reverse), self.t)
 
     def copy(self) -> SmartArray:
         return SmartArray(self)
+
+    # reductions. Each one walks the storage once with a builtin, without building Python
+    # generators. Float sums use math.fsum, so they are exact up to the final rounding
+
+    def sum(self) -> scalar_t:
+        ''' the sum of a bool array is the number of True elements '''
+        if self.t is float:
+            return math.fsum(self.arr)
+        return sum(self.arr)
+
+    def mean(self) -> Union[float, complex]:
+        if len(self.arr) == 0:
+            raise ValueError('mean of an empty array')
+        return self.sum() / len(self.arr)
+
+    def var(self, ddof: int=0) -> float:
+        ''' variance. ddof=1 gives the sample variance (as statistics.variance) '''
+        if self.t is complex:
+            raise TypeError('var of a complex array')
+        n = len(self.arr)
+        if n - ddof <= 0:
+            raise ValueError(f'var needs more than {ddof} elements')
+        m = self.mean()
+        d = [e - m for e in self.arr]
+        return math.fsum(map(operator.mul, d, d)) / (n - ddof)
+
+    def std(self, ddof: int=0) -> float:
+        ''' standard deviation. ddof=1 gives the sample stdev (as statistics.stdev) '''
+        return math.sqrt(self.var(ddof))
+
+    def min(self) -> scalar_t:
+        res = min(self.arr)
+        return bool(res) if self.t is bool else res
+
+    def max(self) -> scalar_t:
+        res = max(self.arr)
+        return bool(res) if self.t is bool else res
+
+    def argmin(self) -> int:
+        ''' index of the first minimum '''
+        return min(range(len(self.arr)), key=self.arr.__getitem__)
+
+    def argmax(self) -> int:
+        ''' index of the first maximum '''
+        return max(range(len(self.arr)), key=self.arr.__getitem__)
+
+    def any(self) -> bool:
+        return any(self.arr)
+
+    def all(self) -> bool:
+        return all(self.arr)
+
+    def count_nonzero(self) -> int:
+        return len(self.arr) - self.arr.count(0)
+
+    def nonzero(self) -> SmartArray:
+        ''' int array with the indices of the non zero (True) elements '''
+        return SmartArray._from_trusted(list(compress(range(len(self.arr)), self.arr)), int)
     
     # math ops
 
     def __add__(self, other: Union[SmartArray, SmartList, scalar_t]) -> SmartArray:
-        return SmartArray(go._generic_binary_op(self, other, operator.add, scalar_type_list), dtype=_cdt(self, other))
+        return self._binary(other, operator.add, None)
     
     def __sub__(self, other: Union[SmartArray, SmartList, scalar_t]) -> SmartArray:
-        return SmartArray(go._generic_binary_op(self, other, operator.sub, scalar_type_list), dtype=_cdt(self, other))
+        return self._binary(other, operator.sub, None)
     
     def __mul__(self, other: Union[SmartArray, SmartList, scalar_t]) -> SmartArray:
-        return SmartArray(go._generic_binary_op(self, other, operator.mul, scalar_type_list), dtype=_cdt(self, other))
+        return self._binary(other, operator.mul, None)
     
     def __truediv__(self, other: Union[SmartArray, SmartList, scalar_t]) -> SmartArray:
-        return SmartArray(go._generic_binary_op(self, other, operator.truediv, scalar_type_list), dtype=_cdt(self, other))
+        return self._binary(other, operator.truediv, None)
     
     def __floordiv__(self, other: Union[SmartArray, SmartList, scalar_t]) -> SmartArray:
-        return SmartArray(go._generic_binary_op(self, other, operator.floordiv, scalar_type_list), dtype=_cdt(self, other))
+        return self._binary(other, operator.floordiv, None)
     
     def __pow__(self, other: Union[SmartArray, SmartList, scalar_t]) -> SmartArray:
-        return SmartArray(go._generic_binary_op(self, other, operator.pow, scalar_type_list), dtype=_cdt(self, other))
+        return self._binary(other, operator.pow, None)
     
     def __mod__(self, other: Union[SmartArray, SmartList, scalar_t]) -> SmartArray:
-        return SmartArray(go._generic_binary_op(self, other, operator.mod, scalar_type_list), dtype=_cdt(self, other))
+        return self._binary(other, operator.mod, None)
     
     def __radd__(self, other: Union[SmartArray, SmartList, scalar_t]) -> SmartArray:
         return self.__add__(other)
     
     def __rsub__(self, other: Union[SmartArray, SmartList, scalar_t]) -> SmartArray:
-        return SmartArray(go._generic_binary_op_rightsided(other, self, operator.sub, scalar_type_list), dtype=_cdt(self, other))
+        return self._rbinary(other, operator.sub, None)
 
     def __rmul__(self, other: Union[SmartArray, SmartList, scalar_t]) -> SmartArray:
         return self.__mul__(other)
     
     def __rtruediv__(self, other: Union[SmartArray, SmartList, scalar_t]) -> SmartArray:
-        return SmartArray(go._generic_binary_op_rightsided(other, self, operator.truediv, scalar_type_list), dtype=_cdt(self, other))
+        return self._rbinary(other, operator.truediv, None)
     
     def __rfloordiv__(self, other: Union[SmartArray, SmartList, scalar_t]) -> SmartArray:
-        return SmartArray(go._generic_binary_op_rightsided(other, self, operator.floordiv, scalar_type_list), dtype=_cdt(self, other))
+        return self._rbinary(other, operator.floordiv, None)
     
     def __rmod__(self, other: Union[SmartArray, SmartList, scalar_t]) -> SmartArray:
-        return SmartArray(go._generic_binary_op_rightsided(other, self, operator.fmod, scalar_type_list), dtype=_cdt(self, other))
+        return self._rbinary(other, math.fmod, None)
     
+    # bitwise ops, to combine masks
+
+    def __and__(self, other: Union[SmartArray, SmartList, scalar_t]) -> SmartArray:
+        return self._binary(other, operator.and_, None)
+
+    def __or__(self, other: Union[SmartArray, SmartList, scalar_t]) -> SmartArray:
+        return self._binary(other, operator.or_, None)
+
+    def __xor__(self, other: Union[SmartArray, SmartList, scalar_t]) -> SmartArray:
+        return self._binary(other, operator.xor, None)
+
+    def __rand__(self, other: Union[SmartArray, SmartList, scalar_t]) -> SmartArray:
+        return self.__and__(other)
+
+    def __ror__(self, other: Union[SmartArray, SmartList, scalar_t]) -> SmartArray:
+        return self.__or__(other)
+
+    def __rxor__(self, other: Union[SmartArray, SmartList, scalar_t]) -> SmartArray:
+        return self.__xor__(other)
+
+    # in-place ops
+
+    def __iadd__(self, other: Union[SmartArray, SmartList, scalar_t]) -> SmartArray:
+        return self._inplace(other, operator.add)
+
+    def __isub__(self, other: Union[SmartArray, SmartList, scalar_t]) -> SmartArray:
+        return self._inplace(other, operator.sub)
+
+    def __imul__(self, other: Union[SmartArray, SmartList, scalar_t]) -> SmartArray:
+        return self._inplace(other, operator.mul)
+
+    def __itruediv__(self, other: Union[SmartArray, SmartList, scalar_t]) -> SmartArray:
+        return self._inplace(other, operator.truediv)
+
     # unary ops
 
     def __abs__(self) -> SmartArray:
-        return SmartArray(go._generic_unary_op(self.arr, abs), dtype=self.t)
+        return self._unary(abs, self.t)
     
     def __pos__(self) -> SmartArray:
-        return SmartArray(go._generic_unary_op(self.arr, operator.pos), dtype=self.t)
+        return self._unary(operator.pos, self.t)
     
     def __neg__(self) -> SmartArray:
-        return SmartArray(go._generic_unary_op(self.arr, operator.neg), dtype=self.t)
+        return self._unary(operator.neg, self.t)
     
     def __invert__(self) -> SmartArray:
-        return SmartArray(go._generic_unary_op(self.arr, operator.invert), dtype=self.t)
+        # ~True is -2 for Python bools, the logical not is what a mask needs
+        return self._unary(operator.not_ if self.t is bool else operator.invert, self.t)
     
     def __ceil__(self) -> SmartArray:
-        return SmartArray(go._generic_unary_op(self.arr, operator.ceil), dtype=bool if self.t is bool else int)
+        return self._unary(math.ceil, bool if self.t is bool else int)
 
     def __floor__(self) -> SmartArray:
-        return SmartArray(go._generic_unary_op(self.arr, operator.floor), dtype=bool if self.t is bool else int)
+        return self._unary(math.floor, bool if self.t is bool else int)
 
     def __trunc__(self) -> SmartArray:
-        return SmartArray(go._generic_unary_op(self.arr, operator.trunc), dtype=bool if self.t is bool else int)
+        return self._unary(math.trunc, bool if self.t is bool else int)
 
     # bool ops
 
     def __eq__(self, other: Union[SmartArray, SmartList, scalar_t]) -> SmartArray:
-        return SmartArray(go._generic_binary_logic_op(self, other, operator.eq, scalar_type_list), dtype=bool)
+        return self._binary(other, operator.eq, bool)
     
     def __ne__(self, other: Union[SmartArray, SmartList, scalar_t]) -> SmartArray:
-        return SmartArray(go._generic_binary_logic_op(self, other, operator.ne, scalar_type_list), dtype=bool)
+        return self._binary(other, operator.ne, bool)
     
     def __lt__(self, other: Union[SmartArray, SmartList, scalar_t]) -> SmartArray:
-        return SmartArray(go._generic_binary_logic_op(self, other, operator.lt, scalar_type_list), dtype=bool)
+        return self._binary(other, operator.lt, bool)
     
     def __gt__(self, other: Union[SmartArray, SmartList, scalar_t]) -> SmartArray:
-        return SmartArray(go._generic_binary_logic_op(self, other, operator.gt, scalar_type_list), dtype=bool)
+        return self._binary(other, operator.gt, bool)
     
     def __le__(self, other: Union[SmartArray, SmartList, scalar_t]) -> SmartArray:
-        return SmartArray(go._generic_binary_logic_op(self, other, operator.le, scalar_type_list), dtype=bool)
+        return self._binary(other, operator.le, bool)
     
     def __ge__(self, other: Union[SmartArray, SmartList, scalar_t]) -> SmartArray:
-        return SmartArray(go._generic_binary_logic_op(self, other, operator.ge, scalar_type_list), dtype=bool)
+        return self._binary(other, operator.ge, bool)
     
     def __req__(self, other: Union[SmartArray, SmartList, scalar_t]) -> SmartArray:
-        return SmartArray(go._generic_binary_logic_op_rightsided(other, self, operator.eq, scalar_type_list), dtype=bool)
+        return self._rbinary(other, operator.eq, bool)
     
     def __rne__(self, other: Union[SmartArray, SmartList, scalar_t]) -> SmartArray:
-        return SmartArray(go._generic_binary_logic_op_rightsided(other, self, operator.ne, scalar_type_list), dtype=bool)
+        return self._rbinary(other, operator.ne, bool)
     
     def __rlt__(self, other: Union[SmartArray, SmartList, scalar_t]) -> SmartArray:
-        return SmartArray(go._generic_binary_logic_op_rightsided(other, self, operator.lt, scalar_type_list), dtype=bool)
+        return self._rbinary(other, operator.lt, bool)
     
     def __rgt__(self, other: Union[SmartArray, SmartList, scalar_t]) -> SmartArray:
-        return SmartArray(go._generic_binary_logic_op_rightsided(other, self, operator.gt), dtype=bool)
+        return self._rbinary(other, operator.gt, bool)
     
     def __rle__(self, other: Union[SmartArray, SmartList, scalar_t]) -> SmartArray:
-        return SmartArray(go._generic_binary_logic_op_rightsided(other, self, operator.le), dtype=bool)
+        return self._rbinary(other, operator.le, bool)
     
     def __rge__(self, other: Union[SmartArray, SmartList, scalar_t]) -> SmartArray:
-        return SmartArray(go._generic_binary_logic_op_rightsided(other, self, operator.ge), dtype=bool)
+        return self._rbinary(other, operator.ge, bool)
 
     # utils
 
     def __list__(self) -> List:
-        return self.arr.tolist()
+        return list(self)
 
     def __repr__(self) -> str:
         return f'SmartArray({list(self)})'
@@ -213,44 +438,48 @@ class SmartArray:
         return self.__repr__()
     
 class SmartList(SmartArray):
-    def __init__(self, a: Optional[Union[Iterable, SmartArray, SmartList]]=None) -> None:
-        super().__init__(a)
+    __slots__ = ()
+
+    def __init__(self, a: Optional[Union[Iterable, SmartArray, SmartList]]=None, dtype: Optional[type]=None) -> None:
+        super().__init__(a, dtype)
 
     def copy(self) -> SmartList:
         return SmartList(self)
     
     def bool(self) -> SmartList:
-        return SmartList((bool(e) for e in self), dtype=bool)
+        return SmartList._from_trusted(list(self.arr), bool)
     
     def int(self) -> SmartList:
-        return SmartList((int(e) for e in self), dtype=int)
+        return SmartList._from_trusted([int(e) for e in self.arr], int)
     
     def float(self) -> SmartList:
-        return SmartList((float(e) for e in self), dtype=float)
+        return SmartList._from_trusted([float(e) for e in self.arr], float)
     
     def complex(self) -> SmartList:
-        return SmartList((complex(e) for e in self), dtype=complex)
+        return SmartList._from_trusted([complex(e) for e in self.arr], complex)
 
     def append(self, x: scalar_t) -> None:
-        if not isinstance(x, scalar_t):
+        if not isinstance(x, scalar_type_list):
             raise TypeError()
-        self.arr.append(x)
+        self.arr.append(self.t(x))
     
     def extend(self, it: Iterable) -> None:
-        if not all(isinstance(e, scalar_t) for e in it):
+        it = tuple(it)
+        if not all(isinstance(e, scalar_type_list) for e in it):
             raise TypeError()
-        self.arr.extend(it)
+        self.arr.extend(self.t(e) for e in it)
 
     def clear(self) -> None:
-        self.arr.clear()
+        del self.arr[:]
 
     def insert(self, i: int, x: scalar_t) -> None:
-        if not isinstance(x, scalar_t):
+        if not isinstance(x, scalar_type_list):
             raise TypeError()
-        self.arr.index(i, x)
+        self.arr.insert(i, self.t(x))
 
-    def pop(self, i: int) -> scalar_t:
-        return self.arr.pop(i)
+    def pop(self, i: int=-1) -> scalar_t:
+        res = self.arr.pop(i)
+        return bool(res) if self.t is bool else res
     
     def __repr__(self) -> str:
         return f'SmartList({list(self)})'
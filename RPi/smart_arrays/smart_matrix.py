@@ -0,0 +1,283 @@
+from __future__ import annotations
+from array import array
+from typing import Iterable, Iterator, List, Optional, Tuple, Union
+import math
+from .smart_array import SmartArray, scalar_t, scalar_type_list, _typecodes
+
+
+def _buffer(size: int, t: type) -> Union[array, List]:
+    tc = _typecodes.get(t)
+    if tc is None:
+        return [t(0)]*size
+    return array(tc, bytes(size * array(tc).itemsize))
+
+
+class SmartMatrix:
+    '''
+        2-D (rows x columns) array of a single dtype, stored row-major in one contiguous
+        buffer (an array.array, like SmartArray) with room for capacity rows.
+        Rows are appended into the preallocated capacity; when it is full the buffer doubles,
+        or, if ring is True, the oldest row is overwritten (as a deque with maxlen), which is
+        how the histories are kept. Rows are indexed from the oldest (0) to the newest (-1).
+        column(j) is a view of a column that reads and writes the buffer without copying
+    '''
+    __slots__ = ('buf', 't', 'n_cols', 'capacity', 'ring', '_start', '_n_rows')
+
+    def __init__(self, n_cols: int, capacity: int=16, dtype: type=float, ring: bool=False, rows: Optional[Iterable[Iterable]]=None) -> None:
+        if n_cols < 0 or capacity < 1:
+            raise ValueError('n_cols should not be negative and capacity should be positive')
+        if not any(dtype is t for t in scalar_type_list):
+            raise ValueError(f'dtype {dtype} is not allowed')
+        self.t = dtype
+        self.n_cols = n_cols
+        self.capacity = capacity
+        self.ring = ring
+        self.buf = _buffer(capacity * n_cols, dtype)
+        self._start = 0
+        self._n_rows = 0
+        if rows is not None:
+            for row in rows:
+                self.append_row(row)
+
+    @property
+    def dtype(self) -> type:
+        return self.t
+
+    @property
+    def n_rows(self) -> int:
+        return self._n_rows
+
+    @property
+    def shape(self) -> Tuple[int, int]:
+        return self._n_rows, self.n_cols
+
+    def __len__(self) -> int:
+        return self._n_rows
+
+    def _physical_row(self, i: int) -> int:
+        if i < 0:
+            i += self._n_rows
+        if not 0 <= i < self._n_rows:
+            raise IndexError('row index out of range')
+        return (self._start + i) % self.capacity
+
+    def _grow(self) -> None:
+        # only for non ring matrices, which always start at the physical row 0
+        self.buf.extend(_buffer(self.capacity * self.n_cols, self.t))
+        self.capacity *= 2
+
+    def append_row(self, row: Union[SmartArray, Iterable[scalar_t]]) -> None:
+        n = self.n_cols
+        if isinstance(row, SmartArray) and row.t is self.t:
+            values = row.arr
+        else:
+            t = self.t
+            values = [t(e) for e in row]
+            tc = _typecodes.get(t)
+            if tc is not None:
+                values = array(tc, values)
+        if len(values) != n:
+            raise IndexError(f'the row should be of length {n}, not {len(values)}')
+        if self._n_rows == self.capacity:
+            if self.ring:
+                # overwrite the oldest row
+                p = self._start
+                self._start = (self._start + 1) % self.capacity
+                self.buf[p*n:(p+1)*n] = values
+                return
+            self._grow()
+        p = (self._start + self._n_rows) % self.capacity
+        self.buf[p*n:(p+1)*n] = values
+        self._n_rows += 1
+
+    def clear(self) -> None:
+        self._start = 0
+        self._n_rows = 0
+
+    def row(self, i: int) -> SmartArray:
+        ''' copy of the row i. Rows are contiguous, so this is a single slice '''
+        n = self.n_cols
+        p = self._physical_row(i)
+        return SmartArray._from_trusted(self.buf[p*n:(p+1)*n], self.t)
+
+    def rows(self) -> Iterator[SmartArray]:
+        return (self.row(i) for i in range(self._n_rows))
+
+    def column(self, j: int) -> ColumnView:
+        if j < 0:
+            j += self.n_cols
+        if not 0 <= j < self.n_cols:
+            raise IndexError('column index out of range')
+        return ColumnView(self, j)
+
+    def columns(self) -> Tuple[ColumnView, ...]:
+        return tuple(ColumnView(self, j) for j in range(self.n_cols))
+
+    def _column_values(self, j: int, start: int=0) -> Union[array, List]:
+        '''
+            values of the column j, from the logical row start to the newest. A strided slice
+            of the buffer is a single C copy, which is much faster than walking the buffer
+            element by element (islice visits the skipped elements too)
+        '''
+        n = self.n_cols
+        first = self._start + start
+        stop = self._start + self._n_rows
+        if stop <= self.capacity:
+            return self.buf[first*n + j:stop*n:n]
+        if first >= self.capacity:
+            return self.buf[(first - self.capacity)*n + j:(stop - self.capacity)*n:n]
+        # the rows wrap around the end of the ring
+        return self.buf[first*n + j:self.capacity*n:n] + self.buf[j:(stop - self.capacity)*n:n]
+
+    def __getitem__(self, key: Tuple[int, int]) -> scalar_t:
+        ''' m[i, j] '''
+        i, j = key
+        if j < 0:
+            j += self.n_cols
+        if not 0 <= j < self.n_cols:
+            raise IndexError('column index out of range')
+        res = self.buf[self._physical_row(i)*self.n_cols + j]
+        return bool(res) if self.t is bool else res
+
+    def __setitem__(self, key: Tuple[int, int], value: scalar_t) -> None:
+        i, j = key
+        if j < 0:
+            j += self.n_cols
+        if not 0 <= j < self.n_cols:
+            raise IndexError('column index out of range')
+        self.buf[self._physical_row(i)*self.n_cols + j] = self.t(value)
+
+    # reductions. axis=0 reduces the rows (one value per column), axis=1 reduces the
+    # columns (one value per row) and axis=None reduces everything
+
+    def _reduce(self, name: str, axis: Optional[int], dtype: type, *args) -> Union[scalar_t, SmartArray]:
+        if axis == 0:
+            return SmartArray._from_trusted([getattr(c, name)(*args) for c in self.columns()], dtype)
+        if axis == 1:
+            return SmartArray._from_trusted([getattr(r, name)(*args) for r in self.rows()], dtype)
+        if axis is None:
+            return getattr(self.flat(), name)(*args)
+        raise ValueError(f'axis should be 0, 1 or None, not {axis}')
+
+    def flat(self) -> SmartArray:
+        ''' copy of all the rows, from the oldest to the newest, in a single SmartArray '''
+        n = self.n_cols
+        end = self._start + self._n_rows
+        if end <= self.capacity:
+            values = self.buf[self._start*n:end*n]
+        else:
+            values = self.buf[self._start*n:] + self.buf[:(end - self.capacity)*n]
+        return SmartArray._from_trusted(values, self.t)
+
+    def sum(self, axis: Optional[int]=None) -> Union[scalar_t, SmartArray]:
+        return self._reduce('sum', axis, int if self.t is bool else self.t)
+
+    def mean(self, axis: Optional[int]=None) -> Union[float, SmartArray]:
+        return self._reduce('mean', axis, complex if self.t is complex else float)
+
+    def var(self, axis: Optional[int]=None, ddof: int=0) -> Union[float, SmartArray]:
+        return self._reduce('var', axis, float, ddof)
+
+    def std(self, axis: Optional[int]=None, ddof: int=0) -> Union[float, SmartArray]:
+        return self._reduce('std', axis, float, ddof)
+
+    def min(self, axis: Optional[int]=None) -> Union[scalar_t, SmartArray]:
+        return self._reduce('min', axis, self.t)
+
+    def max(self, axis: Optional[int]=None) -> Union[scalar_t, SmartArray]:
+        return self._reduce('max', axis, self.t)
+
+    def any(self, axis: Optional[int]=None) -> Union[bool, SmartArray]:
+        return self._reduce('any', axis, bool)
+
+    def all(self, axis: Optional[int]=None) -> Union[bool, SmartArray]:
+        return self._reduce('all', axis, bool)
+
+    def __repr__(self) -> str:
+        return f'SmartMatrix({[list(r) for r in self.rows()]})'
+
+    def __str__(self) -> str:
+        return self.__repr__()
+
+
+class ColumnView:
+    '''
+        Column j of a SmartMatrix, from the oldest row to the newest. Creating it doesn't
+        copy anything and it reads and writes the buffer of the matrix, so it sees the rows
+        appended after it was created. Iterations and reductions take a strided slice of the
+        buffer (one C level copy of the column)
+    '''
+    __slots__ = ('m', 'j')
+
+    def __init__(self, m: SmartMatrix, j: int) -> None:
+        self.m = m
+        self.j = j
+
+    @property
+    def dtype(self) -> type:
+        return self.m.t
+
+    def __len__(self) -> int:
+        return self.m._n_rows
+
+    def __iter__(self) -> Iterator:
+        values = self.m._column_values(self.j)
+        return map(bool, values) if self.m.t is bool else iter(values)
+
+    def __getitem__(self, i: int) -> scalar_t:
+        return self.m[i, self.j]
+
+    def __setitem__(self, i: int, value: scalar_t) -> None:
+        self.m[i, self.j] = value
+
+    def last(self, k: int) -> SmartArray:
+        ''' copy of the newest k values (or less if there are not so many rows), oldest first '''
+        m = self.m
+        start = max(m._n_rows - k, 0)
+        return SmartArray._from_trusted(m._column_values(self.j, start), m.t)
+
+    def values(self) -> SmartArray:
+        ''' copy of the column '''
+        return self.last(self.m._n_rows)
+
+    # reductions, over a strided slice of the buffer
+
+    def sum(self) -> scalar_t:
+        if self.m.t is float:
+            return math.fsum(self.m._column_values(self.j))
+        return sum(self.m._column_values(self.j))
+
+    def mean(self) -> Union[float, complex]:
+        if self.m._n_rows == 0:
+            raise ValueError('mean of an empty column')
+        return self.sum() / self.m._n_rows
+
+    def var(self, ddof: int=0) -> float:
+        return self.values().var(ddof)
+
+    def std(self, ddof: int=0) -> float:
+        return math.sqrt(self.var(ddof))
+
+    def min(self) -> scalar_t:
+        res = min(self.m._column_values(self.j))
+        return bool(res) if self.m.t is bool else res
+
+    def max(self) -> scalar_t:
+        res = max(self.m._column_values(self.j))
+        return bool(res) if self.m.t is bool else res
+
+    def any(self) -> bool:
+        return any(self.m._column_values(self.j))
+
+    def all(self) -> bool:
+        return all(self.m._column_values(self.j))
+
+    def count_nonzero(self) -> int:
+        values = self.m._column_values(self.j)
+        return len(values) - values.count(0)
+
+    def __repr__(self) -> str:
+        return f'ColumnView({list(self)})'
+
+    def __str__(self) -> str:
+        return self.__repr__()
@@ -1,5 +1,6 @@
 from __future__ import annotations
 from typing import Iterable, Optional, Literal, Union, List, Tuple, Callable, Generator
+from itertools import compress
 import operator
 import math
 from uncertainties import umath
@@ -20,9 +21,11 @@ def zeros(size: int) -> UncertaintiesArray:
     return filled(size, 0)
 
 def sqrt(a: UncertaintiesArray) -> UncertaintiesArray:
-    return UncertaintiesArray(go._generic_unary_op(a, math.sqrt))
+    return UncertaintiesArray._from_trusted([umath.sqrt(e) for e in a.arr])
 
 class UncertaintiesArray:
+    __slots__ = ('arr',)
+
     def __init__(self, a: Optional[Union[Iterable, UncertaintiesArray, UncertaintiesList]]=None, b: Optional[Iterable]=None) -> None:
         if not isinstance(a, Iterable):
             raise TypeError('a is not iterable')
@@ -35,9 +38,11 @@ class UncertaintiesArray:
                 b = tuple(b)
             if len(a) != len(b):
                 raise IndexError('a and b are not of same size')
-            if not (all(castable(e, float) for e in a) and all(castable(e, float) for e in b)):
+            try:
+                self.arr = [ufloat(float(e1), float(e2)) for e1, e2 in zip(a, b)]
+            except ValueError:
                 raise TypeError('not all elements of a and b are castable to float')
-            a = list(ufloat(e1, e2) for e1, e2 in zip(a, b))
+            return
         if isinstance(a, UncertaintiesArray):
             self.arr = a.arr.copy()
         else:
@@ -48,6 +53,58 @@ class UncertaintiesArray:
             else:
                 self.arr = list(a)
 
+    @classmethod
+    def _from_trusted(cls, values: List) -> UncertaintiesArray:
+        ''' internal constructor for results of operations, which are already ufloats '''
+        res = cls.__new__(cls)
+        res.arr = values
+        return res
+
+    def _binary(self, other: Union[UncertaintiesArray, float, int, ufloat_t], op: Callable) -> UncertaintiesArray:
+        if isinstance(other, (UncertaintiesArray, SmartArray)):
+            if len(self.arr) != len(other.arr):
+                raise IndexError('Arrays are not of same size')
+            return UncertaintiesArray._from_trusted(list(map(op, self.arr, other.arr)))
+        if isinstance(other, (float, int, ufloat_t)):
+            return UncertaintiesArray._from_trusted([op(e, other) for e in self.arr])
+        if not isinstance(other, Iterable):
+            # lets the other operand (for example an expression traced by fused) handle it
+            return NotImplemented
+        return UncertaintiesArray(go._generic_binary_op(self, other, op, ufloat_t))
+
+    def _rbinary(self, other: Union[UncertaintiesArray, float, int, ufloat_t], op: Callable) -> UncertaintiesArray:
+        if isinstance(other, (SmartArray, float, int, ufloat_t)):
+            if isinstance(other, SmartArray):
+                return self._binary(other, lambda e1, e2: op(e2, e1))
+            return UncertaintiesArray._from_trusted([op(other, e) for e in self.arr])
+        if not isinstance(other, Iterable):
+            return NotImplemented
+        return UncertaintiesArray(go._generic_binary_op_rightsided(other, self, op, ufloat_t))
+
+    def _inplace(self, other: Union[UncertaintiesArray, float, int, ufloat_t], op: Callable) -> UncertaintiesArray:
+        ''' stores the result in self, without allocating a new array '''
+        arr = self.arr
+        if isinstance(other, (UncertaintiesArray, SmartArray)):
+            if len(arr) != len(other.arr):
+                raise IndexError('Arrays are not of same size')
+            for i, o in enumerate(other.arr):
+                arr[i] = op(arr[i], o)
+        elif isinstance(other, (float, int, ufloat_t)):
+            for i, e in enumerate(arr):
+                arr[i] = op(e, other)
+        else:
+            return NotImplemented
+        return self
+
+    def _compare(self, other: Union[UncertaintiesArray, float, int, ufloat_t], op: Callable) -> SmartArray:
+        if isinstance(other, (UncertaintiesArray, SmartArray)):
+            if len(self.arr) != len(other.arr):
+                raise IndexError('Arrays are not of same size')
+            return SmartArray._from_trusted(list(map(op, self.arr, other.arr)), bool)
+        if not isinstance(other, (float, int, ufloat_t)):
+            return NotImplemented
+        return SmartArray._from_trusted([op(e, other) for e in self.arr], bool)
+
     @property
     def size(self) -> int:
         return len(self.arr)
@@ -58,7 +115,17 @@ class UncertaintiesArray:
     def __iter__(self):
         return iter(self.arr)
     
-    def __getitem__(self, key: int) -> ufloat_t:
+    def __getitem__(self, key: Union[int, slice, SmartArray]) -> Union[ufloat_t, List, UncertaintiesArray]:
+        if isinstance(key, SmartArray):
+            # bool mask or int index array
+            if key.dtype is bool:
+                if len(key) != len(self.arr):
+                    raise IndexError('mask is not of the size of the array')
+                return UncertaintiesArray._from_trusted(list(compress(self.arr, key.arr)))
+            if key.dtype is not int:
+                raise IndexError('only bool masks and int arrays can be used as indices')
+            arr = self.arr
+            return UncertaintiesArray._from_trusted([arr[i] for i in key.arr])
         return self.arr[key]
     
     def __setitem__(self, key: int, value: ufloat_t):
@@ -75,118 +142,139 @@ class UncertaintiesArray:
     def copy(self) -> UncertaintiesArray:
         return UncertaintiesArray(self)
     
+    def sum(self) -> ufloat_t:
+        ''' keeps the correlations between the elements, as any operation between ufloats '''
+        return sum(self.arr, ufloat(0, 0))
+
+    def mean(self) -> ufloat_t:
+        if len(self.arr) == 0:
+            raise ValueError('mean of an empty array')
+        return self.sum() / len(self.arr)
+
     def values(self) -> SmartArray:
-        return SmartArray(tuple(e.nominal_value for e in self), dtype=float)
+        return SmartArray._from_trusted([e.nominal_value for e in self.arr], float)
     
     def errors(self) -> SmartArray:
-        return SmartArray(tuple(e.std_dev for e in self), dtype=float)
+        return SmartArray._from_trusted([e.std_dev for e in self.arr], float)
     
     # math ops
 
     def __add__(self, other: Union[UncertaintiesArray, float, int, ufloat_t]) -> UncertaintiesArray:
-        return UncertaintiesArray(go._generic_binary_op(self, other, operator.add, ufloat_t))
+        return self._binary(other, operator.add)
     
     def __sub__(self, other: Union[UncertaintiesArray, float, int, ufloat_t]) -> UncertaintiesArray:
-        return UncertaintiesArray(go._generic_binary_op(self, other, operator.sub, ufloat_t))
+        return self._binary(other, operator.sub)
     
     def __mul__(self, other: Union[UncertaintiesArray, float, int, ufloat_t]) -> UncertaintiesArray:
-        return UncertaintiesArray(go._generic_binary_op(self, other, operator.mul, ufloat_t))
+        return self._binary(other, operator.mul)
     
     def __truediv__(self, other: Union[UncertaintiesArray, float, int, ufloat_t]) -> UncertaintiesArray:
-        return UncertaintiesArray(go._generic_binary_op(self, other, operator.truediv, ufloat_t))
+        return self._binary(other, operator.truediv)
     
     def __floordiv__(self, other: Union[UncertaintiesArray, float, int, ufloat_t]) -> UncertaintiesArray:
-        return UncertaintiesArray(go._generic_binary_op(self, other, operator.floordiv, ufloat_t))
+        return self._binary(other, operator.floordiv)
     
     def __pow__(self, other: Union[UncertaintiesArray, float, int, ufloat_t]) -> UncertaintiesArray:
-        return UncertaintiesArray(go._generic_binary_op(self, other, umath.pow, ufloat_t))
+        return self._binary(other, umath.pow)
     
     def __mod__(self, other: Union[UncertaintiesArray, float, int, ufloat_t]) -> UncertaintiesArray:
-        return UncertaintiesArray(go._generic_binary_op(self, other, umath.fmod, ufloat_t))
+        return self._binary(other, umath.fmod)
     
+    def __iadd__(self, other: Union[UncertaintiesArray, float, int, ufloat_t]) -> UncertaintiesArray:
+        return self._inplace(other, operator.add)
+
+    def __isub__(self, other: Union[UncertaintiesArray, float, int, ufloat_t]) -> UncertaintiesArray:
+        return self._inplace(other, operator.sub)
+
+    def __imul__(self, other: Union[UncertaintiesArray, float, int, ufloat_t]) -> UncertaintiesArray:
+        return self._inplace(other, operator.mul)
+
+    def __itruediv__(self, other: Union[UncertaintiesArray, float, int, ufloat_t]) -> UncertaintiesArray:
+        return self._inplace(other, operator.truediv)
+
     def __radd__(self, other: Union[UncertaintiesArray, float, int, ufloat_t]) -> UncertaintiesArray:
         return self.__add__(other)
     
     def __rsub__(self, other: Union[UncertaintiesArray, float, int, ufloat_t]) -> UncertaintiesArray:
-        return UncertaintiesArray(go._generic_binary_op_rightsided(other, self, operator.sub, ufloat_t))
+        return self._rbinary(other, operator.sub)
 
     def __rmul__(self, other: Union[UncertaintiesArray, float, int, ufloat_t]) -> UncertaintiesArray:
         return self.__mul__(other)
     
     def __rtruediv__(self, other: Union[UncertaintiesArray, float, int, ufloat_t]) -> UncertaintiesArray:
-        return UncertaintiesArray(go._generic_binary_op_rightsided(other, self, operator.truediv, ufloat_t))
+        return self._rbinary(other, operator.truediv)
     
     def __rfloordiv__(self, other: Union[UncertaintiesArray, float, int, ufloat_t]) -> UncertaintiesArray:
-        return UncertaintiesArray(go._generic_binary_op_rightsided(other, self, operator.floordiv, ufloat_t))
+        return self._rbinary(other, operator.floordiv)
     
     def __rmod__(self, other: Union[UncertaintiesArray, float, int, ufloat_t]) -> UncertaintiesArray:
-        return UncertaintiesArray(go._generic_binary_op_rightsided(other, self, operator.fmod, ufloat_t))
+        return self._rbinary(other, umath.fmod)
     
     # unary ops
 
     def __abs__(self) -> UncertaintiesArray:
-        return UncertaintiesArray(go._generic_unary_op(self.arr, abs))
+        return UncertaintiesArray._from_trusted([abs(e) for e in self.arr])
     
     def __pos__(self) -> UncertaintiesArray:
-        return UncertaintiesArray(go._generic_unary_op(self.arr, operator.pos))
+        return UncertaintiesArray._from_trusted([operator.pos(e) for e in self.arr])
     
     def __neg__(self) -> UncertaintiesArray:
-        return UncertaintiesArray(go._generic_unary_op(self.arr, operator.neg))
+        return UncertaintiesArray._from_trusted([operator.neg(e) for e in self.arr])
     
     def __invert__(self) -> UncertaintiesArray:
-        return UncertaintiesArray(go._generic_unary_op(self.arr, operator.invert))
+        return UncertaintiesArray._from_trusted([operator.invert(e) for e in self.arr])
     
     def __ceil__(self) -> UncertaintiesArray:
-        return UncertaintiesArray(go._generic_unary_op(self.arr, umath.ceil))
+        return UncertaintiesArray._from_trusted([umath.ceil(e) for e in self.arr])
 
     def __floor__(self) -> UncertaintiesArray:
-        return UncertaintiesArray(go._generic_unary_op(self.arr, umath.floor))
+        return UncertaintiesArray._from_trusted([umath.floor(e) for e in self.arr])
 
     def __trunc__(self) -> UncertaintiesArray:
-        return UncertaintiesArray(go._generic_unary_op(self.arr, umath.trunc))
+        return UncertaintiesArray._from_trusted([umath.trunc(e) for e in self.arr])
 
     # bool ops
 
-    def __eq__(self, other: Union[UncertaintiesArray, float, int, ufloat_t]) -> UncertaintiesArray:
-        return UncertaintiesArray(go._generic_binary_logic_op(self, other, operator.eq, ufloat_t))
+    def __eq__(self, other: Union[UncertaintiesArray, float, int, ufloat_t]) -> SmartArray:
+        return self._compare(other, operator.eq)
     
-    def __ne__(self, other: Union[UncertaintiesArray, float, int, ufloat_t]) -> UncertaintiesArray:
-        return UncertaintiesArray(go._generic_binary_logic_op(self, other, operator.ne, ufloat_t))
+    def __ne__(self, other: Union[UncertaintiesArray, float, int, ufloat_t]) -> SmartArray:
+        return self._compare(other, operator.ne)
     
-    def __lt__(self, other: Union[UncertaintiesArray, float, int, ufloat_t]) -> UncertaintiesArray:
-        return UncertaintiesArray(go._generic_binary_logic_op(self, other, operator.lt, ufloat_t))
+    def __lt__(self, other: Union[UncertaintiesArray, float, int, ufloat_t]) -> SmartArray:
+        return self._compare(other, operator.lt)
     
-    def __gt__(self, other: Union[UncertaintiesArray, float, int, ufloat_t]) -> UncertaintiesArray:
-        return UncertaintiesArray(go._generic_binary_logic_op(self, other, operator.gt, ufloat_t))
+    def __gt__(self, other: Union[UncertaintiesArray, float, int, ufloat_t]) -> SmartArray:
+        return self._compare(other, operator.gt)
     
-    def __le__(self, other: Union[UncertaintiesArray, float, int, ufloat_t]) -> UncertaintiesArray:
-        return UncertaintiesArray(go._generic_binary_logic_op(self, other, operator.le, ufloat_t))
+    def __le__(self, other: Union[UncertaintiesArray, float, int, ufloat_t]) -> SmartArray:
+        return self._compare(other, operator.le)
     
-    def __ge__(self, other: Union[UncertaintiesArray, float, int, ufloat_t]) -> UncertaintiesArray:
-        return UncertaintiesArray(go._generic_binary_logic_op(self, other, operator.ge, ufloat_t))
+    def __ge__(self, other: Union[UncertaintiesArray, float, int, ufloat_t]) -> SmartArray:
+        return self._compare(other, operator.ge)
     
-    def __req__(self, other: Union[UncertaintiesArray, float, int, ufloat_t]) -> UncertaintiesArray:
-        return UncertaintiesArray(go._generic_binary_logic_op_rightsided(other, self, operator.eq, ufloat_t))
+    def __req__(self, other: Union[UncertaintiesArray, float, int, ufloat_t]) -> SmartArray:
+        return self._compare(other, operator.eq)
     
-    def __rne__(self, other: Union[UncertaintiesArray, float, int, ufloat_t]) -> UncertaintiesArray:
-        return UncertaintiesArray(go._generic_binary_logic_op_rightsided(other, self, operator.ne, ufloat_t))
+    def __rne__(self, other: Union[UncertaintiesArray, float, int, ufloat_t]) -> SmartArray:
+        return self._compare(other, operator.ne)
     
-    def __rlt__(self, other: Union[UncertaintiesArray, float, int, ufloat_t]) -> UncertaintiesArray:
-        return UncertaintiesArray(go._generic_binary_logic_op_rightsided(other, self, operator.lt, ufloat_t))
+    def __rlt__(self, other: Union[UncertaintiesArray, float, int, ufloat_t]) -> SmartArray:
+        return self._compare(other, operator.gt)
     
-    def __rgt__(self, other: Union[UncertaintiesArray, float, int, ufloat_t]) -> UncertaintiesArray:
-        return UncertaintiesArray(go._generic_binary_logic_op_rightsided(other, self, operator.gt))
+    def __rgt__(self, other: Union[UncertaintiesArray, float, int, ufloat_t]) -> SmartArray:
+        return self._compare(other, operator.lt)
     
-    def __rle__(self, other: Union[UncertaintiesArray, float, int, ufloat_t]) -> UncertaintiesArray:
-        return UncertaintiesArray(go._generic_binary_logic_op_rightsided(other, self, operator.le))
+    def __rle__(self, other: Union[UncertaintiesArray, float, int, ufloat_t]) -> SmartArray:
+        return self._compare(other, operator.ge)
     
-    def __rge__(self, other: Union[UncertaintiesArray, float, int, ufloat_t]) -> UncertaintiesArray:
-        return UncertaintiesArray(go._generic_binary_logic_op_rightsided(other, self, operator.ge))
+    def __rge__(self, other: Union[UncertaintiesArray, float, int, ufloat_t]) -> SmartArray:
+        return self._compare(other, operator.le)
 
     # utils
 
     def __list__(self) -> List:
-        return self.arr.tolist()
+        return self.arr.copy()
 
     def __repr__(self) -> str:
         return f'UncertaintiesArray({list(self)})'
@@ -195,6 +283,8 @@ class UncertaintiesArray:
         return self.__repr__()
     
 class UncertaintiesList(UncertaintiesArray):
+    __slots__ = ()
+
     def __init__(self, a: Optional[Union[Iterable, UncertaintiesArray]]=None) -> None:
         super().__init__(a)
 
@@ -223,7 +313,7 @@ class UncertaintiesList(UncertaintiesArray):
     def insert(self, i: int, x: ufloat_t) -> None:
         if not isinstance(x, ufloat_t):
             raise TypeError()
-        self.arr.index(i, x)
+        self.arr.insert(i, x)
 
     def pop(self, i: int) -> ufloat_t:
         return self.arr.pop(i)
@@ -0,0 +1,169 @@
+'''
+    Soak test of the control loop: SystemsManager.loop() runs against SimulatedArduino in
+    virtual time, with the ticks back to back, for as many ticks as asked (millions take
+    hours, not weeks). Every sample_every ticks the RSS of the process, the number of live
+    objects of each type and the stats of the gc are sampled, after a full collection. It
+    fails if, from the end of the warmup (the histories and the models fill up) to the last
+    sample, the RSS or the objects grew more than the bounds, or if the gc found
+    uncollectable cycles. Run from the RPi directory with:
+        python soak_test.py [ticks] [max_rss_growth_mb]
+    the exit code is 1 if it failed
+'''
+from __future__ import annotations
+import gc
+import os
+import sys
+import math
+import logging
+import dataclasses
+from collections import Counter
+from time import perf_counter
+from typing import Dict, List, Optional
+from simulator import SimulationParams, simulate
+from systems import SystemsManager
+from telemetry import telemetry as tm
+
+
+@dataclasses.dataclass(frozen=True)
+class SoakParams:
+    ticks: int = 1000000
+    warmup_ticks: int = 1000 # more than the history_length of the manager and the windows of the models
+    sample_every: int = 10000 # ticks
+    max_rss_growth_mb: float = 20
+    max_objects_growth: int = 20000 # live objects, in total
+    max_type_growth: int = 2000 # live objects of a single type
+    log_level: int = logging.CRITICAL + 1 # logging.DEBUG also soaks the formatting of the logs
+    simulation: SimulationParams = SimulationParams(name='soak', days=math.inf, tick_period_s=0)
+
+
+@dataclasses.dataclass
+class SoakSample:
+    ticks: int
+    wall_s: float
+    rss_mb: float
+    n_objects: int
+    gc_collections: tuple[int, ...] # per generation, since the start of the process
+    gc_collected: tuple[int, ...]
+    gc_uncollectable: int
+
+
+@dataclasses.dataclass
+class SoakReport:
+    samples: List[SoakSample]
+    baseline: Optional[SoakSample] # first sample after the warmup
+    type_growth: Dict[str, int] # from the baseline to the last sample, only the types that grew
+    failures: List[str]
+
+    @property
+    def passed(self) -> bool:
+        return not self.failures
+
+
+def rss_mb() -> float:
+    ''' resident memory of the process. On other systems than linux, its peak '''
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+    except (OSError, ValueError, AttributeError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def count_types() -> Counter:
+    ''' live objects tracked by the gc, by type (without the samples of the soak test itself) '''
+    return Counter(f'{type(o).__module__}.{type(o).__qualname__}' for o in gc.get_objects() if not isinstance(o, SoakSample))
+
+
+def take_sample(ticks: int, wall_s: float) -> tuple[SoakSample, Counter]:
+    # what is only waiting for the gc is not a leak
+    gc.collect()
+    stats = gc.get_stats()
+    types = count_types()
+    sample = SoakSample(
+        ticks=ticks,
+        wall_s=wall_s,
+        rss_mb=rss_mb(),
+        n_objects=sum(types.values()),
+        gc_collections=tuple(s['collections'] for s in stats),
+        gc_collected=tuple(s['collected'] for s in stats),
+        gc_uncollectable=sum(s['uncollectable'] for s in stats) + len(gc.garbage),
+    )
+    return sample, types
+
+
+def format_sample(s: SoakSample) -> str:
+    return (
+        f'{s.ticks:>9} ticks {s.wall_s:>8.0f} s  rss {s.rss_mb:>7.1f} MB  objects {s.n_objects:>8}  '
+        f'gc {"/".join(str(c) for c in s.gc_collections)} collected {sum(s.gc_collected)} uncollectable {s.gc_uncollectable}'
+    )
+
+
+def soak(params: SoakParams, verbose: bool=True) -> SoakReport:
+    samples: List[SoakSample] = list()
+    baseline: Optional[SoakSample] = None
+    baseline_types: Counter = Counter()
+    last_types: Counter = Counter()
+    n_ticks = 0
+    next_sample = params.warmup_ticks
+    wall_start = perf_counter()
+
+    def count_ticks(record: dict) -> None:
+        nonlocal n_ticks
+        if record['kind'] in ('tick', 'tick_skipped', 'tick_failed'):
+            n_ticks += 1
+
+    def setup(manager: SystemsManager) -> None:
+        def sample() -> None:
+            nonlocal baseline, baseline_types, last_types, next_sample
+            if n_ticks < next_sample and n_ticks < params.ticks:
+                return
+            s, last_types = take_sample(n_ticks, perf_counter() - wall_start)
+            samples.append(s)
+            if baseline is None:
+                baseline, baseline_types = s, last_types
+            if verbose:
+                print(format_sample(s), flush=True)
+            next_sample += params.sample_every
+            if n_ticks >= params.ticks:
+                manager.scheduler.stop()
+        # in virtual time, it only checks the tick count
+        manager.add_periodic_task('soak_sample', 1, sample, pausable=False)
+
+    tm.add_listener(count_ticks)
+    try:
+        simulate(dataclasses.replace(params.simulation, log_level=params.log_level), setup)
+    finally:
+        tm.remove_listener(count_ticks)
+
+    failures = list()
+    type_growth = {k: v for k, v in (last_types - baseline_types).most_common()}
+    if baseline is None or len(samples) < 2:
+        failures.append(f'Solo hubo {n_ticks} ticks, no alcanzan para comparar con el final del calentamiento ({params.warmup_ticks} ticks)')
+    else:
+        last = samples[-1]
+        rss_growth = last.rss_mb - baseline.rss_mb
+        objects_growth = last.n_objects - baseline.n_objects
+        if rss_growth > params.max_rss_growth_mb:
+            failures.append(f'La memoria crecio {rss_growth:.1f} MB (limite {params.max_rss_growth_mb} MB)')
+        if objects_growth > params.max_objects_growth:
+            failures.append(f'Los objetos vivos crecieron en {objects_growth} (limite {params.max_objects_growth})')
+        for name, growth in type_growth.items():
+            if growth > params.max_type_growth:
+                failures.append(f'Los objetos {name} crecieron en {growth} (limite {params.max_type_growth})')
+        if last.gc_uncollectable > 0:
+            failures.append(f'El gc encontro {last.gc_uncollectable} objetos que no pudo liberar')
+    return SoakReport(samples, baseline, type_growth, failures)
+
+
+if __name__ == '__main__':
+    ticks = int(sys.argv[1]) if len(sys.argv) > 1 else SoakParams.ticks
+    max_rss_growth_mb = float(sys.argv[2]) if len(sys.argv) > 2 else SoakParams.max_rss_growth_mb
+    params = SoakParams(ticks=ticks, sample_every=max(ticks // 100, 1), max_rss_growth_mb=max_rss_growth_mb)
+    report = soak(params)
+    print('Tipos que mas crecieron desde el calentamiento:')
+    for name, growth in list(report.type_growth.items())[:15]:
+        print(f'    {name}: +{growth}')
+    for failure in report.failures:
+        print(f'FALLO: {failure}')
+    print('OK' if report.passed else 'FALLO')
+    sys.exit(0 if report.passed else 1)
@@ -0,0 +1,78 @@
+import os
+import importlib
+from time import perf_counter
+from contextlib import contextmanager
+from typing import Iterable, List, Optional, Tuple
+
+
+def _process_age_s() -> Optional[float]:
+    '''
+        seconds since the process was started (including the interpreter startup).
+        Only available on linux, returns None elsewhere
+    '''
+    try:
+        with open('/proc/self/stat', 'r') as f:
+            # the process name can contain spaces, the fields after it can't
+            stat = f.read().rsplit(')', 1)[1].split()
+        with open('/proc/uptime', 'r') as f:
+            uptime_s = float(f.read().split()[0])
+        start_ticks = int(stat[19]) # field 22 (starttime) of /proc/<pid>/stat
+        return uptime_s - start_ticks / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+
+class StartupProfile:
+    '''
+        Records how long each startup phase takes (imports, construction, begin, ...)
+        so that the time from a (watchdog) restart until the first tick can be tracked
+    '''
+    def __init__(self) -> None:
+        self.t0 = perf_counter()
+        self.process_age_at_t0_s = _process_age_s()
+        self.phases: List[Tuple[str, float]] = list()
+        self._last_mark = self.t0
+
+    def time_imports(self, modules: Iterable[str]) -> None:
+        for module in modules:
+            start = perf_counter()
+            importlib.import_module(module)
+            self.phases.append((f'import {module}', perf_counter() - start))
+        self._last_mark = perf_counter()
+
+    @contextmanager
+    def phase(self, name: str):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.phases.append((name, perf_counter() - start))
+            self._last_mark = perf_counter()
+
+    def mark(self, name: str) -> None:
+        ''' records the time since the last phase or mark ended '''
+        now = perf_counter()
+        self.phases.append((name, now - self._last_mark))
+        self._last_mark = now
+
+    @property
+    def elapsed_s(self) -> float:
+        ''' seconds since the process started, or since this module was imported if that is unknown '''
+        elapsed = perf_counter() - self.t0
+        if self.process_age_at_t0_s is not None:
+            elapsed += self.process_age_at_t0_s
+        return elapsed
+
+    def report(self, log: bool=True) -> str:
+        lines = [f'{name}: {dt*1000:.1f} ms' for name, dt in self.phases]
+        if self.process_age_at_t0_s is not None:
+            lines.insert(0, f'interpreter startup: {self.process_age_at_t0_s*1000:.1f} ms')
+        lines.append(f'total: {self.elapsed_s*1000:.1f} ms')
+        res = 'Startup profile -> ' + ', '.join(lines)
+        if log:
+            from logging_helper import logger as lh
+            lh.info(res)
+        return res
+
+
+startup_profile = StartupProfile()
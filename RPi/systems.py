@@ -1,22 +1,40 @@
 from __future__ import annotations
 import dataclasses
-from typing import Generator, Optional, Union
+from typing import Any, Callable, Optional, Union
 import os
 
+import logging
 from logging_helper import logger as lh
+from logging_helper import fields, is_enabled_for
+from telemetry import telemetry as tm
 
 from serial_manager import SerialManager
 from balanzas import Balanzas
 from balanzas import calibrate as balanzas_calibrate
+from balanzas import calibrate_multipoint as balanzas_calibrate_multipoint
 from file_manager import FileManager
-from smart_arrays import SmartArray
+from smart_arrays import SmartArray, SmartMatrix, fused
 import smart_arrays.smart_array as sa
 from dataclass_save import save_dataclass
 from maintenance_circuit import Maintenance
+from weight_model import WeightModel, WeightModelInfo
+from drift_model import DriftModel, DriftModelInfo
+from dose_controller import DoseController, DoseControllerInfo
+from scheduler import Scheduler, MonotonicClock, PeriodicTask
+from halt_control import HaltControl, HaltedError
+from serial_supervisor import SerialSupervisor
+from live_state import LiveStateWriter, SystemState
+from persistence import PersistenceProcess
+from collector import CollectorClient, CollectorInfo
+from tick_profiler import TickProfiler, TickProfilerInfo
 
 from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+import math
+import queue
+import atexit
 
-from time import sleep
+from time import sleep, time
 from datetime import datetime
 
 @dataclasses.dataclass(frozen=True)
@@ -45,7 +63,8 @@ class IntensityConfig:
         x_range = self.n_steps - self.n_steps_not_incrementing
         y_range = self.final_value - self.initial_value
         norm_arg = (arg - self.n_steps_not_incrementing) / x_range
-        return norm_arg * y_range + self.initial_value
+        # the arduino commands only take integers
+        return round(norm_arg * y_range + self.initial_value)
 
 
 @dataclasses.dataclass(frozen=True)
@@ -73,10 +92,17 @@ class Position:
 
 @dataclasses.dataclass(frozen=True)
 class SerialManagerInfo:
+    # a local device, or rfc2217://host:port for an arduino on another pi (see serial_bridge.py)
     port: str = '/dev/ttyACM0'
     baud_rate: int = 9600
     timeout: int = 5
     delay_s: int = .15
+    # gpio pin wired to the reset of the arduino, used when reconnecting isn't enough. None if not wired
+    reset_pin: Optional[int] = None
+    # where to look for the arduino if it disappears from port
+    port_patterns: tuple[str, ...] = ('/dev/ttyACM*', '/dev/ttyUSB*')
+    # faster rates negotiated after begin (needs the baud command in the firmware). If empty, baud_rate is kept
+    baud_rates: tuple[int, ...] = ()
 
 @dataclasses.dataclass(frozen=True)
 class BalanzasInfo:
@@ -85,6 +111,22 @@ class BalanzasInfo:
     n_arduino: int = 10
     err_threshold: int = 500
 
+@dataclasses.dataclass(frozen=True)
+class SamplingInfo:
+    '''
+    Configuration of the prioritised partial weighing (hx_single).
+    Balanzas closer than near_grams to their limit (grams_goals - grams_threshold), with a
+    stdev of the last recent_history weights over high_stdev_grams or without a previous
+    weight get the full n_statistics budget. The rest get fewer samples the further they
+    are from the limit (at least min_samples), and none if the weight model predicts them
+    safely over it. Balanzas that are not watered are only read every rare_every ticks
+    '''
+    near_grams: float = 30
+    high_stdev_grams: float = 5
+    recent_history: int = 5
+    min_samples: int = 3
+    rare_every: int = 10
+
 @dataclasses.dataclass(frozen=False)
 class StepperPos:
     save_file: str
@@ -106,12 +148,32 @@ class SystemInfo:
 
     savedir: str='.'
 
+    # seconds between the start of consecutive ticks. If 0, ticks run back to back
+    tick_period_s: float=0
+
+    # indices of the balanzas that are never watered
+    not_watered: tuple[int, ...]=(0, 1)
+    # if not None, the weighing of a tick is skipped while the weight model predicts all pots are safe
+    weight_model_info: Optional[WeightModelInfo]=None
+    # if not None, the sampling budget of each tick is spent by priority (see SamplingInfo)
+    sampling_info: Optional[SamplingInfo]=None
+    # if not None, the offsets of the balanzas are corrected for temperature and re-zeroed when empty (see DriftModelInfo)
+    drift_model_info: Optional[DriftModelInfo]=None
+    # if not None, the pump time of each watering is computed to reach the goal in one visit (see DoseControllerInfo)
+    dose_controller_info: Optional[DoseControllerInfo]=None
+
     @property
     def data_savefile(self) -> str: # for the file manager
         return os.path.join(self.savedir, 'data_' + self.name + '.csv')
     @property
     def save_file(self) -> str:
         return os.path.join(self.savedir, self.name + '.json')
+    @property
+    def drift_save_file(self) -> str:
+        return os.path.join(self.savedir, self.name + '_drift.json')
+    @property
+    def dose_save_file(self) -> str:
+        return os.path.join(self.savedir, self.name + '_dose.json')
     def steps_to_move_for_position(self, end_position: Union[int, Position]) -> int:
         if isinstance(end_position, Position):
             end_position = end_position.stepper
@@ -129,23 +191,46 @@ class SystemInfo:
     def get_savefile_from_name(name: str, savedir: str='.') -> str:
         return os.path.join(savedir, name + '.json')
 
-def slice_deque(d: deque, stop: int, start: int=0, step: int=1, length_check: bool=True) -> Generator:
-    if length_check:
-        stop = min(stop, len(d))
-        start = min(start, stop)
-    return (d[i] for i in range(start, stop, step))
+@dataclasses.dataclass
+class SystemReadiness:
+    name: str
+    ready: bool = False
+    n_balanzas: Optional[int] = None
+    attempts: int = 0
+    elapsed_s: float = 0
+    error: Optional[str] = None
+
+def _plain(values) -> list:
+    ''' list of python scalars, with None instead of nan (json has no nan) '''
+    return [None if isinstance(v, float) and math.isnan(v) else v for v in values]
+
+# intensity of the macetas that were watered last tick but barely changed weight
+_watering_intensities = fused(lambda watered, weights, last_weights, min_diff: (watered * (abs(weights - last_weights) < min_diff)).int())
 
 class SystemsManager:
-    def __init__(self, systems: tuple[SystemInfo, ...], maintenance: Maintenance) -> None:
+    def __init__(self, systems: tuple[SystemInfo, ...], maintenance: Maintenance, clock: Optional[MonotonicClock]=None, serial_managers: Optional[tuple[SerialManager, ...]]=None) -> None:
+        '''
+            clock is the time source of the loop and of every wait of the ticks. If
+            serial_managers is given, it is used instead of opening the port of each system
+            (for example the simulated arduinos of simulator.py)
+        '''
         self.systems = tuple(systems)
         self.n_systems = len(self.systems)
-        self.serial_managers = tuple(
-            SerialManager(
-                port=s.sm_info.port,
-                baud_rate=s.sm_info.baud_rate,
-                delay_s=s.sm_info.delay_s)
-            for s in self.systems
-        )
+        self.halt_control = HaltControl()
+        if serial_managers is not None:
+            if len(serial_managers) != self.n_systems:
+                raise IndexError(f'serial_managers should be of length {self.n_systems}')
+            self.serial_managers = tuple(serial_managers)
+        else:
+            self.serial_managers = tuple(
+                SerialManager(
+                    port=s.sm_info.port,
+                    baud_rate=s.sm_info.baud_rate,
+                    delay_s=s.sm_info.delay_s,
+                    halt_control=self.halt_control,
+                    baud_rates=s.sm_info.baud_rates)
+                for s in self.systems
+            )
         self.balanzas = tuple(
             Balanzas(
                 serial_manager=sm,
@@ -153,11 +238,21 @@ class SystemsManager:
                 n_statistics=s.balanzas_info.n_statistics,
                 n_arduino=s.balanzas_info.n_arduino,
                 err_threshold=s.balanzas_info.err_threshold,
-                save_file=s.balanzas_info.save_file) 
+                save_file=s.balanzas_info.save_file,
+                halt_control=self.halt_control) 
             for s, sm in zip(self.systems, self.serial_managers)
         )
+        self.supervisors = tuple(
+            SerialSupervisor(
+                serial_manager=sm,
+                handshake=lambda i=i: self._recovery_handshake(i),
+                reset_pin=s.sm_info.reset_pin,
+                port_patterns=s.sm_info.port_patterns,
+                busy_ports=lambda i=i: self._ports_of_others(i))
+            for i, (s, sm) in enumerate(zip(self.systems, self.serial_managers))
+        )
         self.file_managers = tuple(
-            FileManager(s.n_balanzas, s.data_savefile)
+            FileManager(s.n_balanzas, s.data_savefile, s.name)
             for s in self.systems
         )
         self.intensities_all = list(
@@ -168,84 +263,291 @@ class SystemsManager:
             sa.zeros(s.n_balanzas, int)
             for s in self.systems
         )
+        self.tick_counts = [0]*self.n_systems
+        self.weight_models = tuple(
+            WeightModel(s.n_balanzas, s.weight_model_info) if s.weight_model_info is not None else None
+            for s in self.systems
+        )
+        self.drift_models = tuple(
+            # without a calibration yet the saved model can't be checked against its offsets
+            DriftModel(s.n_balanzas, s.drift_model_info, s.drift_save_file, b.offsets.values() if b.offsets is not None else None) if s.drift_model_info is not None else None
+            for s, b in zip(self.systems, self.balanzas)
+        )
+        for balanzas, drift_model in zip(self.balanzas, self.drift_models):
+            balanzas.drift = drift_model
+        self.dose_controllers = tuple(
+            DoseController(s.n_balanzas, s.dose_controller_info, s.dose_save_file) if s.dose_controller_info is not None else None
+            for s in self.systems
+        )
 
         # checks
         self.history_length = 30
-        # accessed like self.weights_history[system_index][balanza_inedex][history_index]
+        # the "watering too much" check never fired with the deques (it compared against the
+        # failed checks of the whole system), and the intensities are 0 or 1, never above its
+        # threshold of 10. It stays off until it is reviewed on its own
+        self.check_watering_too_much = False
+        # one [tick, balanza] ring matrix per system, holding the last history_length ticks
+        # accessed like self.weights_history[system_index].column(balanza_index)[history_index]
+        # the row -1 is the newest
+        self.weights_history: tuple[SmartMatrix,...] = tuple(SmartMatrix(s.n_balanzas, self.history_length, float, ring=True) for s in self.systems)
+        self.watering_history: tuple[SmartMatrix,...] = tuple(SmartMatrix(s.n_balanzas, self.history_length, bool, ring=True) for s in self.systems)
+        self.intensities_history: tuple[SmartMatrix,...] = tuple(SmartMatrix(s.n_balanzas, self.history_length, int, ring=True) for s in self.systems)
         # the left side of the deque is the newest
-        self.weights_history: tuple[tuple[deque[float],...],...] = tuple(tuple(deque(maxlen=self.history_length) for _ in range(s.n_balanzas)) for s in self.systems)
-        self.watering_history: tuple[tuple[deque[bool],...],...] = tuple(tuple(deque(maxlen=self.history_length) for _ in range(s.n_balanzas)) for s in self.systems)
-        self.intensities_history: tuple[tuple[deque[int],...],...] = tuple(tuple(deque(maxlen=self.history_length) for _ in range(s.n_balanzas)) for s in self.systems)
         self.timing_history: tuple[deque[datetime],...] = tuple(deque(maxlen=self.history_length) for _ in range(self.n_systems)) # para esto no necesito una sublista para cada balanza, dado que las balanzas se miden en simultaneo
-        self.failed_checks_history: tuple[tuple[deque[bool],...],...] = tuple(tuple(deque(maxlen=self.history_length) for _ in range(s.n_balanzas)) for s in self.systems)
+        self.failed_checks_history: tuple[SmartMatrix,...] = tuple(SmartMatrix(s.n_balanzas, self.history_length, bool, ring=True) for s in self.systems)
+        # weights_history only has the measured weights (nan for the balanzas that were not read in a
+        # partial read). These are the weights of the last tick, with the predictions for the ones not read
+        self.last_means: list[Optional[SmartArray]] = [None]*self.n_systems
         # accessed like self.weights_history[system_index][balanza_inedex]
         self.inhabilitated_balanzas: tuple[SmartArray,...] = tuple(sa.zeros(s.n_balanzas, bool) for s in self.systems)
 
-        # flags
-        self.halt_flag = False
+        # begin
+        self.begin_backoff_initial_s = .5
+        self.begin_backoff_max_s = 8
+        self.readiness: list[SystemReadiness] = list(SystemReadiness(s.name) for s in self.systems)
+        self.recovery_deadline_s = 10
+        # a tick gives up after this many failed acquisitions
+        self.read_retries = 3
+
+        # scheduling
+        self.clock = MonotonicClock() if clock is None else clock
+        self.scheduler: Optional[Scheduler] = None
+        self.dht_period_s = 60
+        self.flush_period_s = 60
+        self._periodic_tasks: list[tuple[str, float, Callable[[], Any], bool]] = list()
+        self._tick_tasks: list[Optional[PeriodicTask]] = [None]*self.n_systems
+        # a system without link is ticked again after this at least (or the backoff of its supervisor)
+        self.link_retry_s = 1
+        self._dht_cache: list[Optional[tuple[float, Optional[float], Optional[float]]]] = [None]*self.n_systems
+        self._first_tick = [True]*self.n_systems
+        self.min_weight_diff = 5
+        # the old loop never updated the intensities (its first-tick flag was never cleared).
+        # The feedback stays off so the scheduler doesn't change the watering
+        self.intensity_feedback = False
+
+        # shared memory for the monitors, see publish_live_state
+        self.live_state: Optional[LiveStateWriter] = None
+
+        # process that writes the csv and the logs, see start_persistence_process
+        self.persistence: Optional[PersistenceProcess] = None
+
+        # client that ships the rows of the csv to the aggregator, see start_collector
+        self.collector: Optional[CollectorClient] = None
+
+        # profiling of the phases of the ticks, see enable_tick_profiler
+        self.profiler: Optional[TickProfiler] = None
+
+        # commands from other threads (control_api.py), run by the loop in between the ticks
+        self.commands: queue.SimpleQueue[tuple[Callable[[], Any], Future]] = queue.SimpleQueue()
+        # last status of each system, rebuilt by the loop after each tick so other threads can read it
+        self._status: list[dict] = [self._build_status(i) for i in range(self.n_systems)]
+
+        # halt
         self.maintenance = maintenance
+        self.halt_control.add_listener(self._on_halt_changed)
         self.maintenance.begin_maintenance(lambda: self.halt(True))
         self.maintenance.end_maintenance(lambda: self.halt(False))
 
+    @property
+    def halt_flag(self) -> bool:
+        return self.halt_control.halted
+
     def halt(self, state: bool) -> None:
-        self.halt_flag = state
+        '''
+            halts (or resumes) the system. Measurements in progress are interrupted right away,
+            hardware movements (stepper, servo, pump) in progress are finished first
+        '''
+        self.halt_control.set(state)
 
-    def check_halt(self) -> bool:
-        if self.halt_flag:
+    def _on_halt_changed(self, state: bool) -> None:
+        lh.info(f'Sistema {"detenido" if state else "reanudado"}')
+        if self.scheduler is not None:
+            if state:
+                self.scheduler.pause()
+            else:
+                self.scheduler.resume()
+        if state:
             self.maintenance.led_pulse()
-            return True
         else:
             self.maintenance.led_on()
-            return False
+        if self.live_state is not None:
+            self.live_state.publish_halted(state)
 
-    def begin_single(self, index: int) -> None:
+    def publish_live_state(self, path: Optional[str]=None) -> None:
+        '''
+            publishes the state of every system after each tick in a shared memory segment
+            (live_state.default_path() if path is None), which LiveStateReader reads
+        '''
+        if self.live_state is not None:
+            self.live_state.close()
+        self.live_state = LiveStateWriter([s.name for s in self.systems], [s.n_balanzas for s in self.systems], path)
+        self.live_state.publish_halted(self.halt_control.halted)
+        lh.info(f'Estado en vivo publicado en {self.live_state.path}')
+
+    def start_persistence_process(self, queue_size: int=10000) -> None:
+        '''
+            moves the csv writes of the FileManagers and the log files to their own process
+            (see persistence.py). It is stopped at exit, after writing what is left
+        '''
+        if self.persistence is not None:
+            return
+        self.persistence = PersistenceProcess(queue_size)
+        self.persistence.start()
+        for file_manager in self.file_managers:
+            file_manager.persistence = self.persistence
+        atexit.register(self.persistence.stop)
+
+    def start_collector(self, info: Optional[CollectorInfo]=None) -> None:
+        ''' ships the rows of the csv of every system to an aggregator (see collector.py and aggregator.py) '''
+        if self.collector is not None:
+            return
+        self.collector = CollectorClient(info)
+        self.collector.start()
+        for file_manager in self.file_managers:
+            file_manager.collector = self.collector
+        atexit.register(self.collector.stop)
+
+    def enable_tick_profiler(self, info: Optional[TickProfilerInfo]=None) -> None:
+        ''' profiles some of the ticks split by phase and writes the profiles to info.profile_dir (see tick_profiler.py) '''
+        self.profiler = TickProfiler(info)
+        lh.info(f'Perfilado de ticks activado en {self.profiler.info.profile_dir}')
+
+    def _phase(self, name: str) -> None:
+        if self.profiler is not None:
+            self.profiler.phase(name)
+
+    def _publish_live(self, index: int, means: Optional[SmartArray], stdevs: Optional[SmartArray], to_water: Optional[SmartArray], hum: Optional[float], temp: Optional[float], tick_start: float, skipped: bool=False) -> None:
+        ''' means None is a failed tick, the last weights are kept '''
+        if self.live_state is None:
+            return
+        n_balanzas = self.systems[index].n_balanzas
+        if means is None:
+            last_means = self.last_means[index]
+            means = last_means if last_means is not None else sa.filled(n_balanzas, float('nan'), float)
+            stdevs = sa.filled(n_balanzas, float('nan'), float)
+            to_water = sa.zeros(n_balanzas, bool)
+        now = self.clock.monotonic()
+        self.live_state.publish(index, SystemState(
+            tick_count=self.tick_counts[index], last_tick_wall=time(), last_tick_mono=now, last_tick_dt=now-tick_start,
+            hum=hum, temp=temp, ready=self.readiness[index].ready, link_dead=self.supervisors[index].link_dead, skipped=skipped,
+            means=means, stdevs=stdevs, to_water=to_water, intensities=self.intensities_all[index], inhabilitated=self.inhabilitated_balanzas[index]
+        ))
+
+    def check_halt(self) -> bool:
+        return self.halt_control.halted
+
+    def begin_single(self, index: int, deadline_s: Optional[float]=None) -> None:
         if index < 0 or index >= len(self.systems):
             raise IndexError(f'{index} < 0 or {index} >= {len(self.systems)}')
         
         self.balanzas[index].load()
 
+        readiness = self._begin_system(index, deadline_s)
+        self.readiness[index] = readiness
+        if not readiness.ready:
+            raise RuntimeError(f'Sistema {index}: no se pudo iniciar ({readiness.error})')
+
+    def _begin_system(self, index: int, deadline_s: Optional[float]=None) -> SystemReadiness:
+        '''
+            opens the port of the system, checks the connection and that the number of
+            balanzas matches. Failed steps are retried with exponential backoff until
+            deadline_s seconds have passed (forever if deadline_s is None). The deadline is
+            checked between attempts, so a single attempt can end a few seconds after it
+        '''
         system = self.systems[index]
         sm = self.serial_managers[index]
-        sm.open()
-        sleep(1)
+        readiness = SystemReadiness(system.name)
+        start_time = self.clock.monotonic()
+        deadline = None if deadline_s is None else start_time + deadline_s
 
-        # check port ok
-        while not sm.cmd_ok():
-            sleep(1)
+        def retry(step: str, f: Callable[[], Any]) -> Any:
+            backoff_s = self.begin_backoff_initial_s
+            while True:
+                readiness.attempts += 1
+                try:
+                    res = f()
+                except Exception as err:
+                    lh.warning(f'Sistema {index}: fallo {step} ({err})')
+                    res = None
+                if res:
+                    return res
+                if deadline is not None and self.clock.monotonic() + backoff_s > deadline:
+                    readiness.error = f'se agoto el tiempo en {step}'
+                    return None
+                self.clock.sleep(backoff_s)
+                backoff_s = min(backoff_s * 2, self.begin_backoff_max_s)
 
-        # detach stepper
-        sm.cmd_servo_attach(False)
+        def open_port() -> bool:
+            sm.open()
+            # the arduino resets when the port is opened
+            self.clock.sleep(1)
+            return True
 
-        # check that the number of balanzas matches
-        n_balanzas = None
-        while n_balanzas is None:
-            n_balanzas = sm.cmd_hx_n()
-            sleep(1)
-        if not self.systems[index].n_balanzas == n_balanzas:
-            raise ValueError('La cantidad de balanzas reportada y la esperada no son iguales')
-    
-    def begin(self) -> None:
+        try:
+            # open port and check port ok
+            if retry('open', open_port) and retry('ok', lambda: sm.cmd_ok(retries=1)):
+                if sm.baud_rates:
+                    sm.negotiate_baud_rate()
+
+                # detach stepper
+                sm.cmd_servo_attach(False)
+
+                # check that the number of balanzas matches
+                n_balanzas = retry('hx_n', sm.cmd_hx_n)
+                readiness.n_balanzas = n_balanzas
+                if n_balanzas is not None:
+                    if n_balanzas == system.n_balanzas:
+                        readiness.ready = True
+                    else:
+                        readiness.error = f'La cantidad de balanzas reportada ({n_balanzas}) y la esperada ({system.n_balanzas}) no son iguales'
+        except Exception as err:
+            readiness.error = str(err)
+        readiness.elapsed_s = self.clock.monotonic() - start_time
+
+        if readiness.ready:
+            lh.info(f'Sistema {index}: listo en {readiness.elapsed_s:.1f} s ({readiness.attempts} intentos)')
+        else:
+            lh.critical(f'Sistema {index}: no se pudo iniciar en {readiness.elapsed_s:.1f} s ({readiness.error})')
+        return readiness
+
+    def _recovery_handshake(self, index: int) -> bool:
+        # same sequence as begin, with a short deadline since the supervisor escalates if it fails
+        readiness = self._begin_system(index, self.recovery_deadline_s)
+        self.readiness[index] = readiness
+        return readiness.ready
+
+    def _ports_of_others(self, index: int) -> set[str]:
+        ''' ports of the other systems, the supervisor of index must not open them '''
+        return {sm.port for j, sm in enumerate(self.serial_managers) if j != index}
+
+    def _link_available(self, index: int) -> bool:
+        '''
+            True if the system can talk to its arduino. Otherwise a recovery is started in
+            the background (if it isn't running and its backoff passed)
+        '''
+        supervisor = self.supervisors[index]
+        if supervisor.recovering:
+            return False
+        if not self.readiness[index].ready or supervisor.link_dead:
+            supervisor.recover_async()
+            return False
+        return True
+
+    def begin(self, deadline_s: Optional[float]=120) -> tuple[SystemReadiness, ...]:
+        '''
+            runs the begin sequence of all systems concurrently. Returns a readiness report
+            for each system. Systems that are not ready are skipped by loop(). If no system
+            is ready, a RuntimeError is raised
+        '''
         for b in self.balanzas:
             b.load()
-        for s, sm in zip(self.systems, self.serial_managers):
-            # open port
-            sm.open()
-            sleep(1)
-
-            # check port ok
-            while not sm.cmd_ok():
-                sleep(1)
-
-            # detach stepper
-            sm.cmd_servo_attach(False)
-
-            # check that the number of balanzas matches
-            n_balanzas = None
-            while n_balanzas is None:
-                n_balanzas = sm.cmd_hx_n()
-                sleep(1)
-            if not s.n_balanzas == n_balanzas:
-                raise ValueError('La cantidad de balanzas reportada y la esperada no son iguales')
+        with ThreadPoolExecutor(max_workers=max(self.n_systems, 1)) as executor:
+            report = tuple(executor.map(lambda i: self._begin_system(i, deadline_s), range(self.n_systems)))
+        self.readiness = list(report)
+        lh.info(f'Begin: {sum(r.ready for r in report)}/{self.n_systems} sistemas listos -> {report}')
+        if self.n_systems > 0 and not any(r.ready for r in report):
+            raise RuntimeError(f'Ningun sistema se pudo iniciar: {report}')
+        return report
             
     def show_all_positions(self, index: int, wait_for_user_input: bool=False) -> None:
         if index < 0 or index > len(self.systems):
@@ -279,19 +581,39 @@ class SystemsManager:
         system.save_stepper_pos()
         sm.cmd_servo_attach(False)
 
-    def calibrate_system(self, index: int, n: int=200) -> None:
+    def calibrate_system(self, index: int, n: int=200, multipoint: bool=False, target_error: float=.5) -> None:
+        '''
+            multipoint calibrates with several known loads and a weighted least squares fit
+            (see balanzas.calibrate_multipoint), instead of a tare and a single load
+        '''
         if index < 0 or index >= len(self.systems):
             raise IndexError()
         self.serial_managers[index].cmd_stepper_attach(False)
         self.serial_managers[index].cmd_servo_attach(False)
         balanzas = self.balanzas[index]
         n_balanzas = self.systems[index].n_balanzas
-        balanzas_calibrate(
-            balanzas=balanzas,
-            n_balanzas=n_balanzas,
-            n=n,
-            offset_temp_file=f'.tmp_balanzas_offset_system_{index}.json'
-        )
+        try:
+            if multipoint:
+                balanzas_calibrate_multipoint(balanzas=balanzas, n_balanzas=n_balanzas, n=n, target_error=target_error)
+                return
+            balanzas_calibrate(
+                balanzas=balanzas,
+                n_balanzas=n_balanzas,
+                n=n,
+                offset_temp_file=f'.tmp_balanzas_offset_system_{index}.json'
+            )
+        finally:
+            self._calibrated(index)
+
+    def _calibrated(self, index: int) -> None:
+        ''' the drift model was fitted against the old offsets '''
+        drift_model = self.drift_models[index]
+        offsets = self.balanzas[index].offsets
+        # a calibration that failed before the first offsets were measured leaves nothing to tare
+        if drift_model is None or offsets is None:
+            return
+        drift_model.tared(self._get_dht(index)[1], offsets.values())
+        drift_model.save()
 
     def show_system_weights(self, index: int, n: Optional[int]=None) -> None:
         print(self.balanzas[index].read_stats(n))
@@ -318,17 +640,24 @@ class SystemsManager:
         sm.cmd_servo_attach(False)
 
     @staticmethod
-    def water(position: Position, sm: SerialManager, intensity: int, system: SystemInfo) -> None:
+    def water(position: Position, sm: SerialManager, intensity: int, system: SystemInfo, clock: Optional[MonotonicClock]=None, tiempo_ms: Optional[int]=None) -> None:
+        '''
+            if tiempo_ms is given (by the dose controller), the pump runs that long at the
+            initial pwm of the position instead of following the intensity curves
+        '''
         sm.cmd_servo(90)
         sm.cmd_stepper(system.steps_to_move_for_position(position), detach=True)
         system.stepper_pos.pos = position.stepper
         # save system to save stepper state
         system.save_stepper_pos()
-        sleep(.5)
+        (MonotonicClock() if clock is None else clock).sleep(.5)
         sm.cmd_servo(position.servo)
 
-        tiempo_ms = position.water_time_cruve(intensity)
-        pwm = position.water_pwm_curve(intensity)
+        if tiempo_ms is None:
+            tiempo_ms = position.water_time_cruve(intensity)
+            pwm = position.water_pwm_curve(intensity)
+        else:
+            pwm = position.water_pwm_curve.initial_value
         sm.cmd_pump(tiempo_ms, pwm)
 
         sm.cmd_servo_attach(False)
@@ -339,50 +668,106 @@ class SystemsManager:
         system = self.systems[system_index]
         if balanza_index < 0 or balanza_index >= system.n_balanzas:
             raise IndexError()
-        weight_history = self.weights_history[system_index][balanza_index]
-        watering_history = self.watering_history[system_index][balanza_index]
-        intensities_history = self.intensities_history[system_index][balanza_index]
+        weight_history = self.weights_history[system_index].column(balanza_index)
+        watering_history = self.watering_history[system_index].column(balanza_index)
+        intensities_history = self.intensities_history[system_index].column(balanza_index)
         timing_history = self.timing_history[system_index]
-        failed_checks_history = self.failed_checks_history[system_index]
+        failed_checks_history = self.failed_checks_history[system_index].column(balanza_index)
 
         # si el valor es negativo!
-        if weight_history[0] < 0:
+        if weight_history[-1] < 0:
             lh.critical((f'check before watering: sistema {system_index}, balanza {balanza_index} '
-                        f'-> No paso el chequeo para regar. El peso es negativo ({weight_history[0]})'))
+                        f'-> No paso el chequeo para regar. El peso es negativo ({weight_history[-1]})'))
+            tm.emit('safety_check_failed', system=system_index, balanza=balanza_index, reason='negative_weight', weight=weight_history[-1])
             return False
         
         recent_history = self.history_length - 15
-        if len(watering_history) >= recent_history:
+        if self.check_watering_too_much and len(watering_history) >= recent_history:
             # si viene regando a full hace mucho (no contandi fallos del chequeo)
-            # no se puede indexar un deque con un slice: deaque[1:5] no es posible
-            c1 = tuple(w for w, f in zip(slice_deque(watering_history, recent_history), slice_deque(failed_checks_history, recent_history)) if not f)
-            c2 = tuple(i > 10 for i, f in zip(slice_deque(intensities_history, recent_history), slice_deque(failed_checks_history, recent_history)) if not f)
-            if (all(c1) and len(c1) > 0) and (all(c2) and len(c2) > 0):
+            checked = ~failed_checks_history.last(recent_history)
+            c1 = watering_history.last(recent_history)[checked]
+            c2 = intensities_history.last(recent_history)[checked] > 10
+            if (c1.all() and len(c1) > 0) and (c2.all() and len(c2) > 0):
                 lh.critical((f'check before watering: sistema {system_index}, balanza {balanza_index} '
                             '-> No paso el chequeo para regar. Esta regando demasiado intenso demasiadas '
                             f'veces (watering_history={watering_history}, intensities_history={intensities_history}, '
                             f'weight_history={weight_history})'))
+                tm.emit('safety_check_failed', system=system_index, balanza=balanza_index, reason='watering_too_much', weights=weight_history, intensities=intensities_history)
                 return False
         
         # si vienen muchos valores negativos -> INHABILITAR
-        if sum(w < 0 for w in weight_history) > 5:
+        if (weight_history.values() < 0).sum() > 5:
             lh.critical((f'check before watering: sistema {system_index}, balanza {balanza_index} '
                         f'-> No paso el chequeo para regar. tuvo mas de 5 pesos negativos ({weight_history}). '
                         'Inhabilitando balanza hasta intervencion manual'))
             self.inhabilitated_balanzas[system_index][balanza_index] = True
+            tm.emit('safety_check_failed', system=system_index, balanza=balanza_index, reason='many_negative_weights', weights=weight_history, inhabilitated=True)
             return False
         
         # TODO: seguir completando casos
         return True
 
+    def _waterable(self, index: int) -> SmartArray:
+        ''' mask of the balanzas of the system that can be watered '''
+        system = self.systems[index]
+        inhabilitated = self.inhabilitated_balanzas[index]
+        return SmartArray(tuple(i not in system.not_watered and not inhabilitated[i] for i in range(system.n_balanzas)), bool)
+
+    def _sampling_plan(self, index: int, limits: SmartArray) -> Optional[SmartArray]:
+        '''
+            number of samples to take from each balanza in this tick, or None if all the
+            balanzas should be read together (hx). A single hx reads all balanzas in the time
+            of a single hx_single, so partial reads only pay off while the plan needs less
+            samples in total than n_statistics
+        '''
+        system = self.systems[index]
+        sampling_info = system.sampling_info
+        if sampling_info is None:
+            return None
+        n_full = self.balanzas[index].n_statistics
+        waterable = self._waterable(index)
+        weight_model = self.weight_models[index]
+        rare_tick = self.tick_counts[index] % sampling_info.rare_every == 0
+
+        samples = sa.zeros(system.n_balanzas, int)
+        for i in range(system.n_balanzas):
+            history = self.weights_history[index].column(i)
+            if len(history) == 0:
+                samples[i] = n_full
+            elif not waterable[i]:
+                samples[i] = sampling_info.min_samples if rare_tick else 0
+            elif weight_model is not None and weight_model.pot_is_safe(i, limits[i]):
+                samples[i] = 0
+            else:
+                recent = history.last(sampling_info.recent_history)
+                recent = SmartArray([v for v in recent if not math.isnan(v)], float)
+                distance = self.last_means[index][i] - limits[i]
+                if len(recent) > 1 and recent.std(ddof=1) > sampling_info.high_stdev_grams:
+                    samples[i] = n_full
+                elif distance <= sampling_info.near_grams:
+                    samples[i] = n_full
+                else:
+                    samples[i] = max(sampling_info.min_samples, int(n_full * sampling_info.near_grams / distance))
+        if samples.sum() >= n_full:
+            return None
+        return samples
+
     def tick_single(self, index: int) -> Optional[tuple[SmartArray, SmartArray]]:
         '''
-            if return is None, the system was halted.
+            if return is None, the system was halted or the balanzas couldn't be read.
             else, it returns means and macetas_to_water
         '''
-        if self.check_halt():
+        try:
+            return self._tick_single(index)
+        except HaltedError:
+            lh.info(f'Sistema {index}: Tick interrumpido por mantenimiento')
+            tm.emit('tick_halted', system=index)
             return None
 
+    def _tick_single(self, index: int) -> Optional[tuple[SmartArray, SmartArray]]:
+        self.halt_control.check()
+        tick_start = self.clock.monotonic()
+
         system = self.systems[index]
         serial_manager = self.serial_managers[index]
         balanzas = self.balanzas[index]
@@ -390,83 +775,391 @@ class SystemsManager:
         grams_goals = SmartArray(system.grams_goals, float)
         intensities = self.intensities_all[index]
         grams_threshold = system.grams_threshold
+        # the weight under which a pot is watered
+        limits = grams_goals - grams_threshold
+
+        # the dht is read first so the weight model can use the current conditions
+        self._phase('dht')
+        hum, temp = self._get_dht(index)
+
+        self._phase('stats')
+
+        weight_model = self.weight_models[index]
+        if weight_model is not None:
+            weight_model.predict(self.clock.monotonic(), hum, temp)
+            if weight_model.can_skip(limits, self._waterable(index)):
+                weight_model.skip()
+                means, stdevs = weight_model.predicted()
+                lh.debug('Sistema %s: Se salteo la medicion. Pesos predichos %s +/- %s', index, means, stdevs)
+                self._phase('persist')
+                tm.emit('tick_skipped', system=index, means=means, stdevs=stdevs, hum=hum, temp=temp, dt=self.clock.monotonic()-tick_start)
+                self._publish_live(index, means, stdevs, sa.zeros(system.n_balanzas, bool), hum, temp, tick_start, skipped=True)
+                return means, sa.zeros(system.n_balanzas, bool)
+
+        samples = self._sampling_plan(index, limits)
+        self.tick_counts[index] += 1
 
         # leer datos
+        self._phase('acquire')
         res = None
-        while res is None:
-            res = balanzas.read_stats()
-            if res is None:
-                sleep(1)
-                lh.warning(f'Sistema {index}: No se pudo leer las balanzas. Volviendo a intentar...')
-        vals, n_filtered, n_unsuccessful = res
+        for attempt in range(self.read_retries):
+            if samples is None:
+                res = balanzas.read_stats(temp=temp)
+            else:
+                res = balanzas.read_stats_partial(samples, temp=temp)
+            if res is not None or self.supervisors[index].link_dead:
+                break
+            lh.warning(f'Sistema {index}: No se pudo leer las balanzas. Volviendo a intentar...')
+            self.halt_control.sleep(1)
+        if res is None:
+            lh.error(f'Sistema {index}: No se pudo leer las balanzas. Se saltea el tick')
+            tm.emit('tick_failed', system=index, link_dead=self.supervisors[index].link_dead, dt=self.clock.monotonic()-tick_start)
+            self._publish_live(index, None, None, None, hum, temp, tick_start)
+            return None
+        if samples is None:
+            read = None
+            vals, n_filtered, n_unsuccessful = res
+        else:
+            read, vals, n_filtered, n_unsuccessful = res
         if len(vals) != system.n_balanzas:
             lh.warning(f'Sistema {index}: Al leer se obtuvo una lista de largo {len(vals)} cuando hay {system.n_balanzas} balanzas')
 
+        self._phase('stats')
         means = vals.values()
         stdevs = vals.errors()
+        # what the weight model expected each pot to lose since its last weighing, before it is updated
+        expected_changes = self._expected_changes(index)
+        if self.drift_models[index] is not None:
+            self._update_drift(index, means, read, expected_changes)
+        dose_controller = self.dose_controllers[index]
+        if dose_controller is not None:
+            dose_controller.update(self.clock.monotonic(), means, stdevs, read, expected_changes)
+        if read is not None and not read.all():
+            # the balanzas that were not read take the prediction of the model or their last weight
+            # (the balanzas without history are always read, see _sampling_plan)
+            not_read = ~read
+            fallback_means = self.last_means[index]
+            if fallback_means is None:
+                fallback_means = sa.filled(system.n_balanzas, float('nan'), float)
+            fallback_stdevs = sa.filled(system.n_balanzas, float('nan'), float)
+            if weight_model is not None:
+                predicted_means, predicted_stdevs = weight_model.predicted()
+                initialized = weight_model.initialized()
+                fallback_means = sa.where(initialized, predicted_means, fallback_means)
+                fallback_stdevs = sa.where(initialized, predicted_stdevs, fallback_stdevs)
+            means[not_read] = fallback_means[not_read]
+            stdevs[not_read] = fallback_stdevs[not_read]
+        if weight_model is not None:
+            weight_model.update(means, stdevs, read)
 
-        macetas_to_water = means < (grams_goals - grams_threshold)
+        macetas_to_water = means < limits
 
         # agregar datos de mediciones para chequear que todo esta en orden
+        self._phase('checks')
         self.timing_history[index].appendleft(datetime.now().strftime('%Y-%m-%d_%H-%M-%S'))
-        for i in range(system.n_balanzas):
-            self.weights_history[index][i].appendleft(means[i])
-            self.watering_history[index][i].appendleft(macetas_to_water[i])
-            self.intensities_history[index][i].appendleft(intensities[i])
-            self.failed_checks_history[index][i].appendleft(self.inhabilitated_balanzas[index][i])
-        lh.debug(f'Datos de mediciones - sistema {index}: pesos={vals}, a_regar={macetas_to_water}, intensidades={intensities}')
-
-        if self.check_halt():
-            return None
-
-        for i, (w, intensity, position) in enumerate(zip(macetas_to_water, intensities, system.positions)):
-            if i in (0,1): continue
-            if self.inhabilitated_balanzas[index][i]: continue
-            if w:
-                if self._check_all_right(index, i):
-                    SystemsManager.water(
-                        position=position,
-                        sm=serial_manager,
-                        intensity=intensity,
-                        system=system
-                    )
-                    lh.info(f'Tick: Watering {i}, starting with weight {means[i]} +/- {stdevs[i]}, goal of {grams_goals[i]} and threashold of {grams_threshold}')
-                else:
-                    self.failed_checks_history[index][i][-1] = True
-        
-        res = serial_manager.cmd_dht()
-        if res is not None:
-            hum, temp = res
+        if read is None:
+            self.weights_history[index].append_row(means)
         else:
-            hum = None
-            temp = None
+            # the predictions are not measurements, the checks only look at what was read
+            self.weights_history[index].append_row(sa.where(read, means, float('nan')))
+        self.last_means[index] = means.copy()
+        self.watering_history[index].append_row(macetas_to_water)
+        self.intensities_history[index].append_row(intensities)
+        self.failed_checks_history[index].append_row(self.inhabilitated_balanzas[index])
+        if is_enabled_for(logging.DEBUG):
+            lh.debug(fields(f'Datos de mediciones - sistema {index}', pesos=means, errores=stdevs, a_regar=macetas_to_water, intensidades=intensities))
+
+        self._phase('water')
+        halted = False
+        pots_to_water = (macetas_to_water & self._waterable(index)).nonzero()
+        for n, i in enumerate(pots_to_water):
+            # a started watering is finished, but no new one starts once halted
+            if self.halt_control.halted:
+                # the pots that were not reached are recorded as not watered, and the tick is still saved
+                for j in pots_to_water[n:]:
+                    macetas_to_water[j] = False
+                    self.watering_history[index][-1, j] = False
+                halted = True
+                lh.info(f'Sistema {index}: Riego interrumpido por mantenimiento, quedaron sin regar {list(pots_to_water[n:])}')
+                break
+            intensity = intensities[i]
+            self._phase('checks')
+            ok = self._check_all_right(index, i)
+            self._phase('water')
+            if ok:
+                dose_ms = None if dose_controller is None else dose_controller.dose(i, means[i], grams_goals[i])
+                SystemsManager.water(
+                    position=system.positions[i],
+                    sm=serial_manager,
+                    intensity=intensity,
+                    system=system,
+                    clock=self.clock,
+                    tiempo_ms=dose_ms
+                )
+                lh.info(f'Tick: Watering {i}, starting with weight {means[i]} +/- {stdevs[i]}, goal of {grams_goals[i]} and threashold of {grams_threshold}')
+                tm.emit('water', system=index, balanza=i, intensity=intensity, weight=means[i], stdev=stdevs[i], goal=grams_goals[i], dose_ms=dose_ms)
+                if weight_model is not None:
+                    weight_model.watered(i)
+                if dose_controller is not None:
+                    dose_controller.watered(i, self.clock.monotonic(), means[i], stdevs[i], dose_ms)
+            else:
+                # the row 0 is the oldest, where the deque put it
+                self.failed_checks_history[index][0, i] = True
 
+        self._phase('persist')
+        read_mask = sa.filled(system.n_balanzas, True, bool) if read is None else read
         file_manager.add_entry(
             means, stdevs, macetas_to_water, n_filtered, n_unsuccessful,
-            grams_goals, grams_threshold, hum, temp
+            grams_goals, grams_threshold, hum, temp, read_mask
         )
+        tm.emit('tick', system=index, means=means, stdevs=stdevs, to_water=macetas_to_water, read=read_mask,
+                intensities=intensities, n_filtered=n_filtered, n_unsuccessful=n_unsuccessful,
+                hum=hum, temp=temp, halted=halted, dt=self.clock.monotonic()-tick_start)
+        self._publish_live(index, means, stdevs, macetas_to_water, hum, temp, tick_start)
 
         return means, macetas_to_water
  
-    def loop(self):
-        first = True
-        min_weight_diff = 5
+    def _expected_changes(self, index: int) -> Optional[SmartArray]:
+        '''
+            change of the weight of each pot since the last tick predicted by the weight model
+            (the evapotranspiration), 0 for the pots it doesn't know yet. None without a weight
+            model. Waterings are not included
+        '''
+        weight_model = self.weight_models[index]
+        last_means = self.last_means[index]
+        if weight_model is None or last_means is None:
+            return None
+        predicted_means, _ = weight_model.predicted()
+        return sa.where(weight_model.initialized(), predicted_means - last_means, 0.)
+
+    def _update_drift(self, index: int, means: SmartArray, read: Optional[SmartArray], expected_changes: Optional[SmartArray]) -> None:
+        '''
+            feeds the reading of this tick to the drift model of the system. A balanza is empty
+            if it weighs almost nothing (the pot was taken off), and stable if its pot was not
+            watered after the previous reading, in which case it should have changed by
+            expected_changes. Without a weight model (or before it knows the pot) the change is
+            unknown, so there are no stable balanzas
+        '''
+        drift_info = self.systems[index].drift_model_info
+        empty = abs(means) < drift_info.empty_grams
+        history = self.weights_history[index]
+        weight_model = self.weight_models[index]
+        if len(history) == 0 or expected_changes is None or weight_model is None:
+            stable = sa.zeros(len(means), bool)
+        else:
+            stable = ~(self.watering_history[index].row(-1) & self._waterable(index)) & weight_model.initialized()
+        if read is not None:
+            empty &= read
+            stable &= read
+        n_used = self.balanzas[index].update_drift(empty, stable, expected_changes, self.clock.monotonic())
+        if n_used > 0:
+            drift_model = self.drift_models[index]
+            tm.emit('drift_update', system=index, n_used=n_used, empty=empty,
+                    shifts=[f.shift for f in drift_model.filters], coefs=[f.coef for f in drift_model.filters])
+
+    def add_periodic_task(self, name: str, period_s: float, callback: Callable[[], Any], pausable: bool=True) -> None:
+        ''' registers a task that loop() runs every period_s seconds along with the ticks '''
+        self._periodic_tasks.append((name, period_s, callback, pausable))
+
+    def _read_dht(self, index: int) -> tuple[Optional[float], Optional[float]]:
+        if not self._link_available(index):
+            return None, None
+        res = self.serial_managers[index].cmd_dht()
+        hum, temp = res if res is not None else (None, None)
+        self._dht_cache[index] = (self.clock.monotonic(), hum, temp)
+        return hum, temp
 
+    def _get_dht(self, index: int) -> tuple[Optional[float], Optional[float]]:
+        ''' last dht reading of the system, read again if it is older than dht_period_s '''
+        cache = self._dht_cache[index]
+        if cache is None or self.clock.monotonic() - cache[0] > self.dht_period_s:
+            return self._read_dht(index)
+        return cache[1], cache[2]
+
+    def _flush(self) -> None:
+        tm.flush(timeout=0)
+        for handler in lh.handlers:
+            handler.flush()
+
+    def _tick(self, index: int) -> None:
+        try:
+            self._tick_and_adjust(index)
+        finally:
+            self._status[index] = self._build_status(index)
+
+    def _defer_tick(self, index: int) -> None:
+        ''' with a short tick_period_s, the tick of a system without link would spin '''
+        task = self._tick_tasks[index]
+        if self.scheduler is None or task is None:
+            return
+        retry_s = max(self.link_retry_s, self.supervisors[index].retry_in_s)
+        if task.period_s < retry_s:
+            self.scheduler.defer(task, retry_s)
+
+    def _tick_and_adjust(self, index: int) -> None:
+        if not self._link_available(index):
+            self._defer_tick(index)
+            return
+        if self.profiler is None:
+            res = self.tick_single(index)
+        else:
+            self.profiler.begin(index, self.tick_counts[index])
+            try:
+                res = self.tick_single(index)
+            finally:
+                self.profiler.end()
+        self.serial_managers[index].check_error_rate()
+        if res is None:
+            if self.supervisors[index].link_dead:
+                self.supervisors[index].recover_async()
+            return
+        weights, watered_last_tick = res
+
+        if self.intensity_feedback and not self._first_tick[index]:
+            # pots that were watered but barely changed their weight get intensity 1
+            self.intensities_all[index] = _watering_intensities(watered_last_tick, weights, self.last_weights_all[index], self.min_weight_diff)
+        self._first_tick[index] = False
+
+        self.last_weights_all[index] = weights
+
+    def submit(self, callback: Callable[[], Any]) -> Future:
+        '''
+            queues callback to be run by the loop in between the ticks (from run_commands), so
+            it never races the serial I/O of a tick. The result (or the exception) is set in
+            the returned future
+        '''
+        future = Future()
+        self.commands.put((callback, future))
+        return future
+
+    def run_commands(self) -> int:
+        ''' runs the queued commands. Should only be called from the thread of the loop '''
+        n = 0
         while True:
-            if not self.check_halt():
-                for i in range(self.n_systems):
-                    res = self.tick_single(i)
-                    if res is None:
-                        break
-                    weights, watered_last_tick = res
+            try:
+                callback, future = self.commands.get_nowait()
+            except queue.Empty:
+                return n
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(callback())
+            except BaseException as err:
+                future.set_exception(err)
+            n += 1
+            for i in range(self.n_systems):
+                self._status[i] = self._build_status(i)
 
-                    if not first:
-                        first = False
+    def _check_indexes(self, index: int, balanza_index: Optional[int]=None) -> None:
+        if index < 0 or index >= self.n_systems:
+            raise IndexError(f'{index} < 0 or {index} >= {self.n_systems}')
+        n_balanzas = self.systems[index].n_balanzas
+        if balanza_index is not None and (balanza_index < 0 or balanza_index >= n_balanzas):
+            raise IndexError(f'{balanza_index} < 0 or {balanza_index} >= {n_balanzas}')
 
-                        weight_diff = abs(weights - self.last_weights_all[i])
-                        self.intensities_all[i] = (watered_last_tick * (weight_diff < min_weight_diff)).int()
+    def water_now(self, index: int, balanza_index: int, intensity: int=0) -> None:
+        ''' waters a pot right away, regardless of its weight '''
+        self._check_indexes(index, balanza_index)
+        self.halt_control.check()
+        if not self._link_available(index):
+            raise RuntimeError(f'Sistema {index}: El arduino no esta disponible')
+        system = self.systems[index]
+        SystemsManager.water(system.positions[balanza_index], self.serial_managers[index], intensity, system, clock=self.clock)
+        lh.info(f'Sistema {index}: Riego manual de la balanza {balanza_index} con intensidad {intensity}')
+        tm.emit('water', system=index, balanza=balanza_index, intensity=intensity, manual=True)
+        if self.weight_models[index] is not None:
+            self.weight_models[index].watered(balanza_index)
 
-                    self.last_weights_all[i] = weights
-            else:
-                sleep(.1)
+    def enable_balanza(self, index: int, balanza_index: int) -> None:
+        '''
+            manual intervention on an inhabilitated balanza. Its negative weights are forgotten,
+            otherwise the check would inhabilitate it again on the next watering
+        '''
+        self._check_indexes(index, balanza_index)
+        self.inhabilitated_balanzas[index][balanza_index] = False
+        history = self.weights_history[index].column(balanza_index)
+        for i in range(len(history)):
+            if history[i] < 0:
+                history[i] = float('nan')
+        lh.info(f'Sistema {index}: Balanza {balanza_index} habilitada manualmente')
+        tm.emit('balanza_enabled', system=index, balanza=balanza_index)
+
+    def tare(self, index: int) -> bool:
+        ''' measures the offsets of all the balanzas of the system again. They should be empty '''
+        self._check_indexes(index)
+        if not self._link_available(index):
+            raise RuntimeError(f'Sistema {index}: El arduino no esta disponible')
+        balanzas = self.balanzas[index]
+        if not balanzas.calibrate_offset():
+            return False
+        balanzas.save()
+        self._calibrated(index)
+        lh.info(f'Sistema {index}: Tara realizada. Offsets {balanzas.offsets}')
+        tm.emit('tare', system=index, offsets=balanzas.offsets.values())
+        return True
+
+    def _build_status(self, index: int) -> dict:
+        ''' plain (json serializable) copy of the state of a system, see status() '''
+        system = self.systems[index]
+        supervisor = self.supervisors[index]
+        weights = self.weights_history[index]
+        last_means = self.last_means[index]
+        return {
+            'name': system.name,
+            'ready': self.readiness[index].ready,
+            'link_dead': supervisor.link_dead,
+            'tick_count': self.tick_counts[index],
+            'weights': _plain(last_means) if last_means is not None else None,
+            'goals': list(system.grams_goals),
+            'intensities': _plain(self.intensities_all[index]),
+            'inhabilitated': _plain(self.inhabilitated_balanzas[index]),
+            'error_rate': self.serial_managers[index].error_rate,
+            'history': {
+                # oldest first
+                'time': list(reversed(self.timing_history[index])),
+                'weights': [_plain(r) for r in weights.rows()],
+                'watering': [_plain(r) for r in self.watering_history[index].rows()],
+                'intensities': [_plain(r) for r in self.intensities_history[index].rows()],
+            },
+        }
+
+    def status(self, history: bool=False) -> dict:
+        ''' state of every system as of their last tick or command. Safe to call from any thread '''
+        systems = list(self._status)
+        if not history:
+            systems = [{k: v for k, v in s.items() if k != 'history'} for s in systems]
+        return {'halted': self.halt_flag, 'systems': systems}
 
+    def metrics(self) -> dict:
+        tasks = list() if self.scheduler is None else list(self.scheduler.tasks)
+        return {
+            'halted': self.halt_flag,
+            'pending_commands': self.commands.qsize(),
+            'telemetry_dropped': tm.n_dropped,
+            'persistence_dropped': None if self.persistence is None else self.persistence.n_dropped,
+            'persistence_full': None if self.persistence is None else self.persistence.n_full,
+            'collector': None if self.collector is None else {'sent': self.collector.n_sent, 'spooled': len(self.collector.spooled()), 'dropped': self.collector.n_dropped, 'rejected': self.collector.n_rejected},
+            'profiler': None if self.profiler is None else {'profiled': self.profiler.n_profiled, 'slow': self.profiler.n_slow},
+            'tasks': {t.name: {'runs': t.n_runs, 'missed': t.n_missed, 'last_duration_s': t.last_duration_s} for t in tasks},
+        }
+
+    def loop(self, max_runs: Optional[int]=None) -> None:
+        '''
+            runs the tick of each system every tick_period_s seconds, along with the dht reads,
+            the flushes of the logs and the tasks added with add_periodic_task
+        '''
+        self.scheduler = Scheduler(self.clock)
+        for i, s in enumerate(self.systems):
+            # systems that are not ready also get their tasks, their supervisor keeps trying to bring them up
+            self.scheduler.add_task(f'dht_{i}', self.dht_period_s, lambda i=i: self._read_dht(i))
+            self._tick_tasks[i] = self.scheduler.add_task(f'tick_{i}', s.tick_period_s, lambda i=i: self._tick(i))
+            if self.drift_models[i] is not None:
+                self.scheduler.add_task(f'drift_save_{i}', s.drift_model_info.save_period_s, self.drift_models[i].save, pausable=False)
+            if self.dose_controllers[i] is not None:
+                self.scheduler.add_task(f'dose_save_{i}', s.dose_controller_info.save_period_s, self.dose_controllers[i].save, pausable=False)
+        self.scheduler.add_task('flush', self.flush_period_s, self._flush, pausable=False)
+        for name, period_s, callback, pausable in self._periodic_tasks:
+            self.scheduler.add_task(name, period_s, callback, pausable=pausable)
+        if self.check_halt():
+            self.scheduler.pause()
+        self.scheduler.run(max_runs)
@@ -0,0 +1,322 @@
+import os
+import json
+import gzip
+import queue
+import atexit
+import threading
+from time import monotonic, time
+from datetime import datetime, date, timedelta
+from typing import Any, Callable, Iterator, List, Optional, Union
+from logging_helper import logger as lh
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+def _encode_default(v: Any) -> Any:
+    # ufloats (from uncertainties) are stored as [nominal_value, std_dev]
+    if hasattr(v, 'nominal_value') and hasattr(v, 'std_dev'):
+        return [v.nominal_value, v.std_dev]
+    if hasattr(v, '__iter__'):
+        return list(v)
+    return str(v)
+
+def _snapshot(v: Any) -> Any:
+    # mutable containers (SmartArray, deques, lists) are copied when the
+    # record is emitted so later changes in the control loop don't leak in
+    if isinstance(v, (str, bytes, int, float, bool)) or v is None:
+        return v
+    if isinstance(v, dict):
+        return {k: _snapshot(e) for k, e in v.items()}
+    if hasattr(v, '__iter__'):
+        return list(v)
+    return v
+
+
+class TelemetrySink:
+    '''
+        Machine readable telemetry channel. Every record is a flat dict with
+        a kind, a monotonic timestamp (mono), a wall clock timestamp (wall) and
+        a sequence number (seq), plus the fields passed to emit.
+
+        Records are queued and written by a background thread, so emit never
+        blocks the control loop on disk I/O. The current segment is rotated
+        when it grows over max_bytes and rolled segments are gzipped.
+        fmt is either 'jsonl' or 'msgpack' (if the msgpack package is installed).
+        If the writer dies on a disk error (a full SD card), the records are dropped and it is
+        started again after restart_s.
+        Listeners get every record synchronously, in the thread that emits it. If persist is
+        False, records only go to the listeners and nothing is written
+    '''
+    def __init__(self, dirname: str='telemetry', basename: str='labino', fmt: str='jsonl', max_bytes: int=5*1024*1024, backup_count: int=200, flush_interval_s: float=1, queue_size: int=10000, restart_s: float=60) -> None:
+        if fmt not in ('jsonl', 'msgpack'):
+            raise ValueError(f'fmt should be "jsonl" or "msgpack", not "{fmt}"')
+        if fmt == 'msgpack' and msgpack is None:
+            lh.warning('Telemetry: msgpack is not installed. Using jsonl')
+            fmt = 'jsonl'
+        self.dirname = dirname
+        self.basename = basename
+        self.fmt = fmt
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.flush_interval_s = flush_interval_s
+        self.restart_s = restart_s
+        self.enabled = True
+        self.persist = True
+        self._listeners: List[Callable[[dict], None]] = list()
+
+        self._queue: queue.Queue = queue.Queue(maxsize=queue_size)
+        self._seq = 0
+        self._seq_lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._thread_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._flush_done = threading.Event()
+        self._restart_at = 0.
+        self.n_dropped = 0
+
+    @property
+    def extension(self) -> str:
+        return 'jsonl' if self.fmt == 'jsonl' else 'msgpack'
+
+    @property
+    def current_file(self) -> str:
+        return os.path.join(self.dirname, f'{self.basename}.{self.extension}')
+
+    def _writer_alive(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def _start(self) -> None:
+        with self._thread_lock:
+            if self._writer_alive():
+                return
+            try:
+                os.makedirs(self.dirname, exist_ok=True)
+            except OSError as err:
+                lh.error(f'Telemetry: No se pudo crear {self.dirname} ({err})')
+                self._restart_at = monotonic() + self.restart_s
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='telemetry', daemon=True)
+            self._thread.start()
+
+    def add_listener(self, callback: Callable[[dict], None]) -> None:
+        self._listeners.append(callback)
+
+    def remove_listener(self, callback: Callable[[dict], None]) -> None:
+        self._listeners.remove(callback)
+
+    def emit(self, kind: str, **fields) -> None:
+        if not self.enabled:
+            return
+        with self._seq_lock:
+            self._seq += 1
+            seq = self._seq
+        record = {'kind': kind, 'mono': monotonic(), 'wall': time(), 'seq': seq}
+        for k, v in fields.items():
+            record[k] = _snapshot(v)
+        for listener in self._listeners:
+            try:
+                listener(record)
+            except Exception as err:
+                lh.error(f'Telemetry: Fallo un listener con el registro {kind} ({err})')
+        if not self.persist:
+            return
+        if not self._writer_alive():
+            if monotonic() < self._restart_at:
+                # the writer died on a disk error, it is started again later
+                self.n_dropped += 1
+                return
+            self._start()
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            # the control loop is more important than the telemetry
+            self.n_dropped += 1
+
+    def flush(self, timeout: float=5) -> None:
+        if not self._writer_alive():
+            return
+        self._flush_done.clear()
+        try:
+            self._queue.put_nowait(None)
+        except queue.Full:
+            # the writer is behind, it flushes on its own when it catches up
+            return
+        self._flush_done.wait(timeout)
+
+    def close(self) -> None:
+        if self._thread is None:
+            return
+        self.flush()
+        self._stop.set()
+        try:
+            self._queue.put_nowait(None)
+        except queue.Full:
+            pass
+        self._thread.join(5)
+        self._thread = None
+
+    def _encode(self, record: dict) -> bytes:
+        if self.fmt == 'msgpack':
+            return msgpack.packb(record, default=_encode_default, use_bin_type=True)
+        return (json.dumps(record, default=_encode_default, separators=(',', ':')) + '\n').encode('utf-8')
+
+    def _open(self):
+        return open(self.current_file, 'ab', buffering=64*1024)
+
+    def _rotate(self, f):
+        f.close()
+        stamp = datetime.now().strftime('%Y-%m-%d_%H-%M-%S-%f')
+        rolled = os.path.join(self.dirname, f'{self.basename}.{stamp}.{self.extension}')
+        os.replace(self.current_file, rolled)
+        threading.Thread(target=self._compress, args=(rolled,), name='telemetry_gzip', daemon=True).start()
+        return self._open()
+
+    def _compress(self, fname: str) -> None:
+        try:
+            with open(fname, 'rb') as f_in, gzip.open(fname + '.gz', 'wb') as f_out:
+                while True:
+                    chunk = f_in.read(1024*1024)
+                    if not chunk:
+                        break
+                    f_out.write(chunk)
+            os.remove(fname)
+        except OSError as err:
+            lh.error(f'Telemetry: No se pudo comprimir {fname} ({err})')
+            return
+        # remove oldest segments
+        rolled = sorted(segment_files(self.dirname, self.basename, self.extension)[:-1])
+        for old in rolled[:max(len(rolled) - self.backup_count, 0)]:
+            try:
+                os.remove(old)
+            except OSError:
+                pass
+
+    def _run(self) -> None:
+        f = None
+        try:
+            f = self._open()
+            while not self._stop.is_set():
+                try:
+                    record = self._queue.get(timeout=self.flush_interval_s)
+                except queue.Empty:
+                    f.flush()
+                    continue
+                if record is None:
+                    f.flush()
+                    self._flush_done.set()
+                    continue
+                try:
+                    f.write(self._encode(record))
+                except (TypeError, ValueError) as err:
+                    lh.error(f'Telemetry: No se pudo codificar el registro {record.get("kind")} ({err})')
+                if f.tell() >= self.max_bytes:
+                    f = self._rotate(f)
+        except OSError as err:
+            lh.error(f'Telemetry: Error escribiendo telemetria ({err}). Se reintenta en {self.restart_s} s')
+            self._restart_at = monotonic() + self.restart_s
+        finally:
+            if f is not None:
+                try:
+                    f.close()
+                except OSError:
+                    pass
+
+
+def segment_files(dirname: str, basename: str='labino', extension: str='jsonl') -> List[str]:
+    '''
+        returns the telemetry segments in chronological order, the current (not rolled) segment last
+    '''
+    if not os.path.isdir(dirname):
+        return []
+    prefix = basename + '.'
+    rolled = list()
+    current = None
+    for fname in os.listdir(dirname):
+        if not fname.startswith(prefix):
+            continue
+        rest = fname[len(prefix):]
+        if rest == extension:
+            current = fname
+        elif rest.endswith('.' + extension) or rest.endswith('.' + extension + '.gz'):
+            rolled.append(fname)
+    # the timestamp in the name sorts chronologically
+    res = [os.path.join(dirname, fname) for fname in sorted(rolled)]
+    if current is not None:
+        res.append(os.path.join(dirname, current))
+    return res
+
+def _segment_date(fname: str, basename: str) -> Optional[date]:
+    stamp = os.path.basename(fname)[len(basename)+1:].split('.')[0]
+    try:
+        return datetime.strptime(stamp[:10], '%Y-%m-%d').date()
+    except ValueError:
+        return None
+
+def iter_records(fname: str) -> Iterator[dict]:
+    opener = gzip.open if fname.endswith('.gz') else open
+    with opener(fname, 'rb') as f:
+        if '.msgpack' in fname:
+            if msgpack is None:
+                raise ImportError('msgpack is needed to read msgpack telemetry')
+            yield from msgpack.Unpacker(f, raw=False)
+        else:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    # the last line can be truncated if the program was killed
+                    continue
+
+def load_telemetry(dirname: str='telemetry', day: Optional[Union[date, str]]=None, kind: Optional[str]=None, basename: str='labino', extension: str='jsonl') -> List[dict]:
+    '''
+        loads all the records (optionally only of one kind) of the given day (by wall clock).
+        If day is None, all records are loaded.
+        Segments are named after the moment they were rolled, so only segments that
+        can contain records of that day are opened
+    '''
+    if isinstance(day, str):
+        day = datetime.strptime(day, '%Y-%m-%d').date()
+    if day is not None:
+        t0 = datetime.combine(day, datetime.min.time()).timestamp()
+        t1 = t0 + timedelta(days=1).total_seconds()
+    records = list()
+    for fname in segment_files(dirname, basename, extension):
+        if day is not None:
+            d = _segment_date(fname, basename)
+            # a segment rolled on day d has records from d and possibly earlier days
+            if d is not None and d < day:
+                continue
+        done = False
+        for record in iter_records(fname):
+            if kind is not None and record.get('kind') != kind:
+                continue
+            if day is not None:
+                if record['wall'] < t0:
+                    continue
+                if record['wall'] >= t1:
+                    done = True
+                    continue
+            records.append(record)
+        if done:
+            break
+    return records
+
+
+telemetry = TelemetrySink()
+atexit.register(telemetry.close)
+
+
+if __name__ == '__main__':
+    import sys
+    dirname = sys.argv[1] if len(sys.argv) > 1 else 'telemetry'
+    day = sys.argv[2] if len(sys.argv) > 2 else None
+    records = load_telemetry(dirname, day)
+    kinds = dict()
+    for r in records:
+        kinds[r['kind']] = kinds.get(r['kind'], 0) + 1
+    print(f'{len(records)} registros')
+    for k, n in sorted(kinds.items()):
+        print(f'  {k}: {n}')
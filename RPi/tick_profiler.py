@@ -0,0 +1,176 @@
+'''
+    Opt-in profiling of the ticks of a SystemsManager, to find hot spots and memory growth
+    in a loop that has been running for days without restarting it. The ticks are split in
+    phases (dht, acquire, stats, checks, water, persist) and the duration of each one is
+    always measured. Every every_n ticks, and during the next slo_profile_ticks ticks after
+    one went over slo_s (the slow one itself can't be profiled after the fact), the tick is
+    run under cProfile and tracemalloc, and a directory is written with
+        summary.json        duration of each phase and why it was profiled
+        <phase>.prof        cProfile stats of the phase (python -m pstats <phase>.prof)
+        memory.txt          allocations of each phase that were still alive at its end
+        growth.txt          growth since the previous profiled tick (if trace_always)
+    Only the last max_ticks directories are kept
+'''
+from __future__ import annotations
+import os
+import json
+import shutil
+import cProfile
+import tracemalloc
+import dataclasses
+from time import perf_counter, strftime
+from typing import Dict, List, Optional
+from logging_helper import logger as lh
+from telemetry import telemetry as tm
+
+
+def _take_snapshot() -> tracemalloc.Snapshot:
+    # without the allocations of the profiling itself (the previous snapshots, cProfile, ...)
+    return tracemalloc.take_snapshot().filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, cProfile.__file__),
+        tracemalloc.Filter(False, __file__),
+    ))
+
+
+@dataclasses.dataclass(frozen=True)
+class TickProfilerInfo:
+    every_n: int = 0 # every this many ticks of each system, 0 to only profile after slow ticks
+    slo_s: Optional[float] = None # ticks longer than this arm the profiling
+    slo_profile_ticks: int = 3
+    profile_dir: str = 'profiles'
+    max_ticks: int = 50
+    top_n: int = 25 # lines of each memory report
+    trace_frames: int = 5
+    trace_always: bool = False # keeps tracemalloc on between profiled ticks to see the growth, at a cost in every allocation
+
+
+class TickProfiler:
+    def __init__(self, info: Optional[TickProfilerInfo]=None) -> None:
+        self.info = TickProfilerInfo() if info is None else info
+        self.n_profiled = 0
+        self.n_slow = 0
+        self._armed = 0
+        self._system: Optional[int] = None
+        self._tick_count = 0
+        self._profiled = False
+        self._reason = ''
+        self._phase: Optional[str] = None
+        self._phase_start = 0.
+        self._tick_start = 0.
+        self._overhead = 0. # time spent taking the snapshots, not counted in the durations
+        self._durations: Dict[str, float] = dict()
+        self._profiles: Dict[str, cProfile.Profile] = dict()
+        self._memory: Dict[str, List[tracemalloc.StatisticDiff]] = dict()
+        self._snapshot: Optional[tracemalloc.Snapshot] = None
+        self._last_snapshot: Optional[tracemalloc.Snapshot] = None
+        if self.info.trace_always:
+            tracemalloc.start(self.info.trace_frames)
+
+    def begin(self, system: int, tick_count: int) -> None:
+        self._system = system
+        self._tick_count = tick_count
+        self._durations = dict()
+        self._profiles = dict()
+        self._memory = dict()
+        self._phase = None
+        every_n = self.info.every_n
+        if self._armed > 0:
+            self._armed -= 1
+            self._profiled, self._reason = True, 'slo'
+        elif every_n > 0 and tick_count % every_n == 0:
+            self._profiled, self._reason = True, 'every_n'
+        else:
+            self._profiled, self._reason = False, ''
+        if self._profiled and not tracemalloc.is_tracing():
+            tracemalloc.start(self.info.trace_frames)
+        self._overhead = 0.
+        self._tick_start = perf_counter()
+
+    def phase(self, name: str) -> None:
+        ''' the tick moves to phase name (phases can repeat, their durations add up) '''
+        if self._system is None:
+            return
+        self._close_phase()
+        self._phase = name
+        if self._profiled:
+            start = perf_counter()
+            if self._snapshot is None:
+                self._snapshot = _take_snapshot()
+            profile = self._profiles.get(name)
+            if profile is None:
+                profile = self._profiles[name] = cProfile.Profile()
+            self._overhead += perf_counter() - start
+            profile.enable()
+        self._phase_start = perf_counter()
+
+    def _close_phase(self) -> None:
+        if self._phase is None:
+            return
+        end = perf_counter()
+        name = self._phase
+        self._durations[name] = self._durations.get(name, 0.) + end - self._phase_start
+        self._phase = None
+        if self._profiled:
+            self._profiles[name].disable()
+            snapshot = _take_snapshot()
+            diff = [d for d in snapshot.compare_to(self._snapshot, 'lineno') if d.size_diff != 0]
+            self._memory.setdefault(name, list()).extend(diff)
+            self._snapshot = snapshot
+            self._overhead += perf_counter() - end
+
+    def end(self) -> Optional[Dict[str, float]]:
+        ''' finishes the tick. Returns the duration of each phase '''
+        if self._system is None:
+            return None
+        self._close_phase()
+        total = perf_counter() - self._tick_start - self._overhead
+        durations = dict(self._durations, total=total)
+        # the profiled ticks are slower (cProfile), they don't count for the slo
+        if not self._profiled and self.info.slo_s is not None and total > self.info.slo_s:
+            self.n_slow += 1
+            self._armed = self.info.slo_profile_ticks
+            lh.warning(f'TickProfiler: El tick {self._tick_count} del sistema {self._system} duro {total:.2f} s (slo {self.info.slo_s} s). Se perfilan los proximos {self._armed}')
+            tm.emit('tick_slow', system=self._system, tick=self._tick_count, phases=durations)
+        if self._profiled:
+            self._write(durations)
+            self._snapshot = None
+            if not self.info.trace_always:
+                tracemalloc.stop()
+        self._system = None
+        return durations
+
+    def _write(self, durations: Dict[str, float]) -> None:
+        info = self.info
+        dirname = os.path.join(info.profile_dir, f'{strftime("%Y-%m-%d_%H-%M-%S")}_system{self._system}_tick{self._tick_count}')
+        try:
+            os.makedirs(dirname, exist_ok=True)
+            with open(os.path.join(dirname, 'summary.json'), 'w') as f:
+                json.dump({'system': self._system, 'tick': self._tick_count, 'reason': self._reason, 'phases': durations}, f, indent=1)
+            for name, profile in self._profiles.items():
+                profile.dump_stats(os.path.join(dirname, f'{name}.prof'))
+            with open(os.path.join(dirname, 'memory.txt'), 'w') as f:
+                for name, diff in self._memory.items():
+                    diff.sort(key=lambda d: abs(d.size_diff), reverse=True)
+                    f.write(f'--- {name}: {sum(d.size_diff for d in diff) / 1024:+.1f} KiB\n')
+                    for d in diff[:info.top_n]:
+                        f.write(f'{d}\n')
+            if info.trace_always:
+                snapshot = _take_snapshot()
+                if self._last_snapshot is not None:
+                    with open(os.path.join(dirname, 'growth.txt'), 'w') as f:
+                        for d in snapshot.compare_to(self._last_snapshot, 'traceback')[:info.top_n]:
+                            f.write(f'{d}\n')
+                            for line in d.traceback.format():
+                                f.write(f'    {line}\n')
+                self._last_snapshot = snapshot
+            self.n_profiled += 1
+            self._rotate()
+            tm.emit('tick_profile', system=self._system, tick=self._tick_count, reason=self._reason, phases=durations, dirname=dirname)
+        except OSError as err:
+            lh.warning(f'TickProfiler: No se pudo guardar el perfil en {dirname} ({err})')
+
+    def _rotate(self) -> None:
+        dirs = sorted(d for d in os.listdir(self.info.profile_dir) if os.path.isdir(os.path.join(self.info.profile_dir, d)))
+        for d in dirs[:max(len(dirs) - self.info.max_ticks, 0)]:
+            shutil.rmtree(os.path.join(self.info.profile_dir, d), ignore_errors=True)
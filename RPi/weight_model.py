@@ -0,0 +1,189 @@
+from __future__ import annotations
+import math
+import dataclasses
+from typing import Iterable, Optional, Tuple
+from smart_arrays import SmartArray
+
+
+@dataclasses.dataclass(frozen=True)
+class WeightModelInfo:
+    '''
+        Configuration of the predictive weight model.
+        The pot loses water at a rate of et_coef * vpd grams per hour, where vpd is the
+        vapour pressure deficit (in kPa) computed from the DHT readings and et_coef is
+        estimated online for each pot
+    '''
+    initial_et_coef: float = 5 # g/h/kPa
+    initial_et_coef_stdev: float = 10 # g/h/kPa
+    process_noise_weight: float = 1 # g^2 per hour
+    process_noise_et_coef: float = .5 # (g/h/kPa)^2 per hour
+    default_vpd: float = 1 # kPa, used until the DHT is read
+    margin_sigmas: float = 3 # the prediction minus margin_sigmas stdevs must be over the goal...
+    margin_grams: float = 10 # ...by at least margin_grams
+    max_stdev: float = 5 # g. A real weighing is done if the prediction is more uncertain than this
+    max_skipped_ticks: int = 10 # a real weighing is done at least every max_skipped_ticks+1 ticks
+
+
+def vapour_pressure_deficit(hum: float, temp: float) -> float:
+    ''' vapour pressure deficit in kPa (Tetens equation), hum in %, temp in C '''
+    saturation = 0.6108 * math.exp(17.27 * temp / (temp + 237.3))
+    return max(saturation * (1 - hum / 100), 0)
+
+
+class PotKalmanFilter:
+    '''
+        Kalman filter of a single pot with state [weight, et_coef]:
+            weight_{k+1} = weight_k - et_coef_k * vpd * dt
+            et_coef_{k+1} = et_coef_k
+        The model is linear in the state since vpd and dt are known inputs
+    '''
+    __slots__ = ('info', 'w', 'k', 'p00', 'p01', 'p11', 'initialized')
+
+    def __init__(self, info: WeightModelInfo) -> None:
+        self.info = info
+        self.initialized = False
+        self.w = 0.
+        self.k = info.initial_et_coef
+        self.p00 = 0.
+        self.p01 = 0.
+        self.p11 = info.initial_et_coef_stdev**2
+
+    @property
+    def stdev(self) -> float:
+        return math.sqrt(max(self.p00, 0))
+
+    def predict(self, dt_h: float, vpd: float) -> None:
+        if not self.initialized or dt_h <= 0:
+            return
+        a = -vpd * dt_h # F = [[1, a], [0, 1]]
+        self.w += a * self.k
+        # P = F P F^T + Q
+        p00 = self.p00 + 2 * a * self.p01 + a * a * self.p11
+        p01 = self.p01 + a * self.p11
+        self.p00 = p00 + self.info.process_noise_weight * dt_h
+        self.p01 = p01
+        self.p11 = self.p11 + self.info.process_noise_et_coef * dt_h
+
+    def update(self, z: float, z_stdev: float) -> None:
+        r = max(z_stdev, 1e-6)**2
+        if not self.initialized:
+            self.w = z
+            self.p00 = r
+            self.p01 = 0.
+            self.initialized = True
+            return
+        # H = [1, 0]
+        s = self.p00 + r
+        k0 = self.p00 / s
+        k1 = self.p01 / s
+        y = z - self.w
+        self.w += k0 * y
+        self.k += k1 * y
+        p00, p01, p11 = self.p00, self.p01, self.p11
+        self.p00 = (1 - k0) * p00
+        self.p01 = (1 - k0) * p01
+        self.p11 = p11 - k1 * p01
+
+    def disturb(self, stdev: float) -> None:
+        ''' the weight changed by an unknown amount (for example it was watered) '''
+        self.p00 += stdev**2
+
+
+class WeightModel:
+    '''
+        Predicts the weight of every pot of a system between weighings, so that the
+        acquisition can be skipped while all pots are safely over their goal
+    '''
+    def __init__(self, n_balanzas: int, info: Optional[WeightModelInfo]=None) -> None:
+        self.info = WeightModelInfo() if info is None else info
+        self.n_balanzas = n_balanzas
+        self.filters = tuple(PotKalmanFilter(self.info) for _ in range(n_balanzas))
+        self.vpd = self.info.default_vpd
+        self.last_time_s: Optional[float] = None
+        self.skipped_ticks = 0
+
+    def predict(self, time_s: float, hum: Optional[float]=None, temp: Optional[float]=None) -> None:
+        ''' advances the model until time_s (monotonic seconds) '''
+        if hum is not None and temp is not None and not (math.isnan(hum) or math.isnan(temp)):
+            self.vpd = vapour_pressure_deficit(hum, temp)
+        if self.last_time_s is not None:
+            dt_h = (time_s - self.last_time_s) / 3600
+            for f in self.filters:
+                f.predict(dt_h, self.vpd)
+        self.last_time_s = time_s
+
+    def update(self, means: Iterable[float], stdevs: Iterable[float], mask: Optional[Iterable[bool]]=None) -> None:
+        ''' mask selects the pots that were actually weighed (all if None) '''
+        mask = (True,)*self.n_balanzas if mask is None else mask
+        for f, m, s, weighed in zip(self.filters, means, stdevs, mask):
+            if weighed:
+                f.update(m, s)
+        self.skipped_ticks = 0
+
+    def watered(self, index: int, stdev: float=1000) -> None:
+        self.filters[index].disturb(stdev)
+
+    def predicted(self) -> Tuple[SmartArray, SmartArray]:
+        ''' returns the predicted means and stdevs '''
+        return (
+            SmartArray(tuple(f.w for f in self.filters), float),
+            SmartArray(tuple(f.stdev for f in self.filters), float)
+        )
+
+    def initialized(self) -> SmartArray:
+        ''' mask of the pots whose filter has had a measurement '''
+        return SmartArray(tuple(f.initialized for f in self.filters), bool)
+
+    def pot_is_safe(self, index: int, limit: float) -> bool:
+        ''' True if the predicted weight of the pot is confidently over limit '''
+        f = self.filters[index]
+        if not f.initialized:
+            return False
+        stdev = f.stdev
+        if stdev > self.info.max_stdev:
+            return False
+        return f.w - self.info.margin_sigmas * stdev > limit + self.info.margin_grams
+
+    def safe_pots(self, limits: Iterable[float]) -> SmartArray:
+        ''' mask of pot_is_safe for all the pots '''
+        if not isinstance(limits, SmartArray):
+            limits = SmartArray(tuple(limits), float)
+        means, stdevs = self.predicted()
+        info = self.info
+        return self.initialized() & (stdevs <= info.max_stdev) & (means - info.margin_sigmas * stdevs > limits + info.margin_grams)
+
+    def can_skip(self, limits: Iterable[float], relevant: Iterable[bool]) -> bool:
+        '''
+            True if the weighing of this tick can be skipped, that is, if all the relevant
+            pots are predicted to be safely over their limit (grams_goals - grams_threshold)
+        '''
+        if self.skipped_ticks >= self.info.max_skipped_ticks:
+            return False
+        if not isinstance(relevant, SmartArray):
+            relevant = SmartArray(tuple(relevant), bool)
+        return (self.safe_pots(limits) | ~relevant).all()
+
+    def skip(self) -> None:
+        self.skipped_ticks += 1
+
+
+if __name__ == '__main__':
+    import random
+    model = WeightModel(1)
+    w = 700.
+    t = 0.
+    n_weighings = 0
+    for tick in range(200):
+        t += 600
+        w -= 4 * vapour_pressure_deficit(50, 25) * 600 / 3600
+        model.predict(t, 50, 25)
+        if model.can_skip((650,), (True,)):
+            model.skip()
+            continue
+        n_weighings += 1
+        model.update((w + random.gauss(0, 1),), (1,))
+        if w < 650:
+            w += 60
+            model.watered(0)
+    means, stdevs = model.predicted()
+    print(f'real={w:.1f} predicted={means[0]:.1f}+/-{stdevs[0]:.1f} et_coef={model.filters[0].k:.2f} weighings={n_weighings}/200')